@@ -0,0 +1,340 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AdaptiveSweep.py:
+
+This file runs Monte Carlo sweeps whose number of replications adapts to the noise of their results. Rather than a
+fixed number of replications, run_adaptive_sweep runs batches of replications with run_sweep, and keeps the running
+mean and variance of the final-period statistics of each scenario (price of green delivery and simulation type):
+TotalEmission, the share of green delivery users GreenShare, and TotalUtility. A scenario stops once the confidence
+intervals of all of its statistics are narrower than their targets, or once it reaches max_replications, so that the
+following batches only simulate the scenarios which are still noisy.
+
+Every batch runs the replications following those of the previous batch, with the same seed, so that replication r of
+every scenario starts from the same agents whatever the batches it was run in. The scenarios still running at a price
+are grouped by their simulation types, and each group of prices with the same types is one run_sweep.
+
+With a checkpoint_dir, the state of the controller is saved after each run_sweep, whose own checkpoints are kept in a
+subdirectory, so that an interrupted adaptive sweep is continued with resume_adaptive_sweep. The results of each
+run_sweep are saved once, in a file of their own, so that the checkpoints grow linearly with the number of batches.
+"""
+
+import functools
+import math
+import os
+import shutil
+
+import pandas as pd
+
+from Sweep import *
+
+# Confidence interval half-width targets of the final-period statistics, as (kind, half-width). The totals grow with the
+# number of agents, so their targets are relative to their mean, while the share of green users has an absolute target.
+DEFAULT_TARGETS = {
+    'TotalEmission': ('relative', 0.01),
+    'GreenShare': ('absolute', 0.01),
+    'TotalUtility': ('relative', 0.005)
+}
+
+
+class RunningStats:
+    """
+    Streaming estimator of the mean and variance of a statistic (Welford's algorithm), which does not keep its values.
+    """
+
+    def __init__(self):
+        self.Count = 0
+        self.Mean = 0.0
+        self.SquaredDeviations = 0.0
+
+    def Add(self, value):
+        self.Count += 1
+        delta = value - self.Mean
+        self.Mean += delta / self.Count
+        self.SquaredDeviations += delta * (value - self.Mean)
+
+    def Variance(self):
+        """
+        :return: the sample variance, or nan for fewer than two values
+        """
+        return self.SquaredDeviations / (self.Count - 1) if self.Count > 1 else np.nan
+
+    def HalfWidth(self, confidence):
+        """
+        :param confidence: confidence level of the interval
+        :return: half-width of the confidence interval of the mean, from Student's t distribution with Count - 1
+                 degrees of freedom
+        """
+        if self.Count < 2:
+            return np.inf
+        return t_quantile(confidence, self.Count - 1) * np.sqrt(self.Variance() / self.Count)
+
+
+@functools.lru_cache(maxsize=None)
+def t_quantile(confidence, degrees):
+    """
+    The two-sided quantile of Student's t distribution: the t for which P(|T| < t) = confidence. P(|T| < t) has a
+    closed form for integer degrees of freedom, a finite series in the cosine of atan(t / sqrt(degrees)), which is
+    inverted by bisection.
+
+    :param confidence: confidence level, between 0 and 1
+    :param degrees:    degrees of freedom, a positive integer
+    """
+    def probability(t):
+        theta = math.atan(t / math.sqrt(degrees))
+        cos2 = math.cos(theta) ** 2
+        if degrees % 2 == 1:
+            series, term = 0.0, 1.0
+            for k in range(1, (degrees - 1) // 2 + 1):
+                series += term
+                term *= 2 * k / (2 * k + 1) * cos2
+            return 2 / math.pi * (theta + math.sin(theta) * math.cos(theta) * series)
+
+        series, term = 0.0, 1.0
+        for k in range(1, degrees // 2 + 1):
+            series += term
+            term *= (2 * k - 1) / (2 * k) * cos2
+        return math.sin(theta) * series
+
+    low, high = 0.0, 1.0
+    while probability(high) < confidence:
+        low, high = high, 2 * high
+    for i in range(100):
+        middle = (low + high) / 2
+        if probability(middle) < confidence:
+            low = middle
+        else:
+            high = middle
+    return high
+
+
+class ReplicationController:
+
+    def __init__(self, prices, modes, targets=None, confidence=0.95, min_replications=10, max_replications=100):
+        """
+        :param prices:           prices of green delivery of the scenarios
+        :param modes:            simulation types of the scenarios
+        :param targets:          dict of the confidence interval half-width target of each statistic, as
+                                 ('absolute', half-width) or ('relative', fraction of the mean). None uses
+                                 DEFAULT_TARGETS.
+        :param confidence:       confidence level of the intervals, whose half-widths use Student's t distribution
+        :param min_replications: number of replications of every scenario before it can stop
+        :param max_replications: number of replications after which a scenario stops, whatever its intervals
+        """
+        self.Targets = DEFAULT_TARGETS if targets is None else targets
+        self.Confidence = confidence
+        self.MinReplications = min_replications
+        self.MaxReplications = max_replications
+        self.Prices = list(prices)
+        self.Modes = tuple(modes)
+        self.Stats = {(cG, mode): {name: RunningStats() for name in self.Targets}
+                      for cG in self.Prices for mode in self.Modes}
+        self.Stopped = {}  # reason each stopped scenario stopped, 'converged' or 'budget'
+
+    def Add(self, cG, mode, simulation_stats):
+        for name, value in final_period_statistics(simulation_stats).items():
+            if name in self.Targets:
+                self.Stats[(cG, mode)][name].Add(value)
+
+    def Replications(self, cG, mode):
+        return min(stats.Count for stats in self.Stats[(cG, mode)].values())
+
+    def Converged(self, cG, mode):
+        if self.Replications(cG, mode) < self.MinReplications:
+            return False
+
+        for name, (kind, half_width) in self.Targets.items():
+            stats = self.Stats[(cG, mode)][name]
+            if kind == 'relative':
+                half_width *= abs(stats.Mean)
+            if not stats.HalfWidth(self.Confidence) <= half_width:
+                return False
+        return True
+
+    def Update(self):
+        """
+        Stops the scenarios which have converged or have reached MaxReplications.
+        """
+        for cG, mode in self.Running():
+            if self.Converged(cG, mode):
+                self.Stopped[(cG, mode)] = 'converged'
+            elif self.Replications(cG, mode) >= self.MaxReplications:
+                self.Stopped[(cG, mode)] = 'budget'
+
+    def Running(self):
+        """
+        :return: list of the (price, mode) scenarios which have not stopped
+        """
+        return [scenario for scenario in self.Stats if scenario not in self.Stopped]
+
+    def Groups(self):
+        """
+        :return: list of (prices, modes) of the running scenarios, grouping the prices which run the same modes
+        """
+        groups = {}
+        for cG in self.Prices:
+            modes = tuple(mode for mode in self.Modes if (cG, mode) in self.Stats and (cG, mode) not in self.Stopped)
+            if modes:
+                groups.setdefault(modes, []).append(cG)
+        return [(prices, modes) for modes, prices in groups.items()]
+
+    def Summary(self):
+        """
+        :return: DataFrame of the replications, mean, standard deviation and confidence interval half-width of each
+                 statistic of each scenario, and why the scenario stopped
+        """
+        rows = []
+        for (cG, mode), scenario_stats in self.Stats.items():
+            for name, stats in scenario_stats.items():
+                rows.append({'PriceOfGreenDelivery': cG, 'Mode': mode, 'Statistic': name,
+                             'Replications': stats.Count, 'Mean': stats.Mean, 'Std': np.sqrt(stats.Variance()),
+                             'HalfWidth': stats.HalfWidth(self.Confidence), 'Stopped': self.Stopped.get((cG, mode))})
+        return pd.DataFrame(rows)
+
+
+def final_period_statistics(simulation_stats):
+    """
+    :param simulation_stats: simulation statistics of a run, one row per period
+    :return: dict of the statistics of its final period tracked by ReplicationController
+    """
+    final = simulation_stats.iloc[-1]
+    users = final['GreenUsers'] + final['NormalUsers']
+    return {'TotalEmission': float(final['TotalEmission']),
+            'GreenShare': float(final['GreenUsers'] / users) if users > 0 else 0.0,
+            'TotalUtility': float(final['TotalUtility'])}
+
+
+def run_adaptive_sweep(config, prices, modes=('benchmark', 'normal', 'social'), periods=24, targets=None,
+                       confidence=0.95, min_replications=10, max_replications=100, batch_size=5, budget=None,
+                       workers=None, save=True, seed=None, batch_prices=False, checkpoint_dir=None):
+    """
+    Runs batches of replications of every simulation type in modes at every price in prices, until the confidence
+    intervals of the final-period statistics of each (price, mode) scenario meet their targets, or its replications or
+    the sweep's budget run out (see ReplicationController).
+
+    :param config:           dict of Engine keyword arguments, see run_sweep
+    :param prices:           prices of green delivery to simulate
+    :param modes:            simulation types to run, any of 'benchmark', 'normal' and 'social'
+    :param periods:          number of periods for each simulation
+    :param targets:          confidence interval half-width targets, see ReplicationController
+    :param confidence:       confidence level of the intervals
+    :param min_replications: number of replications of the first batch, which every scenario runs
+    :param max_replications: largest number of replications of a scenario
+    :param batch_size:       number of replications of each following batch
+    :param budget:           largest number of (replication, price, mode) simulations of the sweep, or None
+    :param workers:          number of worker processes, see run_sweep
+    :param save:             If True, the statistics of every batch are saved to ./SavedStats
+    :param seed:             Seed of the sweep, see run_sweep. All batches use it, and if None, it is drawn and logged
+                             once.
+    :param batch_prices:     see run_sweep
+    :param checkpoint_dir:   If given, the sweep is checkpointed in this directory, so that it can be continued with
+                             resume_adaptive_sweep if it is interrupted. It is deleted once the sweep is complete.
+    :return: summary DataFrame of the scenarios (see ReplicationController.Summary), and the list of (replication,
+             price, mode, simulation statistics, agent sample) of every batch
+    """
+    arguments = dict(config=config, prices=list(prices), modes=tuple(modes), periods=periods, targets=targets,
+                     confidence=confidence, min_replications=min_replications, max_replications=max_replications,
+                     batch_size=batch_size, budget=budget, save=save, seed=seed, batch_prices=batch_prices)
+
+    state = None
+    if checkpoint_dir is not None:
+        state = start_adaptive_checkpoints(checkpoint_dir, arguments)
+    if state is None:
+        if seed is None:
+            seed = np.random.SeedSequence().entropy  # every batch needs the same seed
+            log_message(f"Sweep seed: {seed}")
+        controller = ReplicationController(prices, modes, targets, confidence, min_replications, max_replications)
+        state = dict(arguments=dict(arguments, seed=seed), controller=controller, sweeps=0, replications=0,
+                     simulations=0, pending=[])
+    controller = state['controller']
+    seed = state['arguments']['seed']
+    all_results = [result for sweep in range(state['sweeps'])
+                   for result in read_pickle(sweep_results_path(checkpoint_dir, sweep))]
+
+    while controller.Running() or state['pending']:
+        if not state['pending']:
+            running = len(controller.Running())
+            count = min_replications if state['replications'] == 0 else batch_size
+            count = min(count, max_replications - state['replications'])
+            if budget is not None:
+                count = min(count, (budget - state['simulations']) // running)
+            if count <= 0:
+                for scenario in controller.Running():
+                    controller.Stopped[scenario] = 'budget'
+                break
+            state['pending'] = [(state['replications'], count, group_prices, group_modes)
+                                for group_prices, group_modes in controller.Groups()]
+            log_message(f"\nReplications {state['replications']} to {state['replications'] + count - 1} of "
+                        f"{running} scenarios")
+            if checkpoint_dir is not None:
+                write_pickle(adaptive_checkpoint_path(checkpoint_dir), state)
+
+        first_replication, count, group_prices, group_modes = state['pending'][0]
+        batch_checkpoint_dir = None
+        if checkpoint_dir is not None:
+            batch_checkpoint_dir = os.path.join(checkpoint_dir,
+                                                f'batch-{first_replication:06d}-{len(state["pending"])}')
+        results = run_sweep(config, group_prices, count, modes=group_modes, periods=periods, workers=workers,
+                            save=save, seed=seed, batch_prices=batch_prices, checkpoint_dir=batch_checkpoint_dir,
+                            first_replication=first_replication)
+        for replication, cG, mode, simulation_stats, agent_sample in results:
+            controller.Add(cG, mode, simulation_stats)
+        all_results.extend(results)
+        if checkpoint_dir is not None:
+            write_pickle(sweep_results_path(checkpoint_dir, state['sweeps']), results)
+        state['sweeps'] += 1
+        state['simulations'] += count * len(group_prices) * len(group_modes)
+
+        state['pending'] = state['pending'][1:]
+        if not state['pending']:
+            state['replications'] = first_replication + count
+            controller.Update()
+        if checkpoint_dir is not None:
+            write_pickle(adaptive_checkpoint_path(checkpoint_dir), state)
+
+    summary = controller.Summary()
+    log_message(f"\nAdaptive sweep: {state['simulations']} simulations\n{summary.to_string(index=False)}")
+    if checkpoint_dir is not None:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+    return summary, all_results
+
+
+def resume_adaptive_sweep(checkpoint_dir, workers=None):
+    """
+    Continues an adaptive sweep started by run_adaptive_sweep with checkpoint_dir which was interrupted, with the same
+    arguments and seed.
+
+    :param checkpoint_dir: checkpoint_dir of the interrupted sweep
+    :param workers:        number of worker processes, see run_sweep
+    :return: the results of run_adaptive_sweep
+    """
+    if not os.path.exists(adaptive_checkpoint_path(checkpoint_dir)):
+        raise ValueError(f"No interrupted adaptive sweep to resume in {checkpoint_dir}")
+
+    state = read_pickle(adaptive_checkpoint_path(checkpoint_dir))
+    log_message(f"Resuming the adaptive sweep in {checkpoint_dir}")
+    return run_adaptive_sweep(**state['arguments'], workers=workers, checkpoint_dir=checkpoint_dir)
+
+
+def start_adaptive_checkpoints(checkpoint_dir, arguments):
+    """
+    :return: the state of the adaptive sweep checkpointed in checkpoint_dir, or None if there is none
+    """
+    if not os.path.exists(adaptive_checkpoint_path(checkpoint_dir)):
+        return None
+
+    state = read_pickle(adaptive_checkpoint_path(checkpoint_dir))
+    seed = arguments['seed'] if arguments['seed'] is not None else state['arguments']['seed']
+    if state['arguments'] != dict(arguments, seed=seed):
+        raise ValueError(f"{checkpoint_dir} holds the checkpoints of another sweep: continue it with "
+                         f"resume_adaptive_sweep, or delete it")
+    return state
+
+
+def adaptive_checkpoint_path(checkpoint_dir):
+    return os.path.join(checkpoint_dir, 'adaptive.pkl')
+
+
+def sweep_results_path(checkpoint_dir, sweep):
+    return os.path.join(checkpoint_dir, f'results-{sweep:06d}.pkl')
@@ -3,18 +3,49 @@
 """
 Agent.py:
 
-This file stores the Agent class.
+This file stores the Agent class. Agents keep no state of their own: they are views of one entry of a Population and
+its History (see Population.py and History.py).
 """
 
-from EnvSymbols import *  # Also imports math and sympy
 from Constants import *
+from Population import *
+from Instrumentation import *
+
+
+def population_property(name, doc):
+    """
+    A property reading and writing the agent's entry of a Population array.
+    """
+    def get(self):
+        return getattr(self.Population, name)[self.Index].item()
+
+    def set(self, value):
+        getattr(self.Population, name)[self.Index] = value
+
+    return property(get, set, doc=doc)
+
+
+def history_property(name, doc):
+    """
+    A property returning a dict-like view of the agent's column of a History record, keyed by period.
+    """
+    def get(self):
+        return PeriodRecords(self.Population.History, name, self.Index)
+
+    return property(get, doc=doc)
 
 
 class Agent:
+    """
+    An Agent is a view of one entry of a Population: its parameters and state are read from and written to the
+    Population's arrays, and its records to the Population's History.
+    """
+
+    __slots__ = ('Population', 'Index')
 
     def __init__(self, _id, a, b, mu, Y, p, delta=0, friends=[]):
         """
-        Initialises an Agent object with the following attributes:
+        Initialises an Agent object, backed by a Population of one agent, with the following attributes:
 
         :param _id: Unique identifier
         :param a: Preference for consumption (coefficient of ln[Q])
@@ -26,40 +57,65 @@ class Agent:
         :param delta:
         :param friends: a list of agent ids who the Agent values the opinion of
         """
-        print(f"Initialising agent {_id}")
-
-        self.Id = _id
+        log_message(f"Initialising agent {_id}")
 
-        # Expression variables
-        self.Budget = Y
-        self.A = a
-        self.B = b
-       # self.UtilityExpr = a * ln(Q) + b * ln(S) - a*ln(mu * e_rate * Q + 1)
-        self.Price = p
-        self.EcoCon = mu
+        self.Population = Population([_id], [a], [b], [mu], [Y], p, [delta], FriendIndex.FromFriendLists([friends]))
+        self.Index = 0
 
-        # Current period props
-        self.CurrentPlan = 'Normal'  # plan defaults to normal delivery
-        self.CurrentUtility = 0
-
-        # Friendship
-        self.Friends = []
-        self.Delta = delta
-        self.Friend_Effect = None
-
-        # History
-        self.Qrecords = {}
-        self.Srecords = {}
-        self.BudgetHistory = {}
-        self.PlanRecords = {}
-        self.GreenUtility = {}
-        self.NormalUtility = {}
-        self.GenericUtility = {}
-
-        self.UtilityDisparity = {}
-        self.Erecords = {}
-
-        # ErrorLogger
+    @classmethod
+    def View(cls, population, index):
+        """
+        An Agent viewing entry index of a Population. A Population simulated at several prices at once has one state per
+        price: an Agent views the Population of one price, from Population.Batch.
+        """
+        if population.Budget.ndim > 1:
+            raise ValueError("Agents view the Population of one price: view Population.Batch(index) of a Population "
+                             "simulated at several prices")
+        agent = cls.__new__(cls)
+        agent.Population = population
+        agent.Index = index
+        return agent
+
+    # Expression variables
+    Id = population_property('Id', "Unique identifier")
+    Budget = population_property('Budget', "Disposable income")
+    A = population_property('A', "Preference for consumption (coefficient of ln[Q])")
+    B = population_property('B', "Preference for savings (coefficient of ln[S])")
+    EcoCon = population_property('EcoCon', "Eco-consciousness")
+    Delta = population_property('Delta', "Affinity towards friends' opinions")
+
+    @property
+    def Price(self):
+        return self.Population.Price
+
+    # Current period props
+    CurrentUtility = population_property('CurrentUtility', "Utility of the selected plan")
+
+    @property
+    def CurrentPlan(self):
+        return PLAN_NAMES[self.Population.CurrentPlan[self.Index]]
+
+    @CurrentPlan.setter
+    def CurrentPlan(self, plan):
+        self.Population.CurrentPlan[self.Index] = PLAN_CODES[plan]
+
+    # Friendship
+    @property
+    def Friends(self):
+        """
+        A list of agent ids who the Agent values the opinion of
+        """
+        return self.Population.FriendIndex.FriendsOf(self.Index).tolist()
+
+    # History
+    Qrecords = history_property('Qrecords', "Quantity of goods consumed, by period")
+    Srecords = history_property('Srecords', "Savings, by period")
+    BudgetHistory = history_property('BudgetHistory', "Budget, by period")
+    PlanRecords = history_property('PlanRecords', "Selected delivery plan, by period")
+    GreenUtility = history_property('GreenUtility', "Utility if the green plan is selected, by period")
+    NormalUtility = history_property('NormalUtility', "Utility if the normal plan is selected, by period")
+    UtilityDisparity = history_property('UtilityDisparity', "GreenUtility - NormalUtility, by period")
+    Erecords = history_property('Erecords', "Emissions, by period")
 
     def EnterGenericRound(self, period, cG, cN, eG, eN, utility_handler):
         self.CurrentUtility = self.compare_generic(period, cG, cN, eG, eN, utility_handler)
@@ -127,7 +183,7 @@ class Agent:
         return
 
     
-    def EnterSocialRound(self, period, cG, cN, eG, eN, friends, utility_handler):
+    def EnterSocialRound(self, period, cG, cN, eG, eN, green_share, normal_share, utility_handler):
         """
         At each period (round),
 
@@ -136,14 +192,17 @@ class Agent:
         :param cN:
         :param eG:
         :param eN:
-        :param friends:
+        :param green_share: share of the agent's friends on the green plan last period
+        :param normal_share: share of the agent's friends on the normal plan last period
         :return:
         """
-        self.CurrentUtility = self.compare_generic_social(period, cG, cN, eG, eN, friends, utility_handler)
+        self.CurrentUtility = self.compare_generic_social(period, cG, cN, eG, eN, green_share, normal_share,
+                                                          utility_handler)
 
-    def compare_generic_social(self, period, cG, cN, eG, eN, friends, utility_handler):
+    def compare_generic_social(self, period, cG, cN, eG, eN, green_share, normal_share, utility_handler):
         # Eval utility for green delivery
-        util_green, util_normal = self.evaluate_green_normal_social(utility_handler, cG, cN, eG, eN, friends, period)
+        util_green, util_normal = self.evaluate_green_normal_social(utility_handler, cG, cN, eG, eN, green_share,
+                                                                    normal_share)
 
         # compare utilities
         green_is_better = util_green > util_normal  # and util_green != util_normal  # I think this second operation is redundant
@@ -158,15 +217,11 @@ class Agent:
             self.assign_budget_and_utilities_disparity(period, util_green, util_normal)
             return util_normal
 
-    def evaluate_green_normal_social(self, utility_handler, cG, cN, eG, eN, friends, period):
+    def evaluate_green_normal_social(self, utility_handler, cG, cN, eG, eN, green_share, normal_share):
         util_green = utility_handler.LambdifySocial(self.A, self.B, self.EcoCon, self.Budget, self.Price, eG, cG,
-                                                    self.Delta,
-                                                    sum([1 for friend in friends if
-                                                         friend.PlanRecords[period - 1] == 'Green']) / len(friends))
+                                                    self.Delta, green_share)
         util_normal = utility_handler.LambdifySocial(self.A, self.B, self.EcoCon, self.Budget, self.Price, eN, cN,
-                                                     self.Delta,
-                                                     sum([1 for friend in friends if
-                                                          friend.PlanRecords[period - 1] == 'Normal']) / len(friends))
+                                                     self.Delta, normal_share)
 
         return util_green, util_normal
 
@@ -195,6 +250,8 @@ class Agent:
             self.Srecords[period] = self.Budget
             self.assign_budget_and_utilities_disparity(period, 0, util_normal)
 
+        return util_normal
+
     def UpdateBudget(self,period):
         # add savings
         self.Budget += Constants.FractionOfSavings() * self.Srecords[period]
@@ -4,18 +4,108 @@
 AggregationManager.py:
 
 This file stores the AggregationManager class. The AggregationManager contains functions that reports the statistics of
-the Engine and Agents, and saves the statistics to csv files under ./SavedStats.
+the Engine and Agents, and saves the statistics under ./SavedStats, as csv files or columnar datasets (simulation
+statistics are appended through a ResultSink).
+
+Agent samples of more than AGENT_CHUNK_SIZE agents are never built as one dataframe: they are saved chunk by chunk, or,
+if they are not saved straight away, spooled to disk chunk by chunk as an AgentSampleSpool, which takes their place in
+the results of the run.
 """
 
 import pandas as pd
 import numpy as np
 import os as os
-import random as rand
+import shutil
+import uuid
+
+from Checkpoint import *
+from History import *
+from ResultSink import *
+from Instrumentation import *
+
+# Number of agents per chunk when agent samples are saved in chunks
+AGENT_CHUNK_SIZE = 10000
+
+# Directory of the AgentSampleSpools
+AGENT_SPOOL_DIR = './SavedStats/agent_sample_spool'
+
+
+class AgentSampleSpool:
+    """
+    An agent sample written to disk one chunk at a time, see AggregationManager.SpoolAgentSample. It is pickled with
+    the results of a run in place of the sample, and its chunks are read back one at a time. Its files stay on disk
+    until Remove is called.
+    """
+
+    def __init__(self, directory, num_chunks):
+        self.Directory = directory
+        self.NumChunks = num_chunks
+
+    def ChunkPath(self, number):
+        return os.path.join(self.Directory, f'part-{number:06d}.pkl')
+
+    def Chunks(self):
+        """
+        :return: generator of the sample's dataframes, as from AggregationManager.AgentSampleChunks
+        """
+        for number in range(self.NumChunks):
+            yield read_pickle(self.ChunkPath(number))
+
+    def Read(self):
+        """
+        :return: the whole sample as one Pandas dataframe
+        """
+        return pd.concat(list(self.Chunks()), ignore_index=True)
+
+    def Exists(self):
+        return all(os.path.exists(self.ChunkPath(number)) for number in range(self.NumChunks))
+
+    def Move(self, directory):
+        """
+        Moves the spool's files to directory, such as that of a ResultCache entry.
+        """
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(os.path.dirname(directory) or '.', exist_ok=True)
+        shutil.move(self.Directory, directory)
+        self.Directory = directory
+
+    def Remove(self):
+        shutil.rmtree(self.Directory, ignore_errors=True)
+
+    def Temporary(self):
+        """
+        Whether the spool is still under AGENT_SPOOL_DIR, rather than moved to a ResultCache which keeps it.
+        """
+        return os.path.dirname(os.path.normpath(self.Directory)) == os.path.normpath(AGENT_SPOOL_DIR)
+
+
+def agent_sample_spools(results):
+    """
+    :param results: results of a run (see Engine.FinishRun), a list of them or a dict of them by simulation type
+    :return: list of the AgentSampleSpools in results
+    """
+    if isinstance(results, AgentSampleSpool):
+        return [results]
+    if isinstance(results, dict):
+        results = list(results.values())
+    if isinstance(results, (list, tuple)):
+        return [spool for result in results for spool in agent_sample_spools(result)]
+    return []
 
 
 class AggregationManager:
 
-    def __init__(self, eG, eN, cG, cN):
+    def __init__(self, eG, eN, cG, cN, rng=None, output_format='csv'):
+        """
+        :param rng:           numpy Generator from which agent samples are drawn
+        :param output_format: 'csv', or one of the columnar formats 'parquet', 'feather' and 'npz', which save datasets
+                              partitioned by price of green delivery (see ResultSink.py)
+        """
+        self.Rng = np.random.default_rng(rng)
+        self.Totals = None
+        self.TotalsKey = None
+        self.OutputFormat = output_format
+        self.ResultSink = ResultSink(output_format=output_format)
         self.eG = eG
         self.eN = eN
         self.cG = cG
@@ -23,222 +113,247 @@ class AggregationManager:
 
     def Reset(self, cG):
         self.cG = cG
-    def AddAgentSampleToCSV(self, agents, sample_size, total_periods, type):
-        if type == 'normal':
-            filepath = './SavedStats/normal_agent.csv'
-        elif type == 'social':
-            filepath = './SavedStats/social_agent.csv'
-        elif type == 'benchmark':
-            filepath = './SavedStats/benchmark_agent.csv'
-
-        # Grab a sample of agents
-        sample_pool = rand.sample(agents, sample_size)
-        sample_pool = sorted(sample_pool, key=lambda x: x.Id, reverse=False)
-
-        cols = ['Period', 'AgentId', 'Budget', 'SelectedDeliveryPlan', 'UtilityIfGreen', 'UtilityIfNormal',
-                'UtilityDisparity', 'Emissions', 'EcoCon']
-        df = pd.DataFrame(columns=cols)
-
-        for i, agent in enumerate(sample_pool):
-            agent_df = pd.DataFrame(columns=cols)
-            periods = [j for j in range(total_periods)]
-            ids = [i for x in range(total_periods)]
-
-            budgets_items = sorted([kv for kv in agent.BudgetHistory.items()], key=lambda x: x[0])
-            budgets = [kv[1] for kv in budgets_items]
-
-            utility_if_green_items = sorted([kv for kv in agent.GreenUtility.items()], key=lambda x: x[0])
-            utility_if_green = [kv[1] for kv in utility_if_green_items]
-            utility_if_normal_items = sorted([kv for kv in agent.NormalUtility.items()], key=lambda x: x[0])
-            utility_if_normal = [kv[1] for kv in utility_if_normal_items]
-            utility_disparity_items = sorted([kv for kv in agent.UtilityDisparity.items()], key=lambda x: x[0])
-            utility_disparity = [kv[1] for kv in utility_disparity_items]
-
-            emissions_items = sorted([kv for kv in agent.Erecords.items()], key=lambda x: x[0])
-            emissions = [kv[1] for kv in emissions_items]
-            plan_items = sorted([kv for kv in agent.PlanRecords.items()], key=lambda x: x[0])
-            plan = [kv[1] for kv in plan_items]
-
-            eco_con = [agent.EcoCon for i in periods]
-
-            agent_df['Period'] = periods
-            agent_df['AgentId'] = ids
-            agent_df['Budget'] = budgets
-            agent_df['SelectedDeliveryPlan'] = plan
-            agent_df['UtilityIfGreen'] = utility_if_green
-            agent_df['UtilityIfNormal'] = utility_if_normal
-            agent_df['UtilityDisparity'] = utility_disparity
-            agent_df['Emissions'] = emissions
-            agent_df['EcoCon'] = eco_con
-
-            df = pd.concat([df, agent_df], join='inner')
-
-        df.to_csv(filepath, index=False)
-
-    def AddSimulationToCSV(self, agents, total_periods, type):
+
+    def FilePath(self, type, level):
         """
-        Save simulation statistics to CSV
+        :param type:  simulation type, 'normal', 'social' or 'benchmark'
+        :param level: 'simulation' for economy level stats, 'agent' for agent level stats
+        :return: path of the csv file under ./SavedStats, or of the dataset directory for the columnar formats
+        """
+        if type not in ('normal', 'social', 'benchmark'):
+            raise ValueError(f"Unknown simulation type {type}")
+        if self.OutputFormat != 'csv':
+            return f'./SavedStats/{type}_{level}'
+        return f'./SavedStats/{type}_{level}.csv'
 
-        :param agents:
-        :param total_periods:
-        :param type:
-        :return:
+    def AddAgentSampleToCSV(self, population, sample_size, total_periods, type, chunk_agents=AGENT_CHUNK_SIZE):
+        """
+        Save an agent sample to CSV, chunk_agents agents at a time, so that samples of the whole population can be saved
+        without building them in memory.
         """
-        if type == 'normal':
-            filepath = './SavedStats/normal_simulation.csv'
-        elif type == 'social':
-            filepath = './SavedStats/social_simulation.csv'
-        elif type == 'benchmark':
-            filepath = './SavedStats/benchmark_simulation.csv'
+        sample_index = self.AgentSampleIndex(len(population.Id), sample_size)
+        self.SaveAgentSample(self.AgentSampleChunks(population, sample_index, total_periods, chunk_agents), type)
 
-        file_exists = os.path.exists(filepath)
+    @instrumented('output.agent')
+    def SaveAgentSample(self, df, type):
+        """
+        Save an agent sample from AgentSample, the chunks from AgentSampleChunks or an AgentSampleSpool, replacing the
+        previous sample. The columnar formats keep one sample per price of green delivery.
+        """
+        if isinstance(df, AgentSampleSpool):
+            chunks = df.Chunks()
+        else:
+            chunks = [df] if isinstance(df, pd.DataFrame) else df
 
-        total_emissions = []
-        total_utilities = []
-        total_green = []
-        total_normal = []
-        total_green_q = []
-        total_normal_q = []
-        total_q = []
+        if self.OutputFormat != 'csv':
+            partition = partition_path(self.FilePath(type, 'agent'), self.cG)
+            for filepath in dataset_files(self.FilePath(type, 'agent'), [self.cG]):
+                os.remove(filepath)
+            for i, chunk in enumerate(chunks):
+                write_frame(chunk, os.path.join(partition, f'part-{i:06d}'), self.OutputFormat)
+            return
 
-        for period in range(total_periods):
+        for i, chunk in enumerate(chunks):
+            chunk.to_csv(self.FilePath(type, 'agent'), mode='w' if i == 0 else 'a', header=i == 0, index=False)
 
-            incomes_list = [agent.BudgetHistory[period] for agent in agents]
-            average_income = sum(incomes_list) / len(incomes_list)
+    def AgentSampleIndex(self, num_agents, sample_size):
+        """
+        Indices of a random sample of agents, in order. Samples of at least num_agents are the whole population.
 
-            green_emissions = sum(
-                [agent.Qrecords[period] * self.eG for agent in agents if agent.PlanRecords[period] == 'Green'])
-            normal_emissions = sum(
-                [agent.Qrecords[period] * self.eN for agent in agents if agent.PlanRecords[period] == 'Normal'])
-            period_emissions = float(green_emissions + normal_emissions) / 1000 # divide 1000 for tons instead of kg of CO2
+        :param num_agents:  number of agents in the population
+        :param sample_size: number of agents to sample, or None for the whole population
+        :return: array of agent indices
+        """
+        if sample_size is None or sample_size >= num_agents:
+            return np.arange(num_agents)
+        return np.sort(self.Rng.choice(num_agents, sample_size, replace=False))
 
-            green_utilities = sum(
-                [agent.GreenUtility[period] for agent in agents if agent.PlanRecords[period] == 'Green'])
-            normal_utilities = sum(
-                [agent.NormalUtility[period] for agent in agents if agent.PlanRecords[period] == 'Normal'])
-            period_utilities = float(green_utilities + normal_utilities)
+    @instrumented('aggregate.agent')
+    def AgentSample(self, population, sample_size, total_periods, sample_index=None):
+        """
+        Agent level statistics of a random sample of agents, one row per agent per period.
 
-            period_green = sum([1 for agent in agents if agent.PlanRecords[period] == 'Green'])
-            period_normal = sum([1 for agent in agents if agent.PlanRecords[period] == 'Normal'])
+        :param population:    Population of the simulation
+        :param sample_size:   number of agents to sample, or None for the whole population
+        :param total_periods: number of periods
+        :param sample_index:  If given, the agent indices of the sample, which is then not drawn
+        :return: Pandas dataframe
+        """
+        if sample_index is None:
+            sample_index = self.AgentSampleIndex(len(population.Id), sample_size)
+        return next(self.AgentSampleChunks(population, sample_index, total_periods, max(len(sample_index), 1)))
 
-            green_q = sum([agent.Qrecords[period] for agent in agents if agent.PlanRecords[period] == 'Green'])
-            normal_q = sum([agent.Qrecords[period] for agent in agents if agent.PlanRecords[period] == 'Normal'])
-            period_q = float(green_q + normal_q)
+    def AgentSampleChunks(self, population, sample_index, total_periods, chunk_agents=AGENT_CHUNK_SIZE):
+        """
+        Agent level statistics of the agents in sample_index, as dataframes of chunk_agents agents each. Each column of
+        a chunk is gathered from the History arrays in one step. AgentId numbers the sampled agents from 0.
+
+        :param population:    Population of the simulation
+        :param sample_index:  agent indices from AgentSampleIndex
+        :param total_periods: number of periods
+        :param chunk_agents:  number of agents per dataframe
+        :return: generator of Pandas dataframes
+        """
+        history = population.History
+
+        for start in range(0, max(len(sample_index), 1), chunk_agents):
+            index = sample_index[start:start + chunk_agents]
+
+            def column(record):
+                # (periods x agents) -> one row per agent per period, ordered by agent then period
+                return record[:total_periods, index].T.ravel()
+
+            yield pd.DataFrame({
+                'Period': np.tile(np.arange(total_periods), len(index)),
+                'AgentId': np.repeat(np.arange(start, start + len(index)), total_periods),
+                'Budget': column(history.BudgetHistory),
+                'SelectedDeliveryPlan': PLAN_NAMES[column(history.PlanRecords)],
+                'UtilityIfGreen': column(history.GreenUtility),
+                'UtilityIfNormal': column(history.NormalUtility),
+                'UtilityDisparity': column(history.UtilityDisparity),
+                'Emissions': column(history.Erecords),
+                'EcoCon': np.repeat(population.EcoCon[index], total_periods)
+            })
+
+    @instrumented('aggregate.agent')
+    def SpoolAgentSample(self, population, sample_index, total_periods, chunk_agents=AGENT_CHUNK_SIZE):
+        """
+        Writes the chunks of an agent sample from AgentSampleChunks to a new AgentSampleSpool under AGENT_SPOOL_DIR, so
+        that the sample can be saved later without being built in memory.
+
+        :return: AgentSampleSpool
+        """
+        spool = AgentSampleSpool(os.path.join(AGENT_SPOOL_DIR, uuid.uuid4().hex), 0)
+        for chunk in self.AgentSampleChunks(population, sample_index, total_periods, chunk_agents):
+            write_pickle(spool.ChunkPath(spool.NumChunks), chunk)
+            spool.NumChunks += 1
+        return spool
+
+    def AddSimulationToCSV(self, history, total_periods, type):
+        """
+        Save simulation statistics to CSV
+
+        :param history:
+        :param total_periods:
+        :param type:
+        :return:
+        """
+        self.SaveSimulationStats(self.SimulationStats(history, total_periods), type)
+
+    def PeriodTotals(self, history, total_periods):
+        """
+        Totals over all agents for each period, by selected plan. Every total is computed in one pass over the History
+        (see History.totals_by_plan). The totals are cached until ClearTotals, and recomputed once the History is
+        reallocated for another run.
 
-            total_emissions.append(period_emissions)
-            total_utilities.append(period_utilities)
-            total_green.append(period_green)
-            total_normal.append(period_normal)
+        :param history:       History of the simulation
+        :param total_periods: number of periods
+        :return: dict of arrays with one entry per period
+        """
+        key = (history, history.Version, total_periods)
+        if self.TotalsKey == key:
+            return self.Totals
+
+        users, q, green_utility, normal_utility = totals_by_plan(
+            history.PlanRecords[:total_periods], history.Qrecords[:total_periods],
+            history.GreenUtility[:total_periods], history.NormalUtility[:total_periods])
+
+        self.Totals = {
+            'GreenUsers': users[:, PLAN_GREEN],
+            'NormalUsers': users[:, PLAN_NORMAL],
+            'QwithGreen': q[:, PLAN_GREEN],
+            'QwithNormal': q[:, PLAN_NORMAL],
+            'TotalQ': q[:, PLAN_GREEN] + q[:, PLAN_NORMAL],
+            'TotalEmission': q[:, PLAN_GREEN] * self.eG + q[:, PLAN_NORMAL] * self.eN,
+            'TotalUtility': green_utility[:, PLAN_GREEN] + normal_utility[:, PLAN_NORMAL],
+            'AverageIncome': history.BudgetHistory[:total_periods].mean(axis=1)
+        }
+        self.TotalsKey = key
+        return self.Totals
 
-            total_green_q.append(green_q)
-            total_normal_q.append(normal_q)
-            total_q.append(period_q)
+    def ClearTotals(self):
+        """
+        Forgets the cached totals of PeriodTotals, so that the History they were computed from is not kept alive once
+        its run is finished.
+        """
+        self.Totals = None
+        self.TotalsKey = None
+
+    @instrumented('aggregate.simulation')
+    def SimulationStats(self, history, total_periods, totals=None):
+        """
+        Economy level statistics of a simulation, one row per period.
+
+        :param history:
+        :param total_periods:
+        :param totals:        If given, the totals of each period (see PeriodTotals and Observers.PeriodStats), which
+                              are then not computed from the History
+        :return: Pandas dataframe
+        """
+        if totals is None:
+            totals = self.PeriodTotals(history, total_periods)
 
         df_dict = {
             'SimulationIndex': [0 for i in range(total_periods)],
             'PriceOfGreenDelivery': [self.cG for i in range(total_periods)],
             'PriceOfNormalDelivery': [self.cN for i in range(total_periods)],
             'Period': [i for i in range(total_periods)],
-            'AverageIncome': average_income,
-            'GreenUsers': total_green,
-            'NormalUsers': total_normal,
-            'TotalEmission': total_emissions,
-            'TotalUtility': total_utilities,
-            'QwithGreen': total_green_q,
-            'QwithNormal': total_normal_q,
-            'TotalQ': total_q
+            'AverageIncome': totals['AverageIncome'][-1] if total_periods > 0 else np.nan,
+            'GreenUsers': totals['GreenUsers'],
+            'NormalUsers': totals['NormalUsers'],
+            'TotalEmission': totals['TotalEmission'] / 1000,  # divide 1000 for tons instead of kg of CO2
+            'TotalUtility': totals['TotalUtility'],
+            'QwithGreen': totals['QwithGreen'],
+            'QwithNormal': totals['QwithNormal'],
+            'TotalQ': totals['TotalQ']
         }
-        df = pd.DataFrame(df_dict)
+        return pd.DataFrame(df_dict)
 
-        if file_exists:
-            existing_df = pd.read_csv(filepath)
-
-            prev_sim_index = max(existing_df['SimulationIndex'])  # previous simulation index
-
-            simulation_index = [prev_sim_index + 1 for i in range(total_periods)]
-            df['SimulationIndex'] = simulation_index
-            save_df = pd.concat([existing_df, df], join='inner')
-
-            save_df.to_csv(filepath, index= False)
-
-        else:
-            # add a column for the simulation number
-            df['SimulationIndex'] = [0 for i in range(total_periods)]
-            df.to_csv(filepath, index = False)
+    @instrumented('output.simulation')
+    def SaveSimulationStats(self, df, type):
+        """
+        Append simulation statistics from SimulationStats, under the next simulation index.
+        """
+        self.ResultSink.AppendSimulation(df, type)
 
     # print num green delivery, normal delivery, total emissions
-    def ReportStatsForPeriod(self, agents, period):
+    def ReportStatsForPeriod(self, history, period):
         """
         Report stats for a period (print df in terminal)
 
-        :param agents:
+        :param history:
         :param period:
         :return:
         """
-        green_emissions = sum(
-            [agent.Qrecords[period] * self.eG for agent in agents if agent.PlanRecords[period] == 'Green'])
-        normal_emissions = sum(
-            [agent.Qrecords[period] * self.eN for agent in agents if agent.PlanRecords[period] == 'Normal'])
-        total_emissions = float(green_emissions + normal_emissions)
-
-        green_utilities = sum(
-            [agent.GreenUtility[period] for agent in agents if agent.PlanRecords[period] == 'Green'])
-        normal_utilities = sum(
-            [agent.NormalUtility[period] for agent in agents if agent.PlanRecords[period] == 'Normal'])
-        total_utilities = float(green_utilities + normal_utilities)
-
-        total_green = sum([1 for agent in agents if agent.PlanRecords[period] == 'Green'])
-        total_normal = sum([1 for agent in agents if agent.PlanRecords[period] == 'Normal'])
+        # the periods after period may not be recorded yet, so that totals cached for them would be stale
+        totals = self.PeriodTotals(history, period + 1)
         df_dict = {
-            'TotalEmission': total_emissions,
-            'TotalUtility': total_utilities,
-            'GreenUsers': total_green,
-            'NormalUsers': total_normal
+            'TotalEmission': totals['TotalEmission'][period],
+            'TotalUtility': totals['TotalUtility'][period],
+            'GreenUsers': totals['GreenUsers'][period],
+            'NormalUsers': totals['NormalUsers'][period]
         }
         df = pd.DataFrame(df_dict, index=[0])
-        print(df)
+        log_message(df)
 
-    def ReportAllStats(self, agents, total_periods):
+    def ReportAllStats(self, history, total_periods, totals=None):
         """
         Report stats for all periods (print df in terminal)
 
-        :param agents:
+        :param history:
         :param total_periods:
+        :param totals:        If given, the totals of each period, see SimulationStats
         :return:
         """
-        total_emissions = []
-        total_utilities = []
-        total_green = []
-        total_normal = []
-
-        for period in range(total_periods):
-            green_emissions = sum(
-                [agent.Qrecords[period] * self.eG for agent in agents if agent.PlanRecords[period] == 'Green'])
-            normal_emissions = sum(
-                [agent.Qrecords[period] * self.eN for agent in agents if agent.PlanRecords[period] == 'Normal'])
-            period_emissions = float(green_emissions + normal_emissions)
-
-            green_utilities = sum(
-                [agent.GreenUtility[period] for agent in agents if agent.PlanRecords[period] == 'Green'])
-            normal_utilities = sum(
-                [agent.NormalUtility[period] for agent in agents if agent.PlanRecords[period] == 'Normal'])
-            period_utilities = float(green_utilities + normal_utilities)
-
-            period_green = sum([1 for agent in agents if agent.PlanRecords[period] == 'Green'])
-            period_normal = sum([1 for agent in agents if agent.PlanRecords[period] == 'Normal'])
-
-            total_emissions.append(period_emissions)
-            total_utilities.append(period_utilities)
-            total_green.append(period_green)
-            total_normal.append(period_normal)
-
+        if totals is None:
+            totals = self.PeriodTotals(history, total_periods)
         df_dict = {
             'Period': [i for i in range(total_periods)],
-            'TotalEmission': total_emissions,
-            'TotalUtility': total_utilities,
-            'GreenUsers': total_green,
-            'NormalUsers': total_normal
+            'TotalEmission': totals['TotalEmission'],
+            'TotalUtility': totals['TotalUtility'],
+            'GreenUsers': totals['GreenUsers'],
+            'NormalUsers': totals['NormalUsers']
         }
         df = pd.DataFrame(df_dict)
         df.set_index('Period', inplace=True)
-        print(df)
+        log_message(df)
@@ -0,0 +1,346 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark.py:
+
+This file times the stages of a simulation: importing the Engine in a new process (a cold start), agent generation,
+solving the utility functions, each simulation type, the simulation types side by side (RunAll), the aggregation of the
+statistics and their output, for several numbers of agents and periods. Each stage reports its best time over a number
+of repeats, after an untimed call which loads the compiled kernels and warms up caches, its throughput in agent-periods
+per second and its peak memory (as traced by tracemalloc, in a separate pass so that tracing does not slow the timed
+repeats).
+
+Results are saved as JSON, and can be compared with the results of an earlier benchmark, the baseline, to find stages
+that have become slower:
+
+    python Benchmark.py --agents 1000 10000 100000 --periods 24 --output benchmark.json --baseline baseline.json
+
+which exits with status 1 if any stage is slower than its baseline by more than the tolerance.
+"""
+
+import argparse
+import contextlib
+import datetime as dt
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import UtilityHandler as utility_handler_module
+from Engine import *
+from RandomNumbers import *
+
+# Engine settings of each benchmark configuration
+CONFIGURATIONS = {
+    'loop': dict(vectorized=False),
+    'vectorized': dict(vectorized=True),
+    'closed_form': dict(vectorized=True, closed_form=True),
+    'jit': dict(vectorized=True, jit=True),
+    'incremental': dict(vectorized=True, jit=True, incremental=True)
+}
+
+SIMULATION_TYPES = ('benchmark', 'normal', 'social')
+
+
+def engine_config(num_agents, configuration, seed=0):
+    """
+    Engine keyword arguments with the parameters of main.py.
+
+    :param num_agents:    number of agents
+    :param configuration: name of the Engine settings in CONFIGURATIONS
+    :param seed:          seed of the Engine
+    """
+    alpha_a, alpha_b = find_beta_shape_params(mean=0.2, stdev=0.04)
+    mu_a, mu_b = find_beta_shape_params(mean=0.05, stdev=0.025)
+
+    return dict(num_agents=num_agents, price=65, a_params=[alpha_a, alpha_b], mu_params=[mu_a, mu_b],
+                income_interval=[np.log(22100 / 12), 0.4219793], cG=14, cN=8, eG=0.9, eN=1, inflation_rate=0.017,
+                delta_interval=[0.01, 0.1], friend_interval=[1, 10], seed=seed, **CONFIGURATIONS[configuration])
+
+
+def measure(function, repeats=3, memory=True, setup=None):
+    """
+    Times function over a number of repeats after an untimed call, and traces its peak memory in one more call.
+
+    :param function: function to time, called with the result of setup
+    :param repeats:  number of timed calls
+    :param memory:   If False, peak memory is not traced
+    :param setup:    If given, called before each call of function, untimed
+    :return: dict of the best and mean seconds of the calls, and the peak memory in MB (or None)
+    """
+    function(setup() if setup is not None else None)
+
+    times = []
+    for i in range(repeats):
+        argument = setup() if setup is not None else None
+        tic = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - tic)
+
+    peak_memory = None
+    if memory:
+        argument = setup() if setup is not None else None
+        tracemalloc.start()
+        try:
+            function(argument)
+            peak_memory = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+
+    return {'seconds': min(times), 'mean_seconds': sum(times) / len(times), 'peak_memory_mb': peak_memory}
+
+
+def record(configuration, stage, num_agents, periods, measurement, throughput=True):
+    """
+    A benchmark result. Stages that go through every agent in every period also report their throughput in
+    agent-periods per second.
+    """
+    agent_periods = num_agents * periods if throughput and num_agents is not None and periods is not None else None
+    return dict(configuration=configuration, stage=stage, num_agents=num_agents, periods=periods, **measurement,
+                agent_periods_per_second=agent_periods / measurement['seconds'] if agent_periods else None)
+
+
+def benchmark_import(repeats=3):
+    """
+    Times importing the Engine in a new Python process, as at the start of main.py or of a worker process.
+
+    :return: list of benchmark results
+    """
+    code = 'import time; tic = time.perf_counter(); import Engine; print(time.perf_counter() - tic)'
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    times = [float(subprocess.run([sys.executable, '-c', code], cwd=directory, capture_output=True, text=True,
+                                  check=True).stdout)
+             for i in range(repeats + 1)][1:]  # the first import also compiles the modules' bytecode
+
+    measurement = {'seconds': min(times), 'mean_seconds': sum(times) / len(times), 'peak_memory_mb': None}
+    return [record('startup', 'import', None, None, measurement)]
+
+
+def benchmark_solve(configuration, repeats=3, memory=True):
+    """
+    Times SolveNormal and SolveSocial from an empty solution cache.
+
+    :return: list of benchmark results
+    """
+    settings = CONFIGURATIONS[configuration]
+    closed_form = settings.get('closed_form', False) or settings.get('jit', False)
+
+    def setup():
+        utility_handler_module.SOLUTION_CACHE.clear()
+        return UtilityHandler(closed_form=closed_form)
+
+    return [record(configuration, 'solve_normal', None, None,
+                   measure(lambda utility_handler: utility_handler.SolveNormal(), repeats, memory, setup)),
+            record(configuration, 'solve_social', None, None,
+                   measure(lambda utility_handler: utility_handler.SolveSocial(), repeats, memory, setup))]
+
+
+def benchmark_engine(configuration, num_agents, periods, repeats=3, memory=True, seed=0):
+    """
+    Times agent generation, each simulation type, RunAll, and the aggregation and output of the normal simulation's
+    statistics. Every run starts from a Fork of the same agents. The run stages include the aggregation of their
+    statistics, without saving them.
+
+    :return: list of benchmark results
+    """
+    config = engine_config(num_agents, configuration, seed)
+    results = [record(configuration, 'generate', num_agents, None,
+                      measure(lambda argument: Engine(**config), repeats, memory))]
+
+    engine = Engine(**config)
+    engine.UtilityHandler.SolveNormal()  # the solutions are cached, so that runs do not time solving
+    engine.UtilityHandler.SolveSocial()
+
+    for simulation_type in SIMULATION_TYPES:
+        measurement = measure(lambda fork: fork.Run(simulation_type, periods, save=False), repeats, memory, engine.Fork)
+        results.append(record(configuration, f'run_{simulation_type}', num_agents, periods, measurement))
+
+    measurement = measure(lambda fork: fork.RunAll(periods, save=False), repeats, memory, engine.Fork)
+    results.append(record(configuration, 'run_all', num_agents, periods, measurement))
+
+    engine.Run('normal', periods, save=False)
+    aggregation_manager = engine.AggregationManager
+
+    def aggregate(argument):
+        aggregation_manager.TotalsKey = None  # the totals are cached otherwise
+        simulation_stats = aggregation_manager.SimulationStats(engine.History, periods)
+        agent_sample = aggregation_manager.AgentSample(engine.Population, engine.AgentSampleSize, periods)
+        return simulation_stats, agent_sample
+
+    results.append(record(configuration, 'aggregate', num_agents, periods, measure(aggregate, repeats, memory)))
+
+    simulation_stats, agent_sample = aggregate(None)
+    with tempfile.TemporaryDirectory() as directory, working_directory(directory):
+        def output(argument):
+            aggregation_manager.SaveSimulationStats(simulation_stats.copy(), 'normal')
+            aggregation_manager.SaveAgentSample(agent_sample, 'normal')
+
+        results.append(record(configuration, 'output', num_agents, periods, measure(output, repeats, memory),
+                              throughput=False))
+
+    return results
+
+
+@contextlib.contextmanager
+def working_directory(directory):
+    previous = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def run_benchmarks(agent_counts=(1000, 10000, 100000), periods=(24,), configurations=('vectorized', 'jit'),
+                   repeats=3, memory=True, seed=0, verbose=True):
+    """
+    Runs the benchmarks of every configuration, number of agents and number of periods, in quiet mode (see
+    Instrumentation.py), so that the times do not include the Engine's progress messages and reports.
+
+    :param agent_counts:   numbers of agents
+    :param periods:        numbers of periods
+    :param configurations: names of Engine settings in CONFIGURATIONS
+    :param repeats:        number of timed calls of each stage
+    :param memory:         If False, peak memory is not traced
+    :param seed:           seed of the Engines
+    :param verbose:        If True, each result is printed as it is measured
+    :return: dict of the environment and the list of benchmark results
+    """
+    results = []
+
+    def add(new_results):
+        for result in new_results:
+            results.append(result)
+            if verbose:
+                print(format_result(result))
+
+    for configuration in configurations:
+        if configuration not in CONFIGURATIONS:
+            raise ValueError(f"Unknown benchmark configuration {configuration}")
+
+    quiet = Instrumentation.Quiet
+    set_quiet()
+    try:
+        add(benchmark_import(repeats))
+
+        for configuration in configurations:
+            add(benchmark_solve(configuration, repeats, memory))
+
+            for num_agents in agent_counts:
+                for num_periods in periods:
+                    add(benchmark_engine(configuration, num_agents, num_periods, repeats, memory, seed))
+    finally:
+        set_quiet(quiet)
+
+    return {'environment': environment(), 'results': results}
+
+
+def environment():
+    """
+    The versions and machine the benchmarks ran on.
+    """
+    return {
+        'date': dt.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'numba': kernels_available(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count()
+    }
+
+
+def format_result(result):
+    agents = '' if result['num_agents'] is None else f" {result['num_agents']} agents"
+    periods = '' if result['periods'] is None else f" x {result['periods']} periods"
+    line = f"{result['configuration']} {result['stage']}{agents}{periods}: {result['seconds']:0.4f} seconds"
+    if result['agent_periods_per_second'] is not None:
+        line += f", {result['agent_periods_per_second']:,.0f} agent-periods/second"
+    if result['peak_memory_mb'] is not None:
+        line += f", peak memory {result['peak_memory_mb']:0.1f} MB"
+    return line
+
+
+def save_results(benchmark, path):
+    with open(path, 'w') as f:
+        json.dump(benchmark, f, indent=2)
+
+
+def load_results(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def result_key(result):
+    return result['configuration'], result['stage'], result['num_agents'], result['periods']
+
+
+def compare_results(benchmark, baseline, tolerance=0.25, min_difference=0.005):
+    """
+    The stages which are slower than in the baseline by more than the tolerance. Stages missing from either are
+    skipped.
+
+    :param benchmark:      results from run_benchmarks
+    :param baseline:       results of an earlier run_benchmarks
+    :param tolerance:      largest allowed relative increase of the best time
+    :param min_difference: smallest increase of the best time, in seconds, that counts as slower, so that the timing
+                           noise of very short stages is not reported
+    :return: list of dicts of the stage, its baseline and current seconds, and their ratio
+    """
+    baseline_seconds = {result_key(result): result['seconds'] for result in baseline['results']}
+
+    regressions = []
+    for result in benchmark['results']:
+        key = result_key(result)
+        if key not in baseline_seconds:
+            continue
+
+        difference = result['seconds'] - baseline_seconds[key]
+        if difference > baseline_seconds[key] * tolerance and difference > min_difference:
+            regressions.append(dict(zip(('configuration', 'stage', 'num_agents', 'periods'), key),
+                                    baseline_seconds=baseline_seconds[key], seconds=result['seconds'],
+                                    ratio=result['seconds'] / max(baseline_seconds[key], 1e-12)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times the stages of a simulation")
+    parser.add_argument('--agents', type=int, nargs='+', default=[1000, 10000, 100000], help="numbers of agents")
+    parser.add_argument('--periods', type=int, nargs='+', default=[24], help="numbers of periods")
+    parser.add_argument('--configurations', nargs='+', default=['vectorized', 'jit'], choices=list(CONFIGURATIONS),
+                        help="Engine settings to benchmark")
+    parser.add_argument('--repeats', type=int, default=3, help="timed calls of each stage")
+    parser.add_argument('--no-memory', action='store_true', help="do not trace peak memory")
+    parser.add_argument('--output', help="JSON file to save the results to")
+    parser.add_argument('--baseline', help="JSON file of earlier results to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="largest allowed relative slowdown from the baseline")
+    parser.add_argument('--min-difference', type=float, default=0.005,
+                        help="smallest slowdown from the baseline that is reported, in seconds")
+    args = parser.parse_args()
+
+    benchmark = run_benchmarks(args.agents, args.periods, args.configurations, args.repeats, not args.no_memory)
+    if args.output:
+        save_results(benchmark, args.output)
+
+    if args.baseline:
+        regressions = compare_results(benchmark, load_results(args.baseline), args.tolerance,
+                                       args.min_difference)
+        for regression in regressions:
+            print(f"Slower than baseline: {regression['configuration']} {regression['stage']} "
+                  f"({regression['num_agents']} agents, {regression['periods']} periods): "
+                  f"{regression['baseline_seconds']:0.4f} -> {regression['seconds']:0.4f} seconds "
+                  f"({regression['ratio']:0.2f}x)")
+        if regressions:
+            raise SystemExit(1)
+        print("No stage is slower than the baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checkpoint.py:
+
+This file stores the Checkpointer class, which saves the state of a run every few periods, so that a run which was
+interrupted continues from its last checkpoint rather than from its first period (see Engine.RunAll), and the
+checkpoints of the completed tasks of a sweep (see Sweep.py).
+
+The checkpoints of a run are pickle files of numpy arrays, checkpoint-{period}.pkl, in the run's directory. Each holds
+the state after its period and the records of the periods since the previous checkpoint (History rows, or the rows of
+the statistics and agent sample recorded without a History), so that the files stay small however long the run. They are
+written by a background thread from copies of the state, so that the simulation does not wait for the disk, and every
+file is written to a temporary file which is then renamed, so that an interrupted write never leaves a partial
+checkpoint.
+"""
+
+import glob
+import os
+import pickle
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Checkpointer:
+
+    def __init__(self, directory, interval=1):
+        """
+        :param directory: directory of the run's checkpoints
+        :param interval:  number of periods between checkpoints
+        """
+        self.Directory = directory
+        self.Interval = interval
+        self.Executor = None
+        self.Pending = None
+
+    def Due(self, period, num_periods):
+        """
+        Whether a checkpoint is saved after period: every Interval periods, except after the last period, when the run
+        is complete.
+        """
+        return (period + 1) % self.Interval == 0 and period + 1 < num_periods
+
+    def Save(self, period, checkpoint):
+        """
+        Writes the checkpoint of a period in the background, once the previous checkpoint is written. The checkpoint
+        must not be modified afterwards.
+        """
+        self.Wait()
+        if self.Executor is None:
+            self.Executor = ThreadPoolExecutor(1)
+        self.Pending = self.Executor.submit(write_pickle, os.path.join(self.Directory, f'checkpoint-{period:06d}.pkl'),
+                                           checkpoint)
+
+    def Wait(self):
+        if self.Pending is not None:
+            self.Pending.result()
+            self.Pending = None
+
+    def Load(self):
+        """
+        :return: list of the saved checkpoints, in order of period
+        """
+        return [read_pickle(filepath)
+                for filepath in sorted(glob.glob(os.path.join(glob.escape(self.Directory), 'checkpoint-*.pkl')))]
+
+    def Remove(self):
+        """
+        Removes the checkpoints of a completed run.
+        """
+        self.Wait()
+        if self.Executor is not None:
+            self.Executor.shutdown()
+            self.Executor = None
+        shutil.rmtree(self.Directory, ignore_errors=True)
+
+
+def write_atomically(filepath, write, mode='wb'):
+    """
+    Writes a file to a temporary file which is then renamed, so that an interrupted write leaves no partial file and
+    parallel processes never read a partially written file.
+
+    :param write: function writing the content to an open file
+    :param mode:  mode of the open file, 'wb' or 'w'
+    """
+    os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+
+    tmp_path = f"{filepath}.{os.getpid()}.tmp"
+    with open(tmp_path, mode) as f:
+        write(f)
+    os.replace(tmp_path, filepath)
+
+
+def write_pickle(filepath, value):
+    write_atomically(filepath, lambda f: pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def read_pickle(filepath):
+    with open(filepath, 'rb') as f:
+        return pickle.load(f)
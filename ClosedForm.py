@@ -0,0 +1,141 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ClosedForm.py:
+
+This file stores the closed-form solution of the agents' utility maximisation, which UtilityHandler uses instead of the
+symbolic solution when closed_form is set.
+
+The agents maximise a ln(Q) + b ln(S) - a ln(k Q + 1), with k = mu e, subject to P Q + S = R, with R = Y - c. The first
+order conditions give S a = b P Q (k Q + 1), and substituting S = R - P Q gives the quadratic
+
+    b P k Q^2 + P (a + b) Q - a R = 0
+
+whose positive root is written in the form that does not cancel when k is small:
+
+    Q* = 2 a R / (P (a + b) + sqrt(P^2 (a + b)^2 + 4 a b P k R))
+    S* = R - P Q*
+
+The social utility adds a delta ln(1 + F), which does not depend on Q or S, so Q* and S* are the same.
+
+Running this file checks the closed form against the symbolic solution, see check_closed_form.
+"""
+
+import numpy as np
+
+
+def optimum(a, b, mu, Y, P, e, c):
+    """
+    The utility, Q and S at the optimum, computed together from the shared subexpressions. Arguments may be scalars
+    or arrays, as for the numerical functions of UtilityHandler.
+
+    :return: (utility, Q, S)
+    """
+    a_plus_b_P = (a + b) * P
+    k = mu * e
+    R = Y - c
+
+    q = 2 * a * R / (a_plus_b_P + np.sqrt(a_plus_b_P * a_plus_b_P + 4 * a * b * P * k * R))
+    s = R - P * q
+    utility = a * (np.log(q) - np.log1p(k * q)) + b * np.log(s)
+    return utility, q, s
+
+
+def optimum_social(a, b, mu, Y, P, e, c, delta, F):
+    """
+    The utility with the social effect of friends' plans, Q and S at the optimum.
+
+    :return: (utility, Q, S)
+    """
+    utility, q, s = optimum(a, b, mu, Y, P, e, c)
+    return utility + a * delta * np.log1p(F), q, s
+
+
+def utility(a, b, mu, Y, P, e, c):
+    return optimum(a, b, mu, Y, P, e, c)[0]
+
+
+def utility_social(a, b, mu, Y, P, e, c, delta, F):
+    return optimum_social(a, b, mu, Y, P, e, c, delta, F)[0]
+
+
+def solved_q(a, b, mu, Y, P, e, c):
+    return optimum(a, b, mu, Y, P, e, c)[1]
+
+
+def solved_s(a, b, mu, Y, P, e, c):
+    return optimum(a, b, mu, Y, P, e, c)[2]
+
+
+def check_closed_form(num_points=100000, num_exact_points=100, seed=0, rtol=1e-6, exact_rtol=1e-12):
+    """
+    Compares the closed form with the symbolic solution of UtilityHandler at random parameters around those of main.py,
+    with eco-consciousness anywhere between the Engine's lower bound of 0.0001 and 1.
+
+    The numerical functions generated from the symbolic solution lose some precision to cancellation, so the closed
+    form is compared with them to rtol, and with the symbolic solution evaluated to 50 significant digits at the first
+    num_exact_points parameter sets to exact_rtol.
+
+    :param num_points:       number of random parameter sets
+    :param num_exact_points: number of parameter sets at which the symbolic solution is evaluated exactly
+    :param seed:             seed of the random parameters
+    :param rtol:             largest relative difference allowed from the generated numerical functions
+    :param exact_rtol:       largest relative difference allowed from the exact symbolic solution
+    :return: dict of the largest relative differences of the utility, Q and S
+    """
+    import mpmath
+    from sympy import lambdify
+    from UtilityHandler import UtilityHandler, NORMAL_ARGS, SOCIAL_ARGS, argument_symbols
+
+    rng = np.random.default_rng(seed)
+    a = rng.uniform(0.01, 0.99, num_points)
+    mu = np.concatenate([rng.uniform(0.0001, 1, num_points - 2), [0.0001, 1]])
+    Y = np.exp(rng.normal(np.log(22100 / 12), 1, num_points))
+    P = rng.uniform(10, 200, num_points)
+    e = rng.uniform(0, 2, num_points)
+    c = rng.uniform(0, 30, num_points) * (Y > 60)
+    delta = rng.uniform(0, 1, num_points)
+    F = rng.uniform(0, 1, num_points)
+
+    normal_args = (a, 1 - a, mu, Y, P, e, c)
+    variants = {
+        'normal': (UtilityHandler.SolveNormal, NORMAL_ARGS, normal_args, optimum(*normal_args)),
+        'social': (UtilityHandler.SolveSocial, SOCIAL_ARGS, normal_args + (delta, F),
+                   optimum_social(*normal_args, delta, F))
+    }
+
+    utility_handler = UtilityHandler()
+    differences = {}
+
+    def compare(name, expected, actual, tolerance):
+        difference = np.max(np.abs(actual - expected) / np.maximum(np.abs(expected), 1))
+        differences[name] = difference
+        if not difference <= tolerance:
+            raise ValueError(f"The closed form {name} differs from the symbolic solution by {difference}")
+
+    for variant, (solve, utility_args, args, closed) in variants.items():
+        solve(utility_handler)
+        utility_function = utility_handler.Solution['Lambdify_Utility']
+        expressions = [(utility_handler.Generic_Utility_Function_QS, utility_args),
+                       (utility_handler.Generic_Solved_Q, NORMAL_ARGS), (utility_handler.Generic_Solved_S, NORMAL_ARGS)]
+
+        generated = (utility_function(*args), utility_handler.Lambdify_Q(*normal_args),
+                     utility_handler.Lambdify_S(*normal_args))
+
+        for name, expected, actual, (expression, expression_args) in zip(('Utility', 'Q', 'S'), generated, closed,
+                                                                         expressions):
+            compare(f'{variant} {name}', expected, actual, rtol)
+
+            exact_function = lambdify(argument_symbols(expression_args), expression, 'mpmath')
+            with mpmath.workdps(50):
+                exact = np.array([float(exact_function(*(mpmath.mpf(float(arg[i])) for arg in
+                                                          args[:len(expression_args)])))
+                                  for i in range(min(num_exact_points, num_points))])
+            compare(f'{variant} {name} exact', exact, actual[:len(exact)], exact_rtol)
+
+    return differences
+
+
+if __name__ == '__main__':
+    for name, difference in check_closed_form().items():
+        print(f"{name}: largest relative difference {difference:.3g}")
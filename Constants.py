@@ -4,6 +4,10 @@ class Constants:
     def FractionOfSavings():
         return 0.01
 
+    @staticmethod
+    def IncrementalTolerance():
+        return 1e-9
+
     @staticmethod
     def PriceHikeInterval():
         return 6
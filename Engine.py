@@ -6,23 +6,38 @@ Engine.py:
 This file stores the Engine class.
 """
 
-from Agent import *  # also imports EnvSymbols, and imports within EnvSymbols
+import time
+
+_import_start = time.perf_counter()
+
+from Agent import *
 from custom_timer import *
 from UtilityHandler import *
 from ErrorLogger import *
 from AggregationManager import *
+from Population import *
+from Observers import *
+from ResultCache import *
+from Checkpoint import *
 
+import copy
 import datetime as dt
-import random as rand
 import math
-from scipy.stats import beta, lognorm, norm
-from tqdm import tqdm
+import os
+
+# seconds taken to import the Engine and the modules it needs, recorded as the span startup.import by main.py (see
+# Benchmark.py for the import time of a cold start)
+IMPORT_SECONDS = time.perf_counter() - _import_start
 
 
 class Engine:
 
     def __init__(self, num_agents, price, a_params, mu_params, income_interval, cG, cN, eG, eN, inflation_rate,
-                 delta_interval=[0, 0], friend_interval=[0, 0]):
+                 delta_interval=[0, 0], friend_interval=[0, 0], vectorized=False,
+                 solution_cache_dir=None, agent_parameters=None, seed=None, output_format='csv',
+                 agent_sample_size=Constants.SampleSize(), closed_form=False, jit=False, keep_history=True,
+                 observers=None, result_cache_dir=None, result_cache_size=None, checkpoint_dir=None, checkpoint_interval=1,
+                 incremental=False):
         """
         The Engine class represents the social system, composed of agents making decisions between e-commerce delivery
         options. The Engine has
@@ -33,21 +48,84 @@ class Engine:
                                 (coefficient of ln(Q))
         :param mu_params:       Min/ max bounds of mu, the eco-consciousness
         :param income_interval: Mean/ stdev of Y, disposable income
-        :param cG:              The price per period of green delivery (say, monthly subscription price)
+        :param cG:              The price per period of green delivery (say, monthly subscription price). A vectorized
+                                Engine also takes a list of prices, which are simulated at once: every run then returns
+                                a list with the results of each price.
         :param cN:              The price per period of normal delivery (monthly subscription price)
         :param eG:              Emissions per unit of green delivery
         :param eN:              Emissions per unit of normal delivery
         :param inflation_rate:  The annual inflation rate of prices.
         :param delta_interval:  Min/ max bounds of delta, affinity towards friends' opinions
         :param friend_interval: Min/ max bounds of number of friends
+        :param vectorized:      If True, each period is evaluated for all agents at once as NumPy arrays (see
+                                Population.py) instead of looping over the Agent objects
+        :param solution_cache_dir: Directory in which the solved utility functions are saved, so that other processes
+                                can skip solving them (see UtilityHandler.py). None keeps them in memory only.
+        :param agent_parameters: Agent parameters from Engine.AgentParameters. If given, the agents are built from them
+                                instead of being generated.
+        :param seed:            Seed of the Engine's random number generator: None, an int, a numpy SeedSequence or a
+                                numpy Generator. Agent generation and agent sampling only draw from this generator.
+        :param output_format:   Format of the saved statistics: 'csv', 'parquet', 'feather' or 'npz' (see
+                                ResultSink.py)
+        :param agent_sample_size: Number of agents in the agent level statistics of each run, by default
+                                Constants.SampleSize(). None, or num_agents or more, gives the whole population (see
+                                AggregationManager.AgentSampleIndex).
+        :param closed_form:     If True, the agents' optimum is computed from its closed form (see ClosedForm.py)
+                                instead of solving the Lagrangian with sympy
+        :param jit:             If True and vectorized is set, each period is evaluated by a compiled kernel (see
+                                Kernels.py), and closed_form is implied. Needs numba; without it, the closed form is
+                                evaluated with NumPy.
+        :param keep_history:    If False, a vectorized Engine only keeps the records of the last two periods, and
+                                computes the statistics and agent sample of each run while it runs (see Observers.py),
+                                so that memory does not grow with the number of periods
+        :param observers:       PeriodObservers called at the end of every period of every run, see AddObserver
+        :param result_cache_dir: Directory in which the results of every run are cached, so that a repeated run from
+                                the same state loads its results instead (see ResultCache.py). None caches nothing.
+        :param result_cache_size: Largest total size of the cached results in bytes, beyond which the least recently
+                                used are evicted. None never evicts.
+        :param checkpoint_dir:  Directory in which a vectorized RunAll saves its state every checkpoint_interval
+                                periods, so that if it is interrupted, running it again from the same state continues
+                                from its last checkpoint (see Checkpoint.py). None saves no checkpoints.
+        :param checkpoint_interval: Number of periods between checkpoints
+        :param incremental:     If True and jit is set, the generic and social rounds only evaluate both plans of the
+                                agents whose choice may change, and the plan they take for the others (see Kernels.py).
+                                The statistics are the same; only the utilities of the plans not taken are first order
+                                estimates. 'check' also evaluates every plan, and raises a ValueError if the choices or
+                                the records of the plans taken differ.
         """
-        print('Initialising engine')
+        log_message('Initialising engine')
+
+        if not keep_history and not vectorized:
+            raise ValueError("Only a vectorized Engine can run without keeping the History")
+        self.KeepHistory = keep_history
+        # incremental rounds are evaluated by the kernels
+        self.Incremental = incremental if vectorized and jit and kernels_available() else False
+        if incremental and not self.Incremental:
+            log_message('Incremental evaluation needs the compiled kernels, every plan is evaluated')
+        self.Observers = list(observers) if observers is not None else []
+        self.RunObservers = {}
+        self.RunRecorders = {}
+        self.ResultCache = ResultCache(result_cache_dir, result_cache_size) if result_cache_dir is not None else None
+        self.CheckpointDir = checkpoint_dir
+        self.CheckpointInterval = checkpoint_interval
+
+        # several prices of green delivery are simulated at once as rows of the agents' state, see Population.Batch
+        self.NumPrices = len(cG) if np.ndim(cG) > 0 else None
+        green_prices = cG  # the statistics record the prices as given
+        if self.NumPrices is not None:
+            if not vectorized:
+                raise ValueError("Several prices of green delivery can only be simulated by a vectorized Engine")
+            cG = np.asarray(cG, dtype=np.float64).reshape(-1, 1)
+
+        self.Rng = np.random.default_rng(seed)
 
         # Managers
-        self.AggregationManager = AggregationManager(eG, eN, cG, cN)
+        self.AggregationManager = AggregationManager(eG, eN, green_prices, cN, self.Rng, output_format)
+        self.AgentSampleSize = agent_sample_size
+        # whether unsaved agent samples of more than AGENT_CHUNK_SIZE agents are spooled to disk, see FinishRun
+        self.SpoolAgentSamples = False
 
         ##document variables
-        self.Agents = [0 for i in range(num_agents)]
         self.Price = price
         self.A_params = a_params
         self.Mu_params = mu_params
@@ -55,7 +133,10 @@ class Engine:
         self.Friend_int = friend_interval
         self.Delta_int = delta_interval
 
-        self.GenerateAgents(num_agents)
+        if agent_parameters is None:
+            self.GenerateAgents(num_agents)
+        else:
+            self.BuildAgents(agent_parameters)
 
         self.cG = cG
         self.cN = cN
@@ -65,61 +146,422 @@ class Engine:
         # inflation
         self.InflationRate = inflation_rate
 
-        self.UtilityHandler = UtilityHandler()
+        self.Vectorized = vectorized
+        self.Jit = vectorized and jit and kernels_available()
+        if jit and not kernels_available():
+            log_message('numba is not installed, periods are evaluated with NumPy')
+
+        # the kernels use the closed form, so the other evaluations do too
+        self.UtilityHandler = UtilityHandler(solution_cache_dir, closed_form or jit)
 
+        # state every run starts from, see ResetEngine and Fork
+        self.InitialState = self.Snapshot()
+
+    @instrumented('generate')
     def GenerateAgents(self, num_agents):
         """
         Initiates n number of Agent objects within the Engine. The agents are initiated with affinity to consume,
-        eco-consciousness
+        eco-consciousness, income, affinity towards friends' opinions and friends, each drawn for all agents at once.
 
         :param num_agents:
         :return:
         """
-        friendList = [j for j in range(num_agents)]
-        for i in range(num_agents):
-            a = beta.rvs(self.A_params[0], self.A_params[1])  # draw from beta distribution
-            b = 1 - a
+        a = self.Rng.beta(self.A_params[0], self.A_params[1], num_agents)  # draw from beta distribution
+
+        mu = self.Rng.beta(self.Mu_params[0], self.Mu_params[1], num_agents)
+        mu[np.round(mu, 5) == 0] = 0.0001
+
+        # income drawn from log-normal distribution, then exponentiated to get normal (level) income.
+        income = np.exp(self.Rng.normal(self.Income_int[0], self.Income_int[1], num_agents))
+
+        delta = self.Rng.uniform(self.Delta_int[0], self.Delta_int[1], num_agents)
+
+        # Assign friends
+        if self.Friend_int[1] > self.Friend_int[0]:
+            num_friends = self.Rng.integers(self.Friend_int[0], self.Friend_int[1], num_agents)
+        else:
+            num_friends = np.full(num_agents, self.Friend_int[0])
+        friend_index = FriendIndex.Sample(self.Rng, num_agents, num_friends)
+
+        self.BuildAgents({
+            'A': a,
+            'B': 1 - a,
+            'EcoCon': mu,
+            'Budget': income,
+            'Delta': delta,
+            'FriendOffsets': friend_index.Offsets,
+            'FriendIds': friend_index.Ids
+        })
+
+    def AgentParameters(self):
+        """
+        The parameters and budgets of the agents as arrays, which are much cheaper to pickle than the Engine itself.
+
+        :return: dict of arrays, to be passed to Engine(agent_parameters=...)
+        """
+        return {
+            'A': self.Population.A.copy(),
+            'B': self.Population.B.copy(),
+            'EcoCon': self.Population.EcoCon.copy(),
+            'Budget': self.Population.Budget.copy(),
+            'Delta': self.Population.Delta.copy(),
+            'FriendOffsets': self.FriendIndex.Offsets,
+            'FriendIds': self.FriendIndex.Ids
+        }
+
+    def Snapshot(self):
+        """
+        The current state of the agents and prices, to be restored with Restore or Fork. Only the agent parameter
+        arrays are copied.
+
+        :return: dict of the AgentParameters arrays, Price, cG and cN
+        """
+        return dict(self.AgentParameters(), Price=self.Price, cG=self.cG, cN=self.cN)
+
+    def Restore(self, snapshot):
+        """
+        Rebuilds the Population and an empty History from a Snapshot, and restores its prices. The snapshot's arrays
+        are copied, so that it can be restored again.
+
+        :param snapshot: dict from Snapshot
+        """
+        self.Price = snapshot['Price']
+        self.cG = snapshot['cG']
+        self.cN = snapshot['cN']
+        if self.NumPrices is None:
+            self.AggregationManager.Reset(self.cG)
+
+        agent_parameters = {name: snapshot[name].copy() for name in ('A', 'B', 'EcoCon', 'Budget', 'Delta')}
+        agent_parameters['FriendOffsets'] = snapshot['FriendOffsets']  # the friendship graph is never modified
+        agent_parameters['FriendIds'] = snapshot['FriendIds']
+        self.BuildAgents(agent_parameters)
+
+    def Fork(self, snapshot=None, seed=None):
+        """
+        A new Engine with the same settings, restored from a Snapshot, so that several simulations can start from the
+        same agents without copying the Engine. The fork shares the solved utility functions.
+
+        :param snapshot: dict from Snapshot. If None, the Engine's initial state.
+        :param seed:     Seed of the fork's random number generator. If None, the fork draws from this Engine's
+                         generator.
+        :return: Engine
+        """
+        engine = copy.copy(self)
+        engine.AggregationManager = copy.copy(self.AggregationManager)
+        engine.Observers = list(self.Observers)
+        engine.RunObservers = {}
+        engine.RunRecorders = {}
+        if seed is not None:
+            engine.Rng = np.random.default_rng(seed)
+            engine.AggregationManager.Rng = engine.Rng
+
+        engine.Restore(self.InitialState if snapshot is None else snapshot)
+        return engine
+
+    def BuildAgents(self, agent_parameters):
+        """
+        Initiates the Population, its History and the Agent views from arrays of agent parameters, see
+        AgentParameters.
+
+        :param agent_parameters: dict of arrays
+        """
+        num_agents = len(agent_parameters['A'])
+
+        budget = agent_parameters['Budget']
+        if self.NumPrices is not None and np.ndim(budget) == 1:
+            budget = np.tile(budget, (self.NumPrices, 1))
+
+        self.FriendIndex = FriendIndex(agent_parameters['FriendOffsets'], agent_parameters['FriendIds'])
+        self.History = History(0, num_agents, self.NumPrices, self.history_depth())
+        self.Population = Population(np.arange(num_agents), agent_parameters['A'], agent_parameters['B'],
+                                     agent_parameters['EcoCon'], budget, self.Price, agent_parameters['Delta'],
+                                     self.FriendIndex, self.History, self.Incremental)
+        self.AgentViews = None
+
+    def history_depth(self):
+        # social rounds read the previous period's plans and savings, so two periods are kept
+        return None if self.KeepHistory else 2
+
+    def AddObserver(self, observer):
+        """
+        Adds an observer, whose OnRunStart and OnPeriodEnd are called in every run (see Observers.py). In RunAll, the
+        periods of the simulation types are interleaved, and observers tell them apart by simulation type.
 
-            mu = beta.rvs(self.Mu_params[0], self.Mu_params[1])
-            if round(mu, 5) == 0:
-                mu = 0.0001
-            income = np.exp(norm.rvs(self.Income_int[0], self.Income_int[1]))
+        :param observer: PeriodObserver
+        """
+        self.Observers.append(observer)
+
+    def start_run(self, simulation_type, population, num_iterations):
+        """
+        Starts the observers of a run. Without a History, the run's statistics and agent sample are recorded by a
+        PeriodStats and an AgentSampleRecorder, whose sample is drawn now, in the order FinishRun would draw it.
+        """
+        observers = []
+        if not self.KeepHistory:
+            sample_index = [self.AggregationManager.AgentSampleIndex(len(population), self.AgentSampleSize)
+                            for i in range(self.NumPrices or 1)]
+            recorders = (PeriodStats(self.eG, self.eN),
+                         AgentSampleRecorder(sample_index if self.NumPrices is not None else sample_index[0]))
+            self.RunRecorders[simulation_type] = recorders
+            observers += recorders
+        observers += self.Observers
+
+        for observer in observers:
+            observer.OnRunStart(simulation_type, population, num_iterations)
+        self.RunObservers[simulation_type] = observers
+
+    def end_period(self, simulation_type, period, population):
+        count_event(f'agent_periods.{simulation_type}', population.Budget.size)
+
+        observers = self.RunObservers.get(simulation_type)
+        if not observers:
+            return
+
+        records = population.History.Rows(period)
+        for observer in observers:
+            observer.OnPeriodEnd(simulation_type, period, records)
+
+    @property
+    def Agents(self):
+        """
+        Agent views of the Population, created when first needed. An Engine simulating several prices at once has
+        the agents of each price instead, see PriceAgents.
+        """
+        if self.NumPrices is not None:
+            raise ValueError("The Engine simulates several prices at once: use PriceAgents(index) for the agents of "
+                             "the index-th price")
+        if self.AgentViews is None:
+            self.AgentViews = [Agent.View(self.Population, i) for i in range(len(self.Population))]
+        return self.AgentViews
+
+    def PriceAgents(self, index):
+        """
+        Agent views of the Population of the index-th price of an Engine simulating several prices at once.
+        """
+        population = self.Population.Batch(index) if self.NumPrices is not None else self.Population
+        return [Agent.View(population, i) for i in range(len(population))]
+
+    def Run(self, simulation_type, num_iterations, save=True):
+        """
+        Runs the simulation of the given type.
+
+        :param simulation_type: 'benchmark', 'normal' or 'social'
+        :param num_iterations:  Number of periods for which simulation is run
+        :param save:            If False, the statistics are returned without being saved to ./SavedStats
+        :return: (simulation statistics, agent sample) dataframes, or a list of them if several prices of green
+                 delivery are simulated
+        """
+        if simulation_type == 'benchmark':
+            return self.RunBenchMark(num_iterations, save)
+        elif simulation_type == 'normal':
+            return self.RunNormal(num_iterations, save)
+        elif simulation_type == 'social':
+            return self.RunSocial(num_iterations, save)
+        raise ValueError(f"Unknown simulation type {simulation_type}")
+
+    @timer
+    @result_cached()
+    def RunAll(self, num_iterations, simulation_types=('benchmark', 'normal', 'social'), save=True):
+        """
+        Runs several simulation types side by side from the current agents, as if each was run on its own Fork. Every
+        simulation type has its own budgets, History and prices, and shares the agents' parameter arrays and solved
+        utility functions. If the Engine is vectorized, every period is evaluated for all simulation types in one loop;
+        otherwise, the simulation types are run one after the other on forks.
+
+        Afterwards, the Engine's Population and History are those of the last simulation type, and its prices are
+        unchanged.
+
+        :param num_iterations:   Number of periods for which simulation is run
+        :param simulation_types: simulation types to run, any of 'benchmark', 'normal' and 'social'
+        :param save:             If False, the statistics are returned without being saved to ./SavedStats
+        :return: dict of the FinishRun results by simulation type
+        """
+        for simulation_type in simulation_types:
+            if simulation_type not in ('benchmark', 'normal', 'social'):
+                raise ValueError(f"Unknown simulation type {simulation_type}")
+
+        snapshot = self.Snapshot()
+        if not self.Vectorized:
+            results = {}
+            for simulation_type in simulation_types:
+                engine = self.Fork(snapshot)
+                engine.ResultCache = None  # RunAll's results are cached as a whole
+                results[simulation_type] = engine.Run(simulation_type, num_iterations, save)
+                self.Population, self.History, self.AgentViews = engine.Population, engine.History, None
+            return results
+
+        log_message(f"\nRunning {', '.join(simulation_types)}")
+
+        # checkpoints are kept by run, so that the same run from the same state finds them
+        checkpointer = None
+        if self.CheckpointDir is not None:
+            run_key = self.RunKey('RunAll', {'num_iterations': num_iterations, 'simulation_types': simulation_types})
+            checkpointer = Checkpointer(os.path.join(self.CheckpointDir, run_key), self.CheckpointInterval)
+
+        # prices before each period. The social simulation's first period is not followed by a price rise, so its
+        # prices lag one period behind from its third period.
+        costs = self.PriceSchedule(num_iterations)
+        social_costs = [costs[0]] + costs[:-1]
+
+        populations = {}
+        utility_handlers = {}
+        for simulation_type in simulation_types:
+            population = self.Population
+            populations[simulation_type] = Population(population.Id, population.A, population.B, population.EcoCon,
+                                                      population.Budget, population.Price, population.Delta,
+                                                      population.FriendIndex,
+                                                      History(num_iterations, len(population), self.NumPrices,
+                                                              self.history_depth()),
+                                                      self.Incremental)
+            utility_handlers[simulation_type] = UtilityHandler(self.UtilityHandler.CacheDir,
+                                                               self.UtilityHandler.ClosedForm)
+            utility_handlers[simulation_type].SolveNormal()
+            self.start_run(simulation_type, populations[simulation_type], num_iterations)
+
+        start = 0
+        if checkpointer is not None:
+            start = self.resume_checkpoint(checkpointer.Load(), populations, utility_handlers)
+
+        for i in range(start, num_iterations):
+            for simulation_type, population in populations.items():
+                if simulation_type == 'social' and num_iterations <= 1:
+                    continue  # as in RunSocial, a social run of one period simulates no period
+                prices = social_costs[i] if simulation_type == 'social' else costs[i]
+                self.run_period(simulation_type, i, population, utility_handlers[simulation_type], *prices)
+
+            if checkpointer is not None and checkpointer.Due(i, num_iterations):
+                checkpointer.Save(i, self.checkpoint(i, start, populations))
+                start = i + 1
+
+        if checkpointer is not None:
+            checkpointer.Remove()
+
+        results = {}
+        for simulation_type, population in populations.items():
+            self.Population, self.History, self.AgentViews = population, population.History, None
+            results[simulation_type] = self.FinishRun(num_iterations, simulation_type, save)
+        return results
+
+    def checkpoint(self, period, first_period, populations):
+        """
+        The state of RunAll after period, with the records of the periods from first_period (those since the previous
+        checkpoint), copied so that the run can go on while it is saved. Records are History rows, and without a
+        History, the rows of the run's PeriodStats and AgentSampleRecorder. See Checkpoint.py.
 
-            # income drawn from log-normal distribution, then exponentiated to get normal (level) income.
+        :param populations: dict of the Population of each simulation type
+        """
+        states = {}
+        for simulation_type, population in populations.items():
+            states[simulation_type] = {
+                'Budget': population.Budget.copy(),
+                'CurrentPlan': population.CurrentPlan.copy(),
+                'CurrentUtility': population.CurrentUtility.copy(),
+                'Incremental': {name: copy.deepcopy(getattr(population, name)) for name in INCREMENTAL_STATE},
+                'Records': population.History.CopyRows(first_period, period)
+            }
+
+        # the recorders' agent samples are drawn by start_run from the state the run started from, as on resuming
+        recorders = {}
+        for simulation_type, (period_stats, agent_sample_recorder) in self.RunRecorders.items():
+            recorders[simulation_type] = {
+                'Totals': {record_period: {name: total[record_period].copy()
+                                           for name, total in period_stats.Totals.items()}
+                           for record_period in range(first_period, period + 1)},
+                'Samples': agent_sample_recorder.History.CopyRows(first_period, period)
+            }
+
+        return {
+            'Period': period,
+            'Populations': states,
+            'Recorders': recorders,
+            'Rng': self.Rng.bit_generator.state
+        }
+
+    def resume_checkpoint(self, checkpoints, populations, utility_handlers):
+        """
+        Restores the state of RunAll from its checkpoints. Observers added with AddObserver are only called for the
+        remaining periods.
 
-            delta = rand.uniform(self.Delta_int[0], self.Delta_int[1])
+        :param checkpoints: list of checkpoints from Checkpointer.Load
+        :return: period from which the run continues
+        """
+        if not checkpoints:
+            return 0
+
+        for simulation_type, population in populations.items():
+            for checkpoint in checkpoints:
+                population.History.SetRows(checkpoint['Populations'][simulation_type]['Records'])
+
+            state = checkpoints[-1]['Populations'][simulation_type]
+            population.Budget = state['Budget']
+            population.CurrentPlan = state['CurrentPlan']
+            population.CurrentUtility = state['CurrentUtility']
+            for name, value in state.get('Incremental', {}).items():
+                setattr(population, name, value)
+
+        for simulation_type, (period_stats, agent_sample_recorder) in self.RunRecorders.items():
+            for checkpoint in checkpoints:
+                recorders = checkpoint['Recorders'][simulation_type]
+                for period, totals in recorders['Totals'].items():
+                    for name, total in totals.items():
+                        period_stats.Totals[name][period] = total
+                agent_sample_recorder.History.SetRows(recorders['Samples'])
+        self.Rng.bit_generator.state = checkpoints[-1]['Rng']
+
+        # the social utility function is solved after the first period
+        if 'social' in utility_handlers and not self.Jit:
+            utility_handlers['social'].SolveSocial()
+
+        log_message(f"Resuming from the checkpoint of period {checkpoints[-1]['Period']}")
+        return checkpoints[-1]['Period'] + 1
+
+    def PriceSchedule(self, num_iterations):
+        """
+        The prices of green and normal delivery before each period of a simulation, from the current prices. The
+        Engine's prices are left unchanged.
 
-            agent = Agent(i, a, b, mu, income, self.Price, delta)
+        :param num_iterations: Number of periods
+        :return: list of (cG, cN), one per period
+        """
+        prices = (self.Price, self.cG, self.cN)
 
-            # Assign friends
-            friendList.remove(i)  # Agents cannot be friends with themselves
-            agent.Friends = rand.sample(friendList, rand.choice(range(self.Friend_int[0], self.Friend_int[1])))
-            friendList.append(i)
+        costs = []
+        for i in range(num_iterations):
+            costs.append((self.cG, self.cN))
+            self.InflatePrices(i)
 
-            self.Agents[i] = agent
+        self.Price, self.cG, self.cN = prices
+        return costs
 
     @timer
-    def RunNormal(self, num_iterations):
+    @result_cached('normal')
+    def RunNormal(self, num_iterations, save=True):
         """
         Runs a simulation, where Agents make decisions on purchasing online goods and decide between a green or normal
         Prime subscription plan. The agents do NOT interact with each other on information exchange.
 
         :param num_iterations: Number of periods for which simulation is run.
+        :param save:           If False, the statistics are returned without being saved to ./SavedStats
         """
-        print('\nRunning normal')
+        log_message('\nRunning normal')
 
         self.UtilityHandler.SolveNormal()  # Sets up mathematical equations
+        self.History.Allocate(num_iterations)
+        self.start_run('normal', self.Population, num_iterations)
+
+        if self.Vectorized:
+            self.RunNormalVectorized(num_iterations)
+        else:
+            for i in range(num_iterations):  # for each period, for each agent...
+                with span('period.normal'):
+                    for agent in self.Agents:
+                        #  cG, cN, eG, eN
+                        agent.EnterGenericRound(i, self.cG, self.cN, self.eG, self.eN, self.UtilityHandler)
+                        agent.UpdateBudget(i)
+                    self.end_period('normal', i, self.Population)
+                self.InflatePrices(i)
 
-        for i in range(num_iterations):  # for each period, for each agent...
-            for agent in self.Agents:
-                #  cG, cN, eG, eN
-                agent.EnterGenericRound(i, self.cG, self.cN, self.eG, self.eN, self.UtilityHandler)
-                agent.UpdateBudget(i)
-            self.InflatePrices(i)
-
-        self.ReportStatsAllStats(self.Agents, num_iterations)
-        self.SaveStats(self.Agents, num_iterations, 'normal')
-        self.SaveAgentSample(Constants.SampleSize(), num_iterations, 'normal')
+        return self.FinishRun(num_iterations, 'normal', save)
 
     def RunNormalWithIncomeScaling(self, num_iterations):
         """
@@ -128,60 +570,302 @@ class Engine:
         :param num_iterations:
         :return:
         """
+        from tqdm import tqdm
+
         for i in range(num_iterations):
             for agent in tqdm(self.Agents):  # tqdm will time how long it takes to maximise each agent
                 #  cG, cN, eG, eN
                 agent.EnterRound(i, self.cG, self.cN, self.eG, self.eN)
                 agent.UpdateBudget(i)
-        self.ReportStatsAllStats(self.Agents, num_iterations)
+        self.ReportStatsAllStats(num_iterations)
 
     @timer  # Times the period for running the Social simulation
-    def RunSocial(self, num_iterations):
+    @result_cached('social')
+    def RunSocial(self, num_iterations, save=True):
         """
         Runs the Social simulation, where agents interact with each other on information exchange.
 
         :param num_iterations: Number of periods for which simulation is run
+        :param save:           If False, the statistics are returned without being saved to ./SavedStats
         """
-        print('\nRunning social')
+        log_message('\nRunning social')
 
         self.UtilityHandler.SolveNormal()
+        self.History.Allocate(num_iterations)
+        self.start_run('social', self.Population, num_iterations)
 
-        if num_iterations > 1:
+        if self.Vectorized:
+            self.RunSocialVectorized(num_iterations)
+
+        elif num_iterations > 1:
 
-            for agent in self.Agents:  # The first round is solved 'normally' without social effect
-                agent.EnterGenericRound(0, self.cG, self.cN, self.eG, self.eN, self.UtilityHandler)
-            self.UtilityHandler.SolveSocial()
+            with span('period.social'):
+                for agent in self.Agents:  # The first round is solved 'normally' without social effect
+                    agent.EnterGenericRound(0, self.cG, self.cN, self.eG, self.eN, self.UtilityHandler)
+                self.UtilityHandler.SolveSocial()
+                self.end_period('social', 0, self.Population)
 
             for i in range(num_iterations - 1):
-                for agent in self.Agents:
-                    # find this agent's friends
-                    friends = [x for x in self.Agents if x.Id in agent.Friends]
-                    agent.EnterSocialRound(i + 1, self.cG, self.cN, self.eG, self.eN, friends, self.UtilityHandler)
-                    agent.UpdateBudget(i)
+                with span('period.social'):
+                    # share of each agent's friends on each plan last period
+                    previous_plans = self.History.PlanRecords[i]
+                    green_shares = self.FriendIndex.Share(previous_plans == PLAN_GREEN)
+                    normal_shares = self.FriendIndex.Share(previous_plans == PLAN_NORMAL)
+
+                    for agent in self.Agents:
+                        agent.EnterSocialRound(i + 1, self.cG, self.cN, self.eG, self.eN, green_shares[agent.Id],
+                                               normal_shares[agent.Id], self.UtilityHandler)
+                        agent.UpdateBudget(i)
+                    self.end_period('social', i + 1, self.Population)
                 self.InflatePrices(i)
 
-        self.ReportStatsAllStats(self.Agents, num_iterations)
-        self.SaveStats(self.Agents, num_iterations, 'social')
-        self.SaveAgentSample(Constants.SampleSize(), num_iterations, 'social')
+        return self.FinishRun(num_iterations, 'social', save)
 
     @timer
-    def RunBenchMark(self, num_iterations):
+    @result_cached('benchmark')
+    def RunBenchMark(self, num_iterations, save=True):
         """
         The Benchmark simulation
 
         :param num_iterations: Number of periods for which to run the simulation for
+        :param save:           If False, the statistics are returned without being saved to ./SavedStats
         """
-        print('\nRunning benchmark')
+        log_message('\nRunning benchmark')
 
         self.UtilityHandler.SolveNormal()
+        self.History.Allocate(num_iterations)
+        self.start_run('benchmark', self.Population, num_iterations)
+
+        if self.Vectorized:
+            self.RunBenchMarkVectorized(num_iterations)
+        else:
+            for i in range(num_iterations):
+                with span('period.benchmark'):
+                    for agent in self.Agents:
+                        agent.EnterBenchMarkRound(i, self.cN, self.eN, self.UtilityHandler)
+                        agent.UpdateBudget(i)
+                    self.end_period('benchmark', i, self.Population)
+                self.InflatePrices(i)
+        return self.FinishRun(num_iterations, 'benchmark', save)
+
+    def FinishRun(self, num_iterations, type, save):
+        """
+        Reports the statistics of a finished run, and saves them unless save is False.
+
+        :return: (simulation statistics, agent sample) dataframes, or a list of them with one entry per price if
+                 several prices of green delivery were simulated. Agent samples of more than AGENT_CHUNK_SIZE agents
+                 are not built in memory: if saved, they are saved chunk by chunk and returned as None. Otherwise, they
+                 are returned as an AgentSampleSpool if SpoolAgentSamples is set (by the ResultCache and the sweeps,
+                 which save them later), and as None if not.
+        """
+        if self.NumPrices is None:
+            results = self.finish_price(self.Population, num_iterations, type, save)
+        else:
+            prices = self.AggregationManager.cG
+            results = []
+            for index, (price, population) in enumerate(zip(np.ravel(prices), self.Population.batches())):
+                log_message(f"\nPrice of green delivery: {price}")
+                self.AggregationManager.Reset(price)
+                results.append(self.finish_price(population, num_iterations, type, save, index))
+            self.AggregationManager.Reset(prices)
+
+        self.AggregationManager.ClearTotals()  # the totals would keep the run's History alive
+        return results
+
+    def finish_price(self, population, num_iterations, type, save, index=None):
+        """
+        :param index: index of the price, if several prices were simulated
+        """
+        totals, sample_index = None, None
+        if not self.KeepHistory:
+            period_stats, agent_sample_recorder = self.RunRecorders[type]
+            totals = period_stats.PriceTotals(index)
+            population = agent_sample_recorder.SamplePopulation(population, index)
+            sample_index = np.arange(len(population.Id))
+
+        self.AggregationManager.ReportAllStats(population.History, num_iterations, totals)
+
+        simulation_stats = self.AggregationManager.SimulationStats(population.History, num_iterations, totals)
+        if save:
+            self.AggregationManager.SaveSimulationStats(simulation_stats, type)
+
+        if sample_index is None:
+            sample_index = self.AggregationManager.AgentSampleIndex(len(population.Id), self.AgentSampleSize)
+        if len(sample_index) <= AGENT_CHUNK_SIZE:
+            agent_sample = self.AggregationManager.AgentSample(population, self.AgentSampleSize, num_iterations,
+                                                               sample_index)
+            if save:
+                self.AggregationManager.SaveAgentSample(agent_sample, type)
+        elif save:
+            self.AggregationManager.SaveAgentSample(
+                self.AggregationManager.AgentSampleChunks(population, sample_index, num_iterations), type)
+            agent_sample = None
+        elif self.SpoolAgentSamples:
+            agent_sample = self.AggregationManager.SpoolAgentSample(population, sample_index, num_iterations)
+        else:
+            agent_sample = None
+
+        return simulation_stats, agent_sample
+
+    def SaveRun(self, type, results):
+        """
+        Saves the statistics of a run, as FinishRun does if save is set.
+
+        :param results: FinishRun result
+        """
+        if self.NumPrices is None:
+            simulation_stats, agent_sample = results
+            self.AggregationManager.SaveSimulationStats(simulation_stats, type)
+            if agent_sample is not None:
+                self.AggregationManager.SaveAgentSample(agent_sample, type)
+            return
+
+        prices = self.AggregationManager.cG
+        for price, (simulation_stats, agent_sample) in zip(np.ravel(prices), results):
+            self.AggregationManager.Reset(price)
+            self.AggregationManager.SaveSimulationStats(simulation_stats, type)
+            if agent_sample is not None:
+                self.AggregationManager.SaveAgentSample(agent_sample, type)
+        self.AggregationManager.Reset(prices)
+
+    def RunKey(self, run, arguments):
+        """
+        Key of a run in the ResultCache: the hash of the state the run starts from (the agents' parameters and budgets,
+        the prices and the state of the random number generator, from which agent samples are drawn), the settings
+        which change its results, and the run method and its arguments.
+
+        :param run:       name of the run method
+        :param arguments: dict of the run's arguments
+        """
+        population = self.Population
+        arrays = {
+            'A': population.A,
+            'B': population.B,
+            'EcoCon': population.EcoCon,
+            'Budget': population.Budget,
+            'Delta': population.Delta,
+            'FriendOffsets': population.FriendIndex.Offsets,
+            'FriendIds': population.FriendIndex.Ids,
+            'cG': np.asarray(self.cG, dtype=np.float64)
+        }
+        values = {
+            'Run': run,
+            'Arguments': arguments,
+            'Price': self.Price,
+            'PopulationPrice': population.Price,
+            'cN': self.cN,
+            'eG': self.eG,
+            'eN': self.eN,
+            'InflationRate': self.InflationRate,
+            'GreenPrices': np.ravel(self.AggregationManager.cG).tolist(),  # as recorded in the statistics
+            'NormalPrice': self.AggregationManager.cN,
+            'AgentSampleSize': self.AgentSampleSize,
+            'Vectorized': self.Vectorized,
+            'Jit': self.Jit,
+            'Incremental': self.Incremental,
+            'ClosedForm': self.UtilityHandler.ClosedForm,
+            'Rng': self.Rng.bit_generator.state
+        }
+        return result_key(arrays, values)
+
+    def RunState(self):
+        """
+        The state a run leaves the Engine in, which the next run starts from: the agents' budgets, plans and utilities,
+        the prices and the state of the random number generator. The History is not part of it.
+        """
+        return {
+            'Budget': self.Population.Budget,
+            'CurrentPlan': self.Population.CurrentPlan,
+            'CurrentUtility': self.Population.CurrentUtility,
+            'PopulationPrice': self.Population.Price,
+            'Price': self.Price,
+            'cG': self.cG,
+            'cN': self.cN,
+            'Rng': self.Rng.bit_generator.state
+        }
+
+    def RestoreRunState(self, state):
+        """
+        Puts the Engine in the state of a cached run, from RunState. Its History is left as it was before the run.
+        """
+        self.Population.Budget = state['Budget']
+        self.Population.CurrentPlan = state['CurrentPlan']
+        self.Population.CurrentUtility = state['CurrentUtility']
+        self.Population.Price = state['PopulationPrice']
+        self.Price = state['Price']
+        self.cG = state['cG']
+        self.cN = state['cN']
+        self.Rng.bit_generator.state = state['Rng']
+
+    def run_period(self, simulation_type, period, population, utility_handler, cG, cN):
+        """
+        Evaluates one period of a simulation type for a whole Population, at prices of delivery cG and cN, then calls
+        the run's observers. The social simulation solves its first period without social effect, and adds the
+        savings of each period to the budgets after the following period.
+        """
+        with span(f'period.{simulation_type}'):
+            if simulation_type == 'benchmark':
+                if self.Jit:
+                    population.EnterBenchMarkRoundCompiled(period, cN, self.eN)
+                else:
+                    population.EnterBenchMarkRound(period, cN, self.eN, utility_handler)
+                    population.UpdateBudget(period)
+
+            elif simulation_type == 'normal':
+                if self.Jit:
+                    population.EnterGenericRoundCompiled(period, cG, cN, self.eG, self.eN)
+                else:
+                    population.EnterGenericRound(period, cG, cN, self.eG, self.eN, utility_handler)
+                    population.UpdateBudget(period)
+
+            elif period == 0:
+                # The first round is solved 'normally' without social effect
+                if self.Jit:
+                    population.EnterGenericRoundCompiled(0, cG, cN, self.eG, self.eN, update_budget=False)
+                else:
+                    population.EnterGenericRound(0, cG, cN, self.eG, self.eN, utility_handler)
+                    utility_handler.SolveSocial()
+
+            elif self.Jit:
+                population.EnterSocialRoundCompiled(period, cG, cN, self.eG, self.eN)
+            else:
+                population.EnterSocialRound(period, cG, cN, self.eG, self.eN, utility_handler)
+                population.UpdateBudget(period - 1)
+
+            self.end_period(simulation_type, period, population)
+
+    def RunNormalVectorized(self, num_iterations):
+        """
+        Vectorized equivalent of the agent loop in RunNormal: every period is evaluated for the whole Population at
+        once.
+
+        :param num_iterations: Number of periods for which simulation is run.
+        """
         for i in range(num_iterations):
-            for agent in self.Agents:
-                agent.EnterBenchMarkRound(i, self.cN, self.eN, self.UtilityHandler)
-                agent.UpdateBudget(i)
+            self.run_period('normal', i, self.Population, self.UtilityHandler, self.cG, self.cN)
+            self.InflatePrices(i)
+
+    def RunSocialVectorized(self, num_iterations):
+        """
+        Vectorized equivalent of the agent loop in RunSocial.
+
+        :param num_iterations: Number of periods for which simulation is run
+        """
+        if num_iterations > 1:
+            self.run_period('social', 0, self.Population, self.UtilityHandler, self.cG, self.cN)
+            for i in range(num_iterations - 1):
+                self.run_period('social', i + 1, self.Population, self.UtilityHandler, self.cG, self.cN)
+                self.InflatePrices(i)
+
+    def RunBenchMarkVectorized(self, num_iterations):
+        """
+        Vectorized equivalent of the agent loop in RunBenchMark.
+
+        :param num_iterations: Number of periods for which to run the simulation for
+        """
+        for i in range(num_iterations):
+            self.run_period('benchmark', i, self.Population, self.UtilityHandler, self.cG, self.cN)
             self.InflatePrices(i)
-        self.ReportStatsAllStats(self.Agents, num_iterations)
-        self.SaveStats(self.Agents, num_iterations, 'benchmark')
-        self.SaveAgentSample(Constants.SampleSize(), num_iterations, 'benchmark')
 
     def InflatePrices(self, period):
         """
@@ -200,30 +884,36 @@ class Engine:
             self.cN = inf ** Constants.PriceHikeInterval() * self.cN
 
     def PrintDeliveryShare(self):
-        greens = 0
-        for agent in self.Agents:
-            if agent.CurrentPlan == "Green":
-                greens += 1
-        return f"Green Delivery: {greens}, Normal Delivery: {len(self.Agents) - greens}"
+        greens = np.count_nonzero(self.Population.CurrentPlan == PLAN_GREEN)
+        return f"Green Delivery: {greens}, Normal Delivery: {self.Population.CurrentPlan.size - greens}"
 
     def ReportStatsForPeriod(self, period):
-        self.AggregationManager.ReportStatsForPeriod(self.Agents, period)
+        self.AggregationManager.ReportStatsForPeriod(self.History, period)
 
-    def ReportStatsAllStats(self, agents, periods):
-        self.AggregationManager.ReportAllStats(agents, periods)
+    def ReportStatsAllStats(self, periods):
+        self.AggregationManager.ReportAllStats(self.History, periods)
 
-    def SaveStats(self, agents, periods, type):
-        self.AggregationManager.AddSimulationToCSV(agents, periods, type)
+    def SaveStats(self, periods, type):
+        self.AggregationManager.AddSimulationToCSV(self.History, periods, type)
 
     def SaveAgentSample(self, sample_size, periods, type):
-        self.AggregationManager.AddAgentSampleToCSV(self.Agents, sample_size, periods, type)
+        self.AggregationManager.AddAgentSampleToCSV(self.Population, sample_size, periods, type)
 
     def ResetEngine(self, price, cG, cN):
-        for agent in self.Agents:
-            agent.ResetAgent(price)
-        self.Price = price
-        self.cG = cG
-        self.cN = cN
+        """
+        Restores the agents' initial budgets and clears their histories, with new prices.
+        """
+        green_prices = cG
+        if self.NumPrices is not None:
+            cG = np.asarray(cG, dtype=np.float64).reshape(-1, 1)
+
+        self.Restore(dict(self.InitialState, Price=price, cG=cG, cN=cN))
+        self.AggregationManager.Reset(green_prices)
+
 
-        self.AggregationManager.Reset(cG)
-        self.UtilityHandler.Reset()
+def kernels_available():
+    """
+    Whether the compiled kernels of Kernels.py can be used, which imports numba.
+    """
+    import Kernels
+    return Kernels.KERNELS_AVAILABLE
@@ -1,5 +1,7 @@
 import os
 
+from Instrumentation import *
+
 class ErrorLogger:
     def __init__(self, timestamp):
         self.Filepath = f"./ErrorLogs/Log-{timestamp}.txt"
@@ -15,7 +17,7 @@ class ErrorLogger:
     def CheckSolutionExists(self, sol_array, period, agent_id):
         if len(sol_array) == 0:
             self.ErrorList.append(f"No solution found for agent {agent_id} in period {period}.")
-            print(f"No solution found for agent {agent_id} in period {period}.")
+            log_message(f"No solution found for agent {agent_id} in period {period}.")
             return False
         return True
 
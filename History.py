@@ -0,0 +1,196 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+History.py:
+
+This file stores the History class, the records of a simulation in columnar form: one preallocated array per record,
+with one row per period and one column per agent. Plans are recorded as small integer codes.
+
+A History with a depth keeps only the records of the last depth periods, in rows reused in turn (see Row), so that its
+memory does not grow with the number of periods.
+"""
+
+from collections.abc import MutableMapping
+
+import numpy as np
+
+# Delivery plan codes stored in the plan arrays
+PLAN_NONE, PLAN_NORMAL, PLAN_GREEN = 0, 1, 2
+PLAN_NAMES = np.array(['None', 'Normal', 'Green'], dtype=object)
+PLAN_CODES = {'None': PLAN_NONE, 'Normal': PLAN_NORMAL, 'Green': PLAN_GREEN}
+
+# Names of the float64 records
+FLOAT_RECORDS = ['Qrecords', 'Srecords', 'BudgetHistory', 'GreenUtility', 'NormalUtility', 'UtilityDisparity',
+                 'Erecords']
+
+
+class History:
+
+    def __init__(self, num_periods, num_agents, num_prices=None, depth=None):
+        """
+        Initialises a History object with the following (num_periods x num_agents) arrays, or (num_periods x num_prices
+        x num_agents) arrays if num_prices is given, for a Population simulated at several prices at once (see Batch):
+
+        Qrecords:         Quantity of goods consumed
+        Srecords:         Savings
+        BudgetHistory:    Budget at the start of the period
+        PlanRecords:      Selected delivery plan (int8 plan code)
+        GreenUtility:     Utility if the green plan is selected
+        NormalUtility:    Utility if the normal plan is selected
+        UtilityDisparity: GreenUtility - NormalUtility
+        Erecords:         Emissions (kg of CO2)
+
+        If depth is given, the arrays only have depth rows, and the records of a period are in row Row(period).
+        """
+        self.NumAgents = num_agents
+        self.NumPrices = num_prices
+        self.Depth = depth
+        self.Version = 0
+        self.Allocate(num_periods)
+
+    def Allocate(self, num_periods):
+        """
+        Replaces the records with zeroed records for num_periods periods. Version is incremented, so that results
+        computed from the previous records can be recognised as stale.
+        """
+        self.Version += 1
+        self.NumPeriods = num_periods
+        num_rows = num_periods if self.Depth is None else self.Depth
+        shape = (num_rows, self.NumAgents) if self.NumPrices is None else (num_rows, self.NumPrices, self.NumAgents)
+        for name in FLOAT_RECORDS:
+            setattr(self, name, np.zeros(shape))
+        self.PlanRecords = np.zeros(shape, dtype=np.int8)
+
+    def EnsurePeriods(self, num_periods):
+        """
+        Extends the records to at least num_periods periods, keeping the existing records.
+        """
+        if num_periods <= self.NumPeriods:
+            return
+        if self.Depth is not None:
+            self.NumPeriods = num_periods
+            return
+
+        records = {name: getattr(self, name) for name in FLOAT_RECORDS + ['PlanRecords']}
+        previous_periods = self.NumPeriods
+        self.Allocate(num_periods)
+        for name, record in records.items():
+            getattr(self, name)[:previous_periods] = record
+
+    def Batch(self, index):
+        """
+        The records of the index-th price of a History with num_prices, as a History of (num_periods x num_agents)
+        views of its arrays.
+        """
+        history = History.__new__(History)
+        history.NumAgents = self.NumAgents
+        history.NumPrices = None
+        history.Depth = self.Depth
+        history.Version = self.Version
+        history.NumPeriods = self.NumPeriods
+        for name in FLOAT_RECORDS + ['PlanRecords']:
+            setattr(history, name, getattr(self, name)[:, index])
+        return history
+
+    def Row(self, period):
+        """
+        :return: row of the records of a period
+        """
+        if self.Depth is None:
+            return period
+        return period % self.Depth
+
+    def Rows(self, period):
+        """
+        The records of a period, as a dict of views of their rows by record name.
+        """
+        row = self.Row(period)
+        return {name: getattr(self, name)[row] for name in FLOAT_RECORDS + ['PlanRecords']}
+
+    def CopyRows(self, first_period, last_period):
+        """
+        Copies of the records of the periods from first_period to last_period which are still kept, by period, as from
+        Rows, to be restored with SetRows.
+        """
+        if self.Depth is not None:
+            first_period = max(first_period, last_period + 1 - self.Depth)
+        return {period: {name: row.copy() for name, row in self.Rows(period).items()}
+                for period in range(first_period, last_period + 1)}
+
+    def SetRows(self, rows):
+        """
+        :param rows: records by period, as from CopyRows
+        """
+        for period, records in rows.items():
+            row = self.Row(period)
+            for name, values in records.items():
+                getattr(self, name)[row] = values
+
+    def NBytes(self):
+        return sum(getattr(self, name).nbytes for name in FLOAT_RECORDS + ['PlanRecords'])
+
+
+class PeriodRecords(MutableMapping):
+    """
+    A dict-like view of one agent's column of a History record, keyed by period. Plan records are read and written as
+    plan names. Only a History which keeps every period can be viewed, as the rows of a History with a depth no longer
+    hold the earlier periods.
+    """
+
+    __slots__ = ('History', 'Name', 'Index')
+
+    def __init__(self, history, name, index):
+        if history.Depth is not None:
+            raise ValueError("The History only keeps its last periods: run the Engine with keep_history=True to view "
+                             "the records of every period")
+        self.History = history
+        self.Name = name
+        self.Index = index
+
+    def __getitem__(self, period):
+        if not 0 <= period < self.History.NumPeriods:
+            raise KeyError(period)
+
+        value = getattr(self.History, self.Name)[self.History.Row(period), self.Index]
+        if self.Name == 'PlanRecords':
+            return PLAN_NAMES[value]
+        return value.item()
+
+    def __setitem__(self, period, value):
+        self.History.EnsurePeriods(period + 1)
+
+        if self.Name == 'PlanRecords':
+            value = PLAN_CODES[value]
+        getattr(self.History, self.Name)[self.History.Row(period), self.Index] = value
+
+    def __delitem__(self, period):
+        raise TypeError("History records cannot be deleted")
+
+    def __iter__(self):
+        return iter(range(self.History.NumPeriods))
+
+    def __len__(self):
+        return self.History.NumPeriods
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+def totals_by_plan(plans, *records):
+    """
+    Sums over the agents, the last axis, by selected plan, in one pass: each agent of each row is assigned to a (row,
+    plan) group, and the records are summed by group.
+
+    :param plans:   plan records, (... x num_agents)
+    :param records: records of the same shape as plans
+    :return: list of (... x num_plans) arrays: the number of agents who selected each plan, then the sum of each record
+             over the agents who selected each plan
+    """
+    batch_shape = plans.shape[:-1]
+    num_rows = int(np.prod(batch_shape))
+    num_plans = len(PLAN_NAMES)
+    groups = (plans.reshape(num_rows, -1) + num_plans * np.arange(num_rows)[:, None]).ravel()
+
+    return [np.bincount(groups, None if weights is None else weights.reshape(num_rows, -1).ravel(),
+                        minlength=num_plans * num_rows).reshape(batch_shape + (num_plans,))
+            for weights in (None,) + records]
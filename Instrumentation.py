@@ -0,0 +1,250 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Instrumentation.py:
+
+This file stores the instrumentation of the simulation. Named spans time its stages (agent generation, solving, every
+period of a run, aggregation and output) and counters count its work, in a Registry of counters and histograms which
+can be exported as JSON.
+
+Instrumentation is off by default, and a span then costs a single flag check. It is turned on with
+enable_instrumentation(), or for whole processes, including the worker processes of a sweep, by setting the environment
+variable SIMULATION_INSTRUMENTATION=1.
+
+Quiet mode, set with set_quiet() or SIMULATION_QUIET=1, silences the progress messages of the Engine, its agents and
+the sweeps, and the statistics reported after each run (see log_message).
+"""
+
+import bisect
+import functools
+import json
+import math
+import os
+import time
+
+
+def environment_flag(name):
+    return os.environ.get(name, '') not in ('', '0')
+
+
+class Instrumentation:
+    """
+    The instrumentation settings of the process.
+    """
+    Enabled = environment_flag('SIMULATION_INSTRUMENTATION')
+    Quiet = environment_flag('SIMULATION_QUIET')
+
+
+class Histogram:
+    """
+    The count, total, minimum and maximum of a measurement, and the number of its values in each bucket.
+    """
+
+    # upper bounds of the buckets, 1, 2 and 5 in every decade from 1 microsecond to 1000 seconds
+    BOUNDS = [mantissa * 10.0 ** exponent for exponent in range(-6, 3) for mantissa in (1, 2, 5)] + [1000.0]
+
+    def __init__(self):
+        self.Count = 0
+        self.Total = 0.0
+        self.Min = math.inf
+        self.Max = -math.inf
+        self.Buckets = [0] * (len(self.BOUNDS) + 1)  # the last bucket counts values above every bound
+
+    def Add(self, value):
+        self.Count += 1
+        self.Total += value
+        self.Min = min(self.Min, value)
+        self.Max = max(self.Max, value)
+
+        self.Buckets[bisect.bisect_left(self.BOUNDS, value)] += 1
+
+    def Merge(self, data):
+        """
+        Adds the values of a histogram exported with ToDict.
+        """
+        if data['count'] == 0:
+            return
+        self.Count += data['count']
+        self.Total += data['total']
+        self.Min = min(self.Min, data['min'])
+        self.Max = max(self.Max, data['max'])
+        self.Buckets = [count + other for count, other in zip(self.Buckets, data['buckets'])]
+
+    def ToDict(self):
+        return {
+            'count': self.Count,
+            'total': self.Total,
+            'mean': self.Total / self.Count if self.Count > 0 else None,
+            'min': self.Min if self.Count > 0 else None,
+            'max': self.Max if self.Count > 0 else None,
+            'bounds': self.BOUNDS,
+            'buckets': self.Buckets
+        }
+
+
+class Registry:
+    """
+    Counters and histograms by name. The histogram of a span holds its durations in seconds.
+    """
+
+    def __init__(self):
+        self.Counters = {}
+        self.Histograms = {}
+
+    def Count(self, name, value=1):
+        self.Counters[name] = self.Counters.get(name, 0) + value
+
+    def Observe(self, name, value):
+        if name not in self.Histograms:
+            self.Histograms[name] = Histogram()
+        self.Histograms[name].Add(value)
+
+    def Merge(self, data):
+        """
+        Adds the counters and histograms of a registry exported with ToDict, such as that of a worker process.
+        """
+        for name, value in data['counters'].items():
+            self.Count(name, value)
+        for name, histogram in data['histograms'].items():
+            if name not in self.Histograms:
+                self.Histograms[name] = Histogram()
+            self.Histograms[name].Merge(histogram)
+
+    def ToDict(self):
+        return {
+            'counters': dict(self.Counters),
+            'histograms': {name: histogram.ToDict() for name, histogram in self.Histograms.items()}
+        }
+
+    def ToJSON(self, path=None):
+        """
+        :param path: If given, the JSON is also written to this file
+        :return: the counters and histograms as a JSON string
+        """
+        text = json.dumps(self.ToDict(), indent=2)
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+    def Reset(self):
+        self.Counters = {}
+        self.Histograms = {}
+
+
+# Registry of the process
+REGISTRY = Registry()
+
+
+class Span:
+    """
+    Times the code it is entered around, and adds the duration to the histogram of its name.
+    """
+
+    __slots__ = ('Name', 'Start')
+
+    def __init__(self, name):
+        self.Name = name
+
+    def __enter__(self):
+        self.Start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        REGISTRY.Observe(self.Name, time.perf_counter() - self.Start)
+        return False
+
+
+class NullSpan:
+    """
+    The span returned while instrumentation is off, which does nothing.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def enable_instrumentation(enabled=True):
+    Instrumentation.Enabled = enabled
+
+
+def set_quiet(quiet=True):
+    Instrumentation.Quiet = quiet
+
+
+def configure_instrumentation(enabled, quiet):
+    """
+    Sets the instrumentation settings, as passed to the worker processes of a sweep.
+    """
+    enable_instrumentation(enabled)
+    set_quiet(quiet)
+
+
+def initialize_worker(enabled, quiet):
+    """
+    Initializer of the worker processes of a sweep: sets the instrumentation settings, and empties the registry, which
+    a forked worker would otherwise inherit from its parent and send back with its first task.
+    """
+    configure_instrumentation(enabled, quiet)
+    REGISTRY.Reset()
+
+
+def span(name):
+    """
+    A context manager timing a span of name, if instrumentation is on.
+    """
+    if Instrumentation.Enabled:
+        return Span(name)
+    return NULL_SPAN
+
+
+def instrumented(name):
+    """
+    Decorates a function, so that each of its calls is a span of name.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not Instrumentation.Enabled:
+                return function(*args, **kwargs)
+            with Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_event(name, value=1):
+    if Instrumentation.Enabled:
+        REGISTRY.Count(name, value)
+
+
+def observe_value(name, value):
+    if Instrumentation.Enabled:
+        REGISTRY.Observe(name, value)
+
+
+def collect_registry():
+    """
+    The registry's counters and histograms, which are then reset, so that a worker process can send what it recorded
+    during each task.
+    """
+    data = REGISTRY.ToDict()
+    REGISTRY.Reset()
+    return data
+
+
+def log_message(*args, **kwargs):
+    """
+    print, unless in quiet mode.
+    """
+    if not Instrumentation.Quiet:
+        print(*args, **kwargs)
@@ -0,0 +1,184 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Kernels.py:
+
+This file stores compiled kernels of the Population's period updates, used by the Engine when jit is set. Each kernel
+evaluates one period in a single loop over the agents: the friends' shares of each plan (social rounds), the optimum of
+each plan from its closed form (see ClosedForm.py), the choice, every History record and the budget update, without
+allocating temporary arrays.
+
+choice_period can also evaluate periods incrementally. The optimal utility V of a plan is increasing and concave in the
+budget less the price of delivery R, with derivative b / S (envelope theorem), and S grows more slowly than R. So if a
+plan had utility V and savings S when it was last evaluated, once R has grown by g (which is negative if the price of
+delivery rises by more than the budget), its utility lies between V + b g / (S + g) and V + b g / S. Budgets only grow
+by a fraction of savings, so for most agents the bounds of the two plans stay apart for many periods, and the plan they
+take is known. Only that plan is evaluated, and the utility of the other plan is recorded as its upper bound, its first
+order estimate. The choices and the Q, S and utility of the plans taken are those of a full evaluation, so the
+statistics are unchanged; only the GreenUtility, NormalUtility and UtilityDisparity records of the plans not taken are
+estimates. Every plan is evaluated again once the price of the average good changes.
+
+The kernels are compiled with numba, which is optional. Without numba, KERNELS_AVAILABLE is False and the Engine falls
+back to the NumPy evaluation of Population.py.
+"""
+
+import math
+
+from History import *
+
+try:
+    from numba import njit
+    KERNELS_AVAILABLE = True
+except ImportError:
+    KERNELS_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        return lambda function: function
+
+
+@njit(cache=True, inline='always')
+def optimum(a, b, mu, Y, P, e, c):
+    """
+    Scalar equivalent of ClosedForm.optimum.
+
+    :return: (utility, Q, S)
+    """
+    a_plus_b_P = (a + b) * P
+    k = mu * e
+    R = Y - c
+
+    q = 2 * a * R / (a_plus_b_P + math.sqrt(a_plus_b_P * a_plus_b_P + 4 * a * b * P * k * R))
+    s = R - P * q
+    utility = a * math.log(q / (1 + k * q)) + b * math.log(s)
+    return utility, q, s
+
+
+@njit(cache=True)
+def choice_period(A, B, EcoCon, Delta, Budget, P, eG, eN, cG, cN, social, friend_offsets, friend_ids, previous_plans,
+                  savings, fraction_of_savings, co2_per_dollar, incremental, refresh_all, tolerance, base_net_budget,
+                  base_utility, base_savings, plan_row, q_row, s_row, budget_row, green_row, normal_row, disparity_row,
+                  e_row, current_plan, current_utility):
+    """
+    One generic or social period for every agent: records the optimum of the preferred plan in the History rows of the
+    period, then adds fraction_of_savings of the savings in the savings row to each budget.
+
+    :param social:         If True, the utilities include the social effect of the friends' plans in previous_plans
+    :param previous_plans: plan records of the previous period (only read if social)
+    :param savings:        savings record added to the budgets, which may be s_row
+    :param incremental:    If True, only the plan an agent takes is evaluated when the bounds from base_net_budget,
+                           base_utility and base_savings show that the other plan cannot be better (see the
+                           module docstring), and these are updated for the plans evaluated
+    :param refresh_all:    If True, every plan is evaluated
+    :param tolerance:      relative margin by which the bounds must exclude indifference
+    :return: number of plans evaluated
+    """
+    evaluated = 0
+    for j in range(len(A)):
+        a, b, mu, budget = A[j], B[j], EcoCon[j], Budget[j]
+
+        social_green = 0.0
+        social_normal = 0.0
+        if social:
+            greens = 0
+            normals = 0
+            for f in range(friend_offsets[j], friend_offsets[j + 1]):
+                plan = previous_plans[friend_ids[f]]
+                greens += plan == PLAN_GREEN
+                normals += plan == PLAN_NORMAL
+            num_friends = friend_offsets[j + 1] - friend_offsets[j]
+            if num_friends > 0:
+                social_green = a * Delta[j] * math.log1p(greens / num_friends)
+                social_normal = a * Delta[j] * math.log1p(normals / num_friends)
+
+        evaluate_green = True
+        evaluate_normal = True
+        util_green, q_green, s_green = math.nan, math.nan, math.nan
+        util_normal, q_normal, s_normal = math.nan, math.nan, math.nan
+        if incremental and not refresh_all:
+            growth_green = budget - cG - base_net_budget[0, j]
+            growth_normal = budget - cN - base_net_budget[1, j]
+            if base_savings[0, j] + growth_green > 0 and base_savings[1, j] + growth_normal > 0:
+                base_green = base_utility[0, j] + social_green
+                base_normal = base_utility[1, j] + social_normal
+                low_green = base_green + b * growth_green / (base_savings[0, j] + growth_green)
+                low_normal = base_normal + b * growth_normal / (base_savings[1, j] + growth_normal)
+                high_green = base_green + b * growth_green / base_savings[0, j]
+                high_normal = base_normal + b * growth_normal / base_savings[1, j]
+                margin = tolerance * (abs(low_green) + abs(low_normal))
+                if low_green - high_normal > margin:
+                    evaluate_normal = False
+                    util_normal = high_normal
+                elif high_green - low_normal < -margin:
+                    evaluate_green = False
+                    util_green = high_green
+
+        if evaluate_green:
+            util_green, q_green, s_green = optimum(a, b, mu, budget, P, eG, cG)
+            evaluated += 1
+            if incremental:
+                base_net_budget[0, j] = budget - cG
+                base_utility[0, j] = util_green
+                base_savings[0, j] = s_green
+            util_green += social_green
+        if evaluate_normal:
+            util_normal, q_normal, s_normal = optimum(a, b, mu, budget, P, eN, cN)
+            evaluated += 1
+            if incremental:
+                base_net_budget[1, j] = budget - cN
+                base_utility[1, j] = util_normal
+                base_savings[1, j] = s_normal
+            util_normal += social_normal
+
+        if util_green > util_normal:
+            plan_row[j] = PLAN_GREEN
+            q_row[j] = q_green
+            s_row[j] = s_green
+            e_row[j] = q_green * eG * co2_per_dollar * P / 1000  # divide 1000 for kg instead of g of CO2
+            current_utility[j] = util_green
+        else:
+            plan_row[j] = PLAN_NORMAL
+            q_row[j] = q_normal
+            s_row[j] = s_normal
+            e_row[j] = q_normal * eN * co2_per_dollar * P / 1000
+            current_utility[j] = util_normal
+        current_plan[j] = plan_row[j]
+
+        budget_row[j] = budget
+        green_row[j] = util_green
+        normal_row[j] = util_normal
+        disparity_row[j] = util_green - util_normal
+
+        Budget[j] = budget + fraction_of_savings * savings[j]
+    return evaluated
+
+
+@njit(cache=True)
+def benchmark_period(A, B, EcoCon, Budget, P, eN, cN, fraction_of_savings, co2_per_dollar, plan_row, q_row, s_row,
+                     budget_row, green_row, normal_row, disparity_row, e_row, current_plan, current_utility):
+    """
+    One benchmark period for every agent: agents take the normal plan if its utility is positive, and no plan
+    otherwise. Then fraction_of_savings of their savings is added to their budgets.
+    """
+    for j in range(len(A)):
+        budget = Budget[j]
+        util_normal, q, s = optimum(A[j], B[j], EcoCon[j], budget, P, eN, cN)
+
+        if util_normal > 0:
+            plan_row[j] = PLAN_NORMAL
+        else:
+            plan_row[j] = PLAN_NONE
+            q = 0.0
+            s = budget
+        current_plan[j] = plan_row[j]
+
+        q_row[j] = q
+        s_row[j] = s
+        e_row[j] = q * eN * co2_per_dollar * P / 1000
+
+        budget_row[j] = budget
+        green_row[j] = 0
+        normal_row[j] = util_normal
+        disparity_row[j] = -util_normal
+        current_utility[j] = util_normal
+
+        Budget[j] = budget + fraction_of_savings * s
@@ -0,0 +1,124 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Observers.py:
+
+This file stores the observers of a simulation. Observers added to the Engine are called at the end of every period with
+views of that period's records, so that statistics can be computed while the simulation runs rather than from the whole
+History afterwards.
+
+With keep_history=False, the Engine keeps only the records of the last two periods, and computes its statistics with a
+PeriodStats and its agent sample with an AgentSampleRecorder instead. Memory then grows with the number of agents, and
+not with the number of agents times the number of periods.
+"""
+
+import copy
+
+import numpy as np
+
+from History import *
+
+
+class PeriodObserver:
+    """
+    Base class of the observers. Subclasses override the methods they need.
+    """
+
+    def OnRunStart(self, simulation_type, population, num_periods):
+        """
+        Called before the first period of a run.
+
+        :param simulation_type: 'benchmark', 'normal' or 'social'
+        :param population:      Population of the run
+        :param num_periods:     number of periods of the run
+        """
+
+    def OnPeriodEnd(self, simulation_type, period, records):
+        """
+        Called once the records of a period are complete. The records are only valid during the call: with
+        keep_history=False, their rows are reused two periods later.
+
+        :param simulation_type: 'benchmark', 'normal' or 'social'
+        :param period:          period whose records are complete
+        :param records:         dict of the period's records by History record name, as (num_agents) views, or
+                                (num_prices x num_agents) views if several prices are simulated at once
+        """
+
+
+class PeriodStats(PeriodObserver):
+    """
+    Computes the totals of AggregationManager.PeriodTotals one period at a time.
+    """
+
+    def __init__(self, eG, eN):
+        self.eG = eG
+        self.eN = eN
+        self.Totals = None
+
+    def OnRunStart(self, simulation_type, population, num_periods):
+        # periods that are not simulated (the only period of a one period social run) keep totals of 0, as in a History
+        shape = (num_periods,) + population.Budget.shape[:-1]
+        self.Totals = {name: np.zeros(shape, dtype=np.int64) for name in ('GreenUsers', 'NormalUsers')}
+        self.Totals.update({name: np.zeros(shape) for name in ('QwithGreen', 'QwithNormal', 'TotalQ', 'TotalEmission',
+                                                               'TotalUtility', 'AverageIncome')})
+
+    def OnPeriodEnd(self, simulation_type, period, records):
+        users, q, green_utility, normal_utility = totals_by_plan(records['PlanRecords'], records['Qrecords'],
+                                                                 records['GreenUtility'], records['NormalUtility'])
+
+        totals = self.Totals
+        totals['GreenUsers'][period] = users[..., PLAN_GREEN]
+        totals['NormalUsers'][period] = users[..., PLAN_NORMAL]
+        totals['QwithGreen'][period] = q[..., PLAN_GREEN]
+        totals['QwithNormal'][period] = q[..., PLAN_NORMAL]
+        totals['TotalQ'][period] = q[..., PLAN_GREEN] + q[..., PLAN_NORMAL]
+        totals['TotalEmission'][period] = q[..., PLAN_GREEN] * self.eG + q[..., PLAN_NORMAL] * self.eN
+        totals['TotalUtility'][period] = green_utility[..., PLAN_GREEN] + normal_utility[..., PLAN_NORMAL]
+        totals['AverageIncome'][period] = records['BudgetHistory'].mean(axis=-1)
+
+    def PriceTotals(self, index=None):
+        """
+        :param index: index of the price, if several prices are simulated at once
+        :return: dict of arrays with one entry per period, as from AggregationManager.PeriodTotals
+        """
+        if index is None:
+            return self.Totals
+        return {name: total[:, index] for name, total in self.Totals.items()}
+
+
+class AgentSampleRecorder(PeriodObserver):
+    """
+    Records the periods of a sample of agents in a History of its own.
+    """
+
+    def __init__(self, sample_index):
+        """
+        :param sample_index: agent indices from AggregationManager.AgentSampleIndex, or a (num_prices x sample size)
+                             array of them if several prices are simulated at once
+        """
+        self.SampleIndex = np.asarray(sample_index)
+        self.History = None
+
+    def OnRunStart(self, simulation_type, population, num_periods):
+        num_prices = len(self.SampleIndex) if self.SampleIndex.ndim == 2 else None
+        self.History = History(num_periods, self.SampleIndex.shape[-1], num_prices)
+
+    def OnPeriodEnd(self, simulation_type, period, records):
+        for name, record in records.items():
+            getattr(self.History, name)[period] = np.take_along_axis(record, self.SampleIndex, axis=-1)
+
+    def SamplePopulation(self, population, index=None):
+        """
+        A Population of the sampled agents only, whose History is the recorded History, to be passed to
+        AggregationManager.AgentSample.
+
+        :param population: Population of the run, or of the price if several prices are simulated at once
+        :param index:      index of the price, if several prices are simulated at once
+        """
+        sample_index = self.SampleIndex if index is None else self.SampleIndex[index]
+
+        sample = copy.copy(population)
+        sample.Id = np.arange(len(sample_index))
+        sample.EcoCon = population.EcoCon[sample_index]
+        sample.History = self.History if index is None else self.History.Batch(index)
+        return sample
@@ -0,0 +1,396 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Population.py:
+
+This file stores the Population class. The Population holds the parameters and state of every Agent as NumPy arrays
+(struct-of-arrays), so that each period is evaluated for all agents at once with one call per lambdified expression.
+The records of each period are written to the Population's History.
+
+The compiled rounds of an incremental Population only evaluate both plans of the agents whose choice may change (see
+Kernels.py).
+"""
+
+import copy
+
+import numpy as np
+from Constants import *
+from History import *
+from Instrumentation import *
+
+# Attributes holding the state of incremental evaluation, which checkpoints save
+INCREMENTAL_STATE = ['IncrementalNetBudget', 'IncrementalUtility', 'IncrementalSavings', 'IncrementalPrice']
+
+
+class FriendIndex:
+
+    def __init__(self, offsets, ids):
+        """
+        The friendship graph in compressed sparse row form: the friends of agent i are ids[offsets[i]:offsets[i + 1]].
+
+        :param offsets: array of length num_agents + 1
+        :param ids:     array of friend ids
+        """
+        self.Offsets = np.asarray(offsets, dtype=np.int64)
+        self.Ids = np.asarray(ids, dtype=np.int64)
+        self.Counts = np.diff(self.Offsets)
+        self.Rows = np.repeat(np.arange(len(self.Counts)), self.Counts)  # agent owning each friendship
+
+    @classmethod
+    def FromFriendLists(cls, friend_lists):
+        """
+        :param friend_lists: a list of friend id lists, one per agent
+        :return: FriendIndex
+        """
+        counts = [len(friends) for friends in friend_lists]
+        offsets = np.zeros(len(friend_lists) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        ids = np.fromiter((j for friends in friend_lists for j in friends), dtype=np.int64, count=offsets[-1])
+        return cls(offsets, ids)
+
+    @classmethod
+    def Sample(cls, rng, num_agents, counts):
+        """
+        Draws counts[i] distinct friends for each agent i, uniformly from the other agents.
+
+        Friends are drawn from the num_agents - 1 other agents as if self did not exist, and ids at or above the agent's
+        own id are shifted up by one. Duplicates within an agent's friends are redrawn until there are none.
+
+        :param rng:        numpy Generator
+        :param num_agents: number of agents
+        :param counts:     array of the number of friends of each agent
+        :return: FriendIndex
+        """
+        counts = np.asarray(counts, dtype=np.int64)
+        if len(counts) > 0 and counts.max() > num_agents - 1:
+            raise ValueError(f"Agents cannot have more than {num_agents - 1} friends")
+
+        max_count = counts.max() if len(counts) > 0 else 0
+        valid = np.arange(max_count) < counts[:, None]
+        draws = rng.integers(0, max(num_agents - 1, 1), size=(num_agents, max_count))
+
+        rows = np.arange(num_agents)
+        while len(rows) > 0:
+            # give unused entries distinct negative values, so that only used entries can be duplicates
+            row_draws = np.where(valid[rows], draws[rows], -1 - np.arange(max_count))
+            order = np.argsort(row_draws, axis=1, kind='stable')
+            sorted_draws = np.take_along_axis(row_draws, order, axis=1)
+
+            is_duplicate_sorted = np.zeros(row_draws.shape, dtype=bool)
+            is_duplicate_sorted[:, 1:] = sorted_draws[:, 1:] == sorted_draws[:, :-1]
+            is_duplicate = np.zeros(row_draws.shape, dtype=bool)
+            np.put_along_axis(is_duplicate, order, is_duplicate_sorted, axis=1)
+
+            has_duplicates = is_duplicate.any(axis=1)
+            rows, is_duplicate = rows[has_duplicates], is_duplicate[has_duplicates]
+            row_draws = draws[rows]
+            row_draws[is_duplicate] = rng.integers(0, num_agents - 1, size=is_duplicate.sum())
+            draws[rows] = row_draws
+
+        draws += draws >= np.arange(num_agents)[:, None]  # Agents cannot be friends with themselves
+
+        offsets = np.zeros(num_agents + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        return cls(offsets, draws[valid])
+
+    def __len__(self):
+        return len(self.Counts)
+
+    def FriendsOf(self, i):
+        return self.Ids[self.Offsets[i]:self.Offsets[i + 1]]
+
+    def Share(self, is_plan):
+        """
+        The share of each agent's friends for whom is_plan is True, as a sparse matrix-vector product over the
+        friendships. Agents without friends get 0.
+
+        :param is_plan: boolean array indexed by agent id, or (num_prices x num_agents) array of a batched Population
+        :return: array of shares, of the same shape
+        """
+        if is_plan.ndim == 2:
+            # one bincount over all prices, with the friendships of each price numbered after the previous price's
+            rows = (np.arange(is_plan.shape[0])[:, None] * len(self) + self.Rows).ravel()
+            totals = np.bincount(rows, weights=is_plan[:, self.Ids].ravel(), minlength=is_plan.size)
+            totals = totals.reshape(is_plan.shape)
+        else:
+            totals = np.bincount(self.Rows, weights=is_plan[self.Ids], minlength=len(self))
+        return np.divide(totals, self.Counts, out=np.zeros(totals.shape), where=self.Counts > 0)
+
+
+class Population:
+
+    def __init__(self, ids, a, b, mu, Y, p, delta, friend_index, history=None, incremental=False):
+        """
+        Initialises a Population object with the following attributes, one array entry per agent:
+
+        The budgets may also be a (num_prices x num_agents) array, for a Population simulated at several prices of
+        green delivery at once. Its state and History then have a row per price, the prices are passed to each round as
+        (num_prices x 1) arrays, and Batch gives the Population of one price.
+
+        :param ids:          Unique identifiers
+        :param a:            Preference for consumption (coefficient of ln[Q])
+        :param b:            Preference for savings (coefficient of ln[S])
+        :param mu:           Eco-consciousness
+        :param Y:            Disposable income
+        :param p:            Average price of e-commerce goods (shared by all agents)
+        :param delta:        Affinity towards friends' opinions
+        :param friend_index: FriendIndex of the agents' friends
+        :param history:      History to record periods in. If None, an empty History is created.
+        :param incremental:  If True, the compiled generic and social rounds only evaluate both plans of the agents
+                             whose choice may change (see Kernels.py). 'check' also evaluates every plan, and raises a
+                             ValueError if the choices or the records of the plans taken differ.
+        """
+        self.Id = np.asarray(ids, dtype=np.int64)
+        self.A = np.asarray(a, dtype=np.float64)
+        self.B = np.asarray(b, dtype=np.float64)
+        self.EcoCon = np.asarray(mu, dtype=np.float64)
+        self.Budget = np.array(Y, dtype=np.float64)
+        self.Delta = np.asarray(delta, dtype=np.float64)
+        self.Price = p
+        self.FriendIndex = friend_index
+
+        n = len(self.Id)
+
+        # Current period props
+        self.CurrentPlan = np.full(self.Budget.shape, PLAN_NORMAL, dtype=np.int8)
+        self.CurrentUtility = np.zeros(self.Budget.shape)
+
+        if history is None:
+            history = History(0, n, self.Budget.shape[0] if self.Budget.ndim == 2 else None)
+        self.History = history
+
+        # each plan's budget less its price of delivery, utility without the social effect and savings when it was last
+        # evaluated, with a row for the green plan and a row for the normal plan, and the price of the last round
+        self.Incremental = incremental
+        state_shape = (2,) + self.Budget.shape if incremental else (2, 0)
+        self.IncrementalNetBudget = np.full(state_shape, np.nan)
+        self.IncrementalUtility = np.full(state_shape, np.nan)
+        self.IncrementalSavings = np.full(state_shape, np.nan)
+        self.IncrementalPrice = None
+
+    def Batch(self, index):
+        """
+        The Population of the index-th price of a batched Population, whose state and History are views of its rows.
+        """
+        population = copy.copy(self)
+        population.Budget = self.Budget[index]
+        population.CurrentPlan = self.CurrentPlan[index]
+        population.CurrentUtility = self.CurrentUtility[index]
+        population.History = self.History.Batch(index)
+        if self.Incremental:
+            population.IncrementalNetBudget = self.IncrementalNetBudget[:, index]
+            population.IncrementalUtility = self.IncrementalUtility[:, index]
+            population.IncrementalSavings = self.IncrementalSavings[:, index]
+        return population
+
+    def batches(self):
+        """
+        The Populations of each price of a batched Population, or just this Population if it is not batched.
+        """
+        if self.Budget.ndim == 1:
+            return [self]
+        return [self.Batch(index) for index in range(len(self.Budget))]
+
+    def __len__(self):
+        return len(self.Id)
+
+    def EnterGenericRound(self, period, cG, cN, eG, eN, utility_handler):
+        green, normal = self.evaluate_green_normal(utility_handler, cG, cN, eG, eN)
+        self.assign_choice(period, green, normal, eG, eN)
+        self.assign_budget_and_utilities_disparity(period, green[0], normal[0])
+
+    def evaluate_green_normal(self, utility_handler, cG, cN, eG, eN):
+        """
+        :return: (utility, Q, S) arrays of the green plan, and of the normal plan
+        """
+        green = utility_handler.Optimum(self.A, self.B, self.EcoCon, self.Budget, self.Price, eG, cG)
+        normal = utility_handler.Optimum(self.A, self.B, self.EcoCon, self.Budget, self.Price, eN, cN)
+        return green, normal
+
+    def assign_choice(self, period, green, normal, eG, eN):
+        """
+        Records the plan, Q, S and emissions of every agent, given the (utility, Q, S) arrays of each plan. Agents take
+        the green plan if its utility is higher.
+        """
+        green_is_better = green[0] > normal[0]
+        e_rate = np.where(green_is_better, eG, eN)
+        q = np.where(green_is_better, green[1], normal[1])
+        s = np.where(green_is_better, green[2], normal[2])
+
+        row = self.History.Row(period)
+        self.CurrentPlan = np.where(green_is_better, PLAN_GREEN, PLAN_NORMAL).astype(np.int8)
+        self.History.PlanRecords[row] = self.CurrentPlan
+        self.History.Qrecords[row] = q
+        self.History.Srecords[row] = s
+        # divide 1000 for kg instead of g of CO2
+        self.History.Erecords[row] = q * e_rate * Constants.CO2PerDollar() * self.Price / 1000
+
+    def assign_budget_and_utilities_disparity(self, period, util_green, util_normal):
+        """
+        Record the agents' budgets, their utilities from choosing green or normal, and the difference between these two
+        utilities (util_green - util_normal). The chosen utility becomes the agents' current utility.
+        """
+        row = self.History.Row(period)
+        self.History.BudgetHistory[row] = self.Budget
+        self.History.GreenUtility[row] = util_green
+        self.History.NormalUtility[row] = util_normal
+        self.History.UtilityDisparity[row] = util_green - util_normal
+        self.CurrentUtility = np.where(self.CurrentPlan == PLAN_GREEN, util_green, util_normal)
+
+    def EnterSocialRound(self, period, cG, cN, eG, eN, utility_handler):
+        green, normal = self.evaluate_green_normal_social(utility_handler, cG, cN, eG, eN, period)
+        self.assign_choice(period, green, normal, eG, eN)
+        self.assign_budget_and_utilities_disparity(period, green[0], normal[0])
+
+    def evaluate_green_normal_social(self, utility_handler, cG, cN, eG, eN, period):
+        """
+        :return: (utility, Q, S) arrays of the green plan, and of the normal plan
+        """
+        previous_plans = self.History.PlanRecords[self.History.Row(period - 1)]
+        green = utility_handler.OptimumSocial(self.A, self.B, self.EcoCon, self.Budget, self.Price, eG, cG,
+                                              self.Delta, self.FriendIndex.Share(previous_plans == PLAN_GREEN))
+        normal = utility_handler.OptimumSocial(self.A, self.B, self.EcoCon, self.Budget, self.Price, eN, cN,
+                                               self.Delta, self.FriendIndex.Share(previous_plans == PLAN_NORMAL))
+        return green, normal
+
+    def EnterBenchMarkRound(self, period, cN, eN, utility_handler):
+        util_normal, q, s = utility_handler.Optimum(self.A, self.B, self.EcoCon, self.Budget, self.Price, eN, cN)
+        takes_normal = util_normal > 0
+
+        row = self.History.Row(period)
+        self.CurrentPlan = np.where(takes_normal, PLAN_NORMAL, PLAN_NONE).astype(np.int8)
+        q = np.where(takes_normal, q, 0)
+        self.History.PlanRecords[row] = self.CurrentPlan
+        self.History.Qrecords[row] = q
+        self.History.Srecords[row] = np.where(takes_normal, s, self.Budget)
+        self.History.Erecords[row] = q * eN * Constants.CO2PerDollar() * self.Price / 1000
+
+        self.History.BudgetHistory[row] = self.Budget
+        self.History.GreenUtility[row] = 0
+        self.History.NormalUtility[row] = util_normal
+        self.History.UtilityDisparity[row] = -util_normal
+        self.CurrentUtility = util_normal
+
+    def EnterGenericRoundCompiled(self, period, cG, cN, eG, eN, update_budget=True):
+        """
+        EnterGenericRound from the closed-form optimum, followed by UpdateBudget(period) if update_budget is set, in
+        one compiled loop per price (see Kernels.py).
+        """
+        fraction_of_savings = Constants.FractionOfSavings() if update_budget else 0.0
+        row = self.History.Row(period)
+        refresh = self.incremental_refresh() if self.Incremental else True
+        for population, batch_cG, batch_cN in self.batch_prices(cG, cN):
+            # previous plans are not read in generic rounds
+            population.choice_period(period, eG, eN, batch_cG, batch_cN, False, population.History.PlanRecords[row],
+                                     None, fraction_of_savings, refresh)
+
+    def EnterSocialRoundCompiled(self, period, cG, cN, eG, eN):
+        """
+        EnterSocialRound from the closed-form optimum, followed by UpdateBudget(period - 1), in one compiled loop per
+        price (see Kernels.py).
+        """
+        previous_row = self.History.Row(period - 1)
+        refresh = self.incremental_refresh() if self.Incremental else True
+        for population, batch_cG, batch_cN in self.batch_prices(cG, cN):
+            population.choice_period(period, eG, eN, batch_cG, batch_cN, True,
+                                     population.History.PlanRecords[previous_row],
+                                     population.History.Srecords[previous_row], Constants.FractionOfSavings(), refresh)
+
+    def incremental_refresh(self):
+        """
+        Whether every plan must be evaluated in an incremental round: in the first, and once the price of the average
+        good has changed, as the bounds only hold at the same price. Records the price of this round.
+        """
+        refresh = self.IncrementalPrice is None or self.IncrementalPrice != self.Price
+        self.IncrementalPrice = self.Price
+        return refresh
+
+    def choice_period(self, period, eG, eN, cG, cN, social, previous_plans, savings, fraction_of_savings, refresh):
+        """
+        Runs the choice_period kernel for a Population of one price. In the 'check' incremental mode, the kernel is also
+        run without incremental evaluation on copies of the state, and the records compared (see check_incremental).
+
+        :param savings: savings added to the budgets, or None for those of this period
+        :param refresh: If True, an incremental round evaluates every plan
+        """
+        from Kernels import choice_period  # numba is only imported when the kernels are used
+
+        rows = self.period_rows(period)
+        if self.Incremental == 'check':
+            expected_budget = self.Budget.copy()
+            expected_rows = tuple(row.copy() for row in rows)
+            unused_state = np.empty((2, 0))
+            choice_period(self.A, self.B, self.EcoCon, self.Delta, expected_budget, self.Price, eG, eN, cG, cN, social,
+                          self.FriendIndex.Offsets, self.FriendIndex.Ids, previous_plans,
+                          expected_rows[2] if savings is None else savings, fraction_of_savings,
+                          Constants.CO2PerDollar(), False, True, 0.0, unused_state, unused_state, unused_state,
+                          *expected_rows)
+
+        evaluated = choice_period(self.A, self.B, self.EcoCon, self.Delta, self.Budget, self.Price, eG, eN, cG, cN,
+                                  social, self.FriendIndex.Offsets, self.FriendIndex.Ids, previous_plans,
+                                  rows[2] if savings is None else savings, fraction_of_savings,
+                                  Constants.CO2PerDollar(), bool(self.Incremental), refresh,
+                                  Constants.IncrementalTolerance(), self.IncrementalNetBudget, self.IncrementalUtility,
+                                  self.IncrementalSavings, *rows)
+
+        if self.Incremental:
+            count_event('incremental.evaluated', evaluated)
+            count_event('incremental.skipped', 2 * len(self) - evaluated)
+        if self.Incremental == 'check':
+            names = ('Plan', 'Q', 'S', 'Emissions', 'Utility')
+            indices = (0, 1, 2, 7, 9)
+            check_incremental(dict({name: rows[index] for name, index in zip(names, indices)}, Budget=self.Budget),
+                              dict({name: expected_rows[index] for name, index in zip(names, indices)},
+                                   Budget=expected_budget))
+
+    def EnterBenchMarkRoundCompiled(self, period, cN, eN):
+        """
+        EnterBenchMarkRound from the closed-form optimum, followed by UpdateBudget(period), in one compiled loop per
+        price (see Kernels.py).
+        """
+        from Kernels import benchmark_period
+
+        for population, batch_cG, batch_cN in self.batch_prices(0, cN):
+            benchmark_period(population.A, population.B, population.EcoCon, population.Budget, population.Price, eN,
+                             batch_cN, Constants.FractionOfSavings(), Constants.CO2PerDollar(),
+                             *population.period_rows(period))
+
+    def batch_prices(self, cG, cN):
+        """
+        The Population of each price, with its prices of green and normal delivery as scalars.
+        """
+        populations = self.batches()
+        shape = (len(populations), 1)
+        return zip(populations, np.broadcast_to(cG, shape).ravel(), np.broadcast_to(cN, shape).ravel())
+
+    def period_rows(self, period):
+        """
+        The History rows of a period and the current plan and utility arrays, in the order the kernels take them.
+        """
+        history = self.History
+        row = history.Row(period)
+        return (history.PlanRecords[row], history.Qrecords[row], history.Srecords[row], history.BudgetHistory[row],
+                history.GreenUtility[row], history.NormalUtility[row], history.UtilityDisparity[row],
+                history.Erecords[row], self.CurrentPlan, self.CurrentUtility)
+
+    def UpdateBudget(self, period):
+        # add savings
+        self.Budget = self.Budget + Constants.FractionOfSavings() * self.History.Srecords[self.History.Row(period)]
+
+
+def check_incremental(records, expected_records):
+    """
+    Raises a ValueError if the records of an incremental round differ from those of a full evaluation: the plans
+    exactly, and the other records to a relative 1e-12.
+
+    :param records:          dict of arrays of the incremental round: 'Plan', and records of the plans taken
+    :param expected_records: dict of the same arrays from the full evaluation
+    """
+    for name, values in records.items():
+        expected = expected_records[name]
+        if name == 'Plan':
+            same = np.array_equal(values, expected)
+        else:
+            same = np.allclose(values, expected, rtol=1e-12, atol=0, equal_nan=True)
+        if not same:
+            raise ValueError(f"Incremental evaluation gives different {name} records from a full evaluation")
@@ -0,0 +1,187 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ResultCache.py:
+
+This file stores the ResultCache class, a content-addressed cache of the results of the Engine's runs on disk, so that
+repeating a run (in another notebook session, or when a sweep is retried) loads its results instead of simulating it.
+
+Each cached run is a pickle file named by its key, the hash of everything the run depends on (see result_key): the
+agents' parameters and budgets, the prices, the Engine's settings, the state of its random number generator, the run
+method and its arguments. The file holds the run's results and the state the run left the Engine in. The agent samples
+of the results which are spooled to disk (see AggregationManager.AgentSampleSpool) are moved into a directory next to
+it, result_{key}.samples, and are evicted with it.
+
+The cache is bounded by its total size in bytes: once it is exceeded, the least recently used results are evicted.
+Loading a result marks it as used by touching its file. Hits and misses are counted in the instrumentation registry
+(result_cache.hits and result_cache.misses), whether or not instrumentation is enabled.
+"""
+
+import functools
+import glob
+import hashlib
+import inspect
+import json
+import os
+import pickle
+
+import shutil
+
+import numpy as np
+
+from AggregationManager import *
+from Checkpoint import *
+from Instrumentation import *
+
+# Changes with the simulation's code, so that results cached by an earlier version are not used
+RESULT_CACHE_VERSION = 1
+
+
+class ResultCache:
+
+    def __init__(self, directory, max_size=None):
+        """
+        :param directory: directory of the cached results
+        :param max_size:  largest total size of the cached results, in bytes. None never evicts results.
+        """
+        self.Directory = directory
+        self.MaxSize = max_size
+        self.Hits = 0
+        self.Misses = 0
+
+    def FilePath(self, key):
+        return os.path.join(self.Directory, f'result_{key}.pkl')
+
+    def SpoolPath(self, filepath):
+        """
+        :param filepath: path of a cached result
+        :return: directory of the spooled agent samples of the result
+        """
+        return filepath[:-len('.pkl')] + '.samples'
+
+    def Load(self, key):
+        """
+        :return: the entry cached under key, or None
+        """
+        filepath = self.FilePath(key)
+        try:
+            entry = read_pickle(filepath)
+            os.utime(filepath)  # most recently used
+        except FileNotFoundError:
+            entry = None
+        except (EOFError, pickle.UnpicklingError):
+            entry = None  # evicted by another process while being read
+        if entry is not None and not all(spool.Exists() for spool in agent_sample_spools(entry)):
+            entry = None  # spooled agent samples evicted by another process
+
+        if entry is None:
+            self.Misses += 1
+            REGISTRY.Count('result_cache.misses')
+        else:
+            self.Hits += 1
+            REGISTRY.Count('result_cache.hits')
+        return entry
+
+    def Store(self, key, entry):
+        """
+        Caches entry under key, then evicts the least recently used results beyond MaxSize.
+        """
+        for number, spool in enumerate(agent_sample_spools(entry)):
+            spool.Move(os.path.join(self.SpoolPath(self.FilePath(key)), f'{number:06d}'))
+
+        write_pickle(self.FilePath(key), entry)
+
+        self.Evict()
+
+    def Evict(self):
+        if self.MaxSize is None:
+            return
+
+        files = []
+        for filepath in glob.glob(os.path.join(glob.escape(self.Directory), 'result_*.pkl')):
+            try:
+                stat = os.stat(filepath)
+            except FileNotFoundError:
+                continue
+            size = stat.st_size
+            for directory, subdirectories, filenames in os.walk(self.SpoolPath(filepath)):
+                size += sum(os.path.getsize(os.path.join(directory, filename)) for filename in filenames)
+            files.append((stat.st_mtime, size, filepath))
+
+        total_size = sum(size for mtime, size, filepath in files)
+        for mtime, size, filepath in sorted(files):
+            if total_size <= self.MaxSize:
+                break
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                pass
+            shutil.rmtree(self.SpoolPath(filepath), ignore_errors=True)
+            total_size -= size
+
+    def Clear(self):
+        for filepath in glob.glob(os.path.join(glob.escape(self.Directory), 'result_*.pkl')):
+            os.remove(filepath)
+            shutil.rmtree(self.SpoolPath(filepath), ignore_errors=True)
+
+
+def result_cached(simulation_type=None):
+    """
+    Decorates a run method of the Engine, so that its results are loaded from the Engine's ResultCache if the same run
+    was cached from the same state (see Engine.RunKey). Runs are cached before their statistics are saved, so save is
+    not part of the key. Engines without a ResultCache, or with observers, which must see every period, always run.
+
+    :param simulation_type: simulation type of the run method, or None for RunAll, whose results are by simulation type
+    """
+    def decorator(run):
+        signature = inspect.signature(run)
+
+        @functools.wraps(run)
+        def wrapper(engine, *args, **kwargs):
+            if engine.ResultCache is None or engine.Observers:
+                return run(engine, *args, **kwargs)
+
+            arguments = signature.bind(engine, *args, **kwargs)
+            arguments.apply_defaults()
+            arguments = dict(list(arguments.arguments.items())[1:])  # without the Engine
+            save = arguments.pop('save')
+
+            key = engine.RunKey(run.__name__, arguments)
+            entry = engine.ResultCache.Load(key)
+            if entry is None:
+                # large agent samples are spooled rather than dropped, so that the cached results can be saved
+                spool_agent_samples = engine.SpoolAgentSamples
+                engine.SpoolAgentSamples = True
+                try:
+                    results = run(engine, save=False, **arguments)
+                finally:
+                    engine.SpoolAgentSamples = spool_agent_samples
+                engine.ResultCache.Store(key, {'results': results, 'state': engine.RunState()})
+            else:
+                log_message(f"\nResults of {run.__name__} loaded from the result cache")
+                results = entry['results']
+                engine.RestoreRunState(entry['state'])
+
+            if save:
+                type_results = results if simulation_type is None else {simulation_type: results}
+                for type, result in type_results.items():
+                    engine.SaveRun(type, result)
+            return results
+        return wrapper
+    return decorator
+
+
+def result_key(arrays, values):
+    """
+    Hash of arrays and JSON serialisable values, used as the key of a cached result.
+
+    :param arrays: dict of numpy arrays
+    :param values: dict of values
+    """
+    digest = hashlib.sha1(f'{RESULT_CACHE_VERSION}'.encode('utf-8'))
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        digest.update(f'{name}:{array.dtype.str}:{array.shape}'.encode('utf-8'))
+        digest.update(array.data)
+    digest.update(json.dumps(values, sort_keys=True, default=repr).encode('utf-8'))
+    return digest.hexdigest()
@@ -0,0 +1,229 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ResultSink.py:
+
+This file stores the ResultSink class, which appends simulation statistics to ./SavedStats, and the readers and writers
+of the output formats.
+
+In the default 'csv' format, statistics go to ./SavedStats/{type}_simulation.csv and only the new rows are written. The
+next simulation index of each file is kept in a small sidecar file next to it ({type}_simulation.csv.next), so the
+existing rows are never read back. Processes running in parallel each write to their own shard file, and the shards
+are merged into the main file at the end, in the order of their names.
+
+The columnar formats ('parquet', 'feather' and 'npz') write a dataset directory per simulation type instead, partitioned
+by price of green delivery, with one file per simulation:
+
+    ./SavedStats/{type}_simulation/PriceOfGreenDelivery={cG}/part-{SimulationIndex}.{format}
+
+Parquet and Feather need pyarrow to be installed; npz only needs numpy.
+"""
+
+import glob
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from Instrumentation import *
+
+OUTPUT_FORMATS = ('csv', 'parquet', 'feather', 'npz')
+
+
+class ResultSink:
+
+    def __init__(self, directory='./SavedStats', shard=None, output_format='csv'):
+        """
+        :param directory:     directory of the saved statistics
+        :param shard:         If given, statistics are appended to the shard {type}_simulation.shard-{shard} instead of
+                              the main file or dataset, see MergeShards
+        :param output_format: 'csv', 'parquet', 'feather' or 'npz'
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format {output_format}")
+
+        self.Directory = directory
+        self.Shard = shard
+        self.OutputFormat = output_format
+
+    def FilePath(self, type, shard=None):
+        """
+        :return: path of the csv file, or of the dataset directory for the columnar formats
+        """
+        name = f'{type}_simulation' if shard is None else f'{type}_simulation.shard-{shard}'
+        if self.OutputFormat == 'csv':
+            name += '.csv'
+        return os.path.join(self.Directory, name)
+
+    def AppendSimulation(self, df, type):
+        """
+        Appends the statistics of one simulation under the next simulation index of the file.
+
+        :param df:   statistics from AggregationManager.SimulationStats
+        :param type: simulation type
+        :return: the simulation index
+        """
+        filepath = self.FilePath(type, self.Shard)
+        simulation_index = self.ReserveIndices(filepath, 1)
+
+        df['SimulationIndex'] = [simulation_index for i in range(len(df))]
+        self.append_rows(df, filepath, simulation_index)
+        return simulation_index
+
+    @instrumented('output.merge')
+    def MergeShards(self, type, prefix=''):
+        """
+        Appends the shards of a simulation type whose shard name starts with prefix to the main file, in order of their
+        names, renumbering their simulation indices to follow on from the main file. Merged shards are deleted.
+
+        :param type:   simulation type
+        :param prefix: shard name prefix
+        :return: number of simulations merged
+        """
+        filepath = self.FilePath(type)
+        shard_paths = sorted(path for path in glob.glob(self.FilePath(type, glob.escape(prefix) + '*'))
+                             if not path.endswith('.next'))
+
+        merged = 0
+        for shard_path in shard_paths:
+            if self.OutputFormat == 'csv':
+                parts = [pd.read_csv(shard_path)]
+            else:
+                parts = [read_frame(path) for path in dataset_files(shard_path)]
+            shard_indices = sorted(set(index for df in parts for index in df['SimulationIndex'].unique()))
+
+            first_index = self.ReserveIndices(filepath, len(shard_indices))
+            new_indices = {index: first_index + i for i, index in enumerate(shard_indices)}
+            for df in parts:
+                df['SimulationIndex'] = df['SimulationIndex'].map(new_indices)
+                self.append_rows(df, filepath, df['SimulationIndex'].iloc[0])
+            merged += len(shard_indices)
+
+            self.remove_path(shard_path)
+
+        return merged
+
+    def RemoveShard(self, type, shard):
+        """
+        Deletes a shard of a simulation type, such as one left partly written by an interrupted process.
+        """
+        self.remove_path(self.FilePath(type, shard))
+
+    def remove_path(self, filepath):
+        if os.path.isdir(filepath):
+            shutil.rmtree(filepath)
+        elif os.path.exists(filepath):
+            os.remove(filepath)
+        if os.path.exists(self.sidecar_path(filepath)):
+            os.remove(self.sidecar_path(filepath))
+
+    def ReserveIndices(self, filepath, count):
+        """
+        Returns the next simulation index of a file, and moves it on by count. The sidecar is updated before any rows
+        are written, so that an interrupted write leaves a gap in the indices rather than a repeated index.
+        """
+        next_index = self.next_index(filepath)
+
+        os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+        with open(self.sidecar_path(filepath), 'w') as f:
+            f.write(str(next_index + count))
+
+        return next_index
+
+    def next_index(self, filepath):
+        if not os.path.exists(filepath):
+            return 0
+
+        if os.path.exists(self.sidecar_path(filepath)):
+            with open(self.sidecar_path(filepath), 'r') as f:
+                return int(f.read())
+
+        # files written before sidecars were kept are read once
+        if os.path.isdir(filepath):
+            existing_index = [int(os.path.splitext(os.path.basename(path))[0][len('part-'):])
+                              for path in dataset_files(filepath)]
+        else:
+            existing_index = pd.read_csv(filepath, usecols=['SimulationIndex'])['SimulationIndex']
+        return int(max(existing_index)) + 1 if len(existing_index) > 0 else 0
+
+    def sidecar_path(self, filepath):
+        return f'{filepath}.next'
+
+    def append_rows(self, df, filepath, simulation_index):
+        if self.OutputFormat == 'csv':
+            file_exists = os.path.exists(filepath)
+            df.to_csv(filepath, mode='a', header=not file_exists, index=False)
+            return
+
+        for price, partition in df.groupby('PriceOfGreenDelivery', sort=False):
+            write_frame(partition, os.path.join(partition_path(filepath, price), f'part-{simulation_index:06d}'),
+                        self.OutputFormat)
+
+
+def partition_path(dataset, price):
+    """
+    :return: directory of the price of green delivery partition of a dataset
+    """
+    return os.path.join(dataset, f'PriceOfGreenDelivery={price}')
+
+
+def dataset_files(dataset, prices=None):
+    """
+    Files of a dataset directory, ordered by partition and name.
+
+    :param dataset: dataset directory
+    :param prices:  If given, only the partitions of these prices of green delivery
+    """
+    if prices is None:
+        partitions = sorted(glob.glob(os.path.join(glob.escape(dataset), 'PriceOfGreenDelivery=*')))
+    else:
+        partitions = [partition_path(dataset, price) for price in prices]
+
+    files = []
+    for partition in partitions:
+        files += sorted(path for path in glob.glob(os.path.join(glob.escape(partition), '*'))
+                        if os.path.splitext(path)[1][1:] in OUTPUT_FORMATS)
+    return files
+
+
+def write_frame(df, path, output_format):
+    """
+    Writes a dataframe to path.{output_format}, replacing any previous file. The file is written to a temporary name
+    first, so that readers never see a partly written file.
+    """
+    filepath = f'{path}.{output_format}'
+    tmp_path = f'{path}.tmp'
+    os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+
+    df = df.reset_index(drop=True)
+    if output_format == 'parquet':
+        df.to_parquet(tmp_path, index=False)
+    elif output_format == 'feather':
+        df.to_feather(tmp_path)
+    elif output_format == 'npz':
+        with open(tmp_path, 'wb') as f:
+            # object columns (the plan names) are stored as fixed width strings, so no pickling is needed
+            np.savez_compressed(f, **{column: (df[column].to_numpy().astype(str) if df[column].dtype == object
+                                               else df[column].to_numpy()) for column in df.columns})
+    else:
+        df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, filepath)
+
+
+def read_frame(filepath, columns=None):
+    """
+    Reads a file written by write_frame, or a csv file.
+
+    :param columns: If given, only these columns are read
+    """
+    output_format = os.path.splitext(filepath)[1][1:]
+    if output_format == 'parquet':
+        return pd.read_parquet(filepath, columns=columns)
+    elif output_format == 'feather':
+        return pd.read_feather(filepath, columns=columns)
+    elif output_format == 'npz':
+        with np.load(filepath, allow_pickle=False) as f:
+            # members of the archive are only decompressed when accessed
+            return pd.DataFrame({column: f[column] for column in (columns or f.files)})
+    return pd.read_csv(filepath, usecols=columns)
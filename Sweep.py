@@ -0,0 +1,360 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sweep.py:
+
+This file runs Monte Carlo sweeps over prices of green delivery and simulation types. Each (replication, price) task
+runs every simulation type side by side (see Engine.RunAll) in a worker process of a ProcessPoolExecutor. If the
+Engines are vectorized, the prices can also be batched, so that each replication is one task which simulates every
+price at once. Workers are sent the agent parameter arrays of their replication rather than a pickled Engine. Each task
+appends its simulation statistics to a ResultSink shard per price, and the shards are merged in (replication, price)
+order at the end of the sweep.
+
+Each simulation type only depends on some of the Engine's parameters (see MODE_PARAMETERS), and is simulated once per
+replication for each distinct value of them, its scenario. The results of the other prices of a scenario are copies of
+its simulation's results, labelled with their price: the benchmark simulation, which does not depend on the price of
+green delivery, is simulated once per replication rather than at every price.
+
+With a checkpoint_dir, the results of every completed task are saved as they come in, and the tasks' Engines save
+checkpoints of their runs (see Checkpoint.py). An interrupted sweep is continued with resume_sweep, which skips the
+completed tasks and continues interrupted runs from their last checkpoint.
+
+Random numbers come from independent streams spawned from one numpy SeedSequence: stream (r, 0) generates the agents of
+replication r and stream (r, k) is used by its k-th task, so a sweep with a given seed gives identical results whatever
+the number of workers.
+"""
+
+import os
+import shutil
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from Engine import *
+
+# Engine parameters the simulation of each type depends on, besides the agents and the number of periods. The
+# benchmark simulation never offers green delivery, so it depends on neither its price cG nor its emissions eG.
+MODE_PARAMETERS = {
+    'benchmark': ('price', 'cN', 'eN', 'inflation_rate'),
+    'normal': ('price', 'cG', 'cN', 'eG', 'eN', 'inflation_rate'),
+    'social': ('price', 'cG', 'cN', 'eG', 'eN', 'inflation_rate')
+}
+
+
+def run_sweep(config, prices, replications, modes=('benchmark', 'normal', 'social'), periods=24, workers=None,
+              save=True, seed=None, batch_prices=False, checkpoint_dir=None, sweep_id=None, first_replication=0):
+    """
+    Runs every simulation type in modes, at every price of green delivery in prices, for a number of replications.
+    Each replication generates one population of agents, which every task of that replication starts from.
+
+    :param config:       dict of Engine keyword arguments (num_agents, price, a_params, ...). Its cG is replaced by
+                         each price in prices.
+    :param prices:       prices of green delivery to simulate
+    :param replications: number of Monte Carlo replications
+    :param modes:        simulation types to run, any of 'benchmark', 'normal' and 'social'
+    :param periods:      number of periods for each simulation
+    :param workers:      number of worker processes. None uses every CPU, 1 runs all tasks in this process.
+    :param save:         If True, the statistics are saved to ./SavedStats in (replication, price, mode) order
+    :param seed:         Seed of the sweep's SeedSequence. If None, fresh entropy is drawn and logged, so that the
+                         sweep can be reproduced.
+    :param batch_prices: If True and config is vectorized, each replication simulates every price at once, in one
+                         task per group of simulation types with the same scenarios. Otherwise, each (replication,
+                         price) is a task.
+    :param checkpoint_dir: If given, the sweep's checkpoints are saved in this directory, so that it can be continued
+                         with resume_sweep if it is interrupted. They are deleted once the sweep is complete.
+    :param sweep_id:     name of the sweep's shards. None draws a new one, or takes that of the sweep being resumed.
+    :param first_replication: number of the first replication, so that sweeps with the same seed can run further
+                         replications (see AdaptiveSweep.py)
+    :return: list of (replication, price, mode, simulation statistics, agent sample), in the same order. Agent samples
+             of more than AGENT_CHUNK_SIZE agents are AgentSampleSpools, or None once saved.
+    """
+    root_seed = np.random.SeedSequence(seed)
+    if seed is None:
+        log_message(f"Sweep seed: {root_seed.entropy}")
+
+    tasks = [(replication, cG, task_modes, fan_out)
+             for replication in range(first_replication, first_replication + replications)
+             for cG, task_modes, fan_out in plan_tasks(config, prices, modes,
+                                                       batch_prices and config.get('vectorized', False))]
+    if sweep_id is None and save:
+        sweep_id = uuid.uuid4().hex[:8]
+
+    results = [None] * len(tasks)
+    task_config = config
+    if checkpoint_dir is not None:
+        results, sweep_id = start_checkpoints(checkpoint_dir, tasks, dict(
+            config=config, prices=list(prices), replications=replications, modes=tuple(modes), periods=periods,
+            save=save, seed=root_seed.entropy, batch_prices=batch_prices, sweep_id=sweep_id,
+            first_replication=first_replication))
+        task_config = dict(config, checkpoint_dir=os.path.join(checkpoint_dir, 'runs'))
+    arguments = [task_args for task_number, task_args in
+                 enumerate(task_arguments(task_config, tasks, root_seed, periods, sweep_id))
+                 if results[task_number] is None]
+    pending = [task_number for task_number, task_results in enumerate(results) if task_results is None]
+
+    def complete(task_number, task_results):
+        results[task_number] = task_results
+        if checkpoint_dir is not None:
+            write_pickle(task_checkpoint_path(checkpoint_dir, task_number), task_results)
+
+    if workers == 1:
+        for task_number, task_args in zip(pending, arguments):
+            complete(task_number, run_task(*task_args))
+    else:
+        # workers take this process's instrumentation settings, and send back what they record in each task
+        with ProcessPoolExecutor(workers, initializer=initialize_worker,
+                                 initargs=(Instrumentation.Enabled, Instrumentation.Quiet)) as executor:
+            futures = {executor.submit(run_worker_task, *task_args): task_number
+                       for task_number, task_args in zip(pending, arguments)}
+            for future in as_completed(futures):
+                task_results, registry = future.result()
+                REGISTRY.Merge(registry)
+                complete(futures[future], task_results)
+
+    # each task returns its results by mode, then by price. They are put back in (replication, price, mode) order.
+    mode_order = {mode: number for number, mode in enumerate(modes)}
+    keyed_results = []
+    for (replication, task_prices, task_modes, fan_out), task_results in zip(tasks, results):
+        positions = [position for mode in task_modes for position, price, index in fan_out[mode]]
+        for position, (cG, mode, simulation_stats, agent_sample) in zip(positions, task_results):
+            keyed_results.append(((replication, position, mode_order[mode]),
+                                  (replication, cG, mode, simulation_stats, agent_sample)))
+    results = [result for key, result in sorted(keyed_results, key=lambda item: item[0])]
+
+    if save:
+        results = remove_spools(save_results(config, results, sweep_id))
+    if checkpoint_dir is not None:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+    return results
+
+
+def resume_sweep(checkpoint_dir, workers=None):
+    """
+    Continues a sweep started by run_sweep with checkpoint_dir which was interrupted, with the same arguments and seed.
+    Completed tasks are not run again, and interrupted runs continue from their last checkpoint.
+
+    :param checkpoint_dir: checkpoint_dir of the interrupted sweep
+    :param workers:        number of worker processes, see run_sweep
+    :return: the results of run_sweep
+    """
+    sweep_path = os.path.join(checkpoint_dir, 'sweep.pkl')
+    if not os.path.exists(sweep_path):
+        raise ValueError(f"No interrupted sweep to resume in {checkpoint_dir}")
+
+    arguments = read_pickle(sweep_path)
+    log_message(f"Resuming the sweep in {checkpoint_dir}")
+    return run_sweep(**arguments, workers=workers, checkpoint_dir=checkpoint_dir)
+
+
+def start_checkpoints(checkpoint_dir, tasks, arguments):
+    """
+    Saves the arguments of a sweep in checkpoint_dir, or, if the same sweep was interrupted, loads the results of its
+    completed tasks, and deletes the shards that its other tasks may have partly written.
+
+    :param tasks:     the sweep's tasks
+    :param arguments: run_sweep arguments of the sweep
+    :return: list of the results of each task, None for tasks still to run, and the sweep_id of the sweep
+    """
+    sweep_path = os.path.join(checkpoint_dir, 'sweep.pkl')
+    if not os.path.exists(sweep_path):
+        write_pickle(sweep_path, arguments)
+        return [None] * len(tasks), arguments['sweep_id']
+
+    saved_arguments = read_pickle(sweep_path)
+    if dict(saved_arguments, sweep_id=None) != dict(arguments, sweep_id=None):
+        raise ValueError(f"{checkpoint_dir} holds the checkpoints of another sweep: continue it with resume_sweep, or "
+                         f"delete it")
+    arguments = saved_arguments
+
+    results = []
+    for task_number, (replication, cG, task_modes, fan_out) in enumerate(tasks):
+        if os.path.exists(task_checkpoint_path(checkpoint_dir, task_number)):
+            results.append(read_pickle(task_checkpoint_path(checkpoint_dir, task_number)))
+            continue
+
+        results.append(None)
+        if arguments['sweep_id'] is not None:
+            result_sink = ResultSink(output_format=arguments['config'].get('output_format', 'csv'))
+            for mode in task_modes:
+                for position, price, index in fan_out[mode]:
+                    result_sink.RemoveShard(mode, f"{arguments['sweep_id']}-{replication:06d}-{position:06d}")
+    return results, arguments['sweep_id']
+
+
+def task_checkpoint_path(checkpoint_dir, task_number):
+    return os.path.join(checkpoint_dir, f'task-{task_number:06d}.pkl')
+
+
+def plan_tasks(config, prices, modes, batch_prices=False):
+    """
+    The tasks of a replication. Each simulation type in modes is simulated once for each of its scenarios, at the first
+    price of the scenario, and its results for the scenario's other prices are copies of those of that simulation.
+
+    :param config:       dict of Engine keyword arguments
+    :param prices:       prices of green delivery of the sweep
+    :param modes:        simulation types of the sweep
+    :param batch_prices: If True, each task simulates a list of prices at once, with every simulation type that has
+                         the same scenarios. Otherwise, each task simulates one price.
+    :return: list of (price or list of prices, modes, fan_out) tasks, where fan_out maps each mode of the task to the
+             (position in prices, price, index of the simulated price in the task) of each of its results, in order of
+             position
+    """
+    # position in prices of the simulated price of the scenario of each price, by mode
+    simulated_positions = {}
+    for mode in modes:
+        scenarios = {}
+        simulated_positions[mode] = [scenarios.setdefault(scenario_key(config, mode, cG), position)
+                                     for position, cG in enumerate(prices)]
+
+    # the simulated positions of each task, and its modes
+    if batch_prices:
+        groups = {}
+        for mode in modes:
+            groups.setdefault(tuple(dict.fromkeys(simulated_positions[mode])), []).append(mode)
+        task_positions = list(groups.items())
+    else:
+        task_positions = [((position,), [mode for mode in modes if position in simulated_positions[mode]])
+                          for position in range(len(prices))]
+
+    tasks = []
+    for positions, task_modes in task_positions:
+        if not task_modes:
+            continue
+
+        fan_out = {mode: [(position, prices[position], positions.index(simulated_position))
+                          for position, simulated_position in enumerate(simulated_positions[mode])
+                          if simulated_position in positions]
+                   for mode in task_modes}
+        cG = [prices[position] for position in positions] if batch_prices else prices[positions[0]]
+        tasks.append((cG, task_modes, fan_out))
+    return tasks
+
+
+def scenario_key(config, mode, cG):
+    """
+    The values of the parameters the simulation type mode depends on, at a price of green delivery cG.
+    """
+    parameters = dict(config, cG=cG)
+    return tuple(repr(parameters.get(name)) for name in MODE_PARAMETERS[mode])
+
+
+def task_arguments(config, tasks, root_seed, periods, sweep_id):
+    """
+    Yields the run_task arguments of each task, generating the agents of each replication once. If sweep_id is given,
+    the tasks of replication r save to the shards {sweep_id}-{r}-{position of the price}.
+    """
+    replication_parameters = {}
+    task_numbers = {}
+    for replication, cG, task_modes, fan_out in tasks:
+        if replication not in replication_parameters:
+            generation_seed = task_seed(root_seed, replication, 0)
+            replication_parameters = {replication: Engine(**dict(config, seed=generation_seed)).AgentParameters()}
+        task_numbers[replication] = task_numbers.get(replication, 0) + 1
+
+        shard = None if sweep_id is None else f"{sweep_id}-{replication:06d}"
+
+        yield (config, replication_parameters[replication], cG, task_modes, periods,
+               task_seed(root_seed, replication, task_numbers[replication]), shard, fan_out)
+
+
+def task_seed(root_seed, replication, number):
+    """
+    The SeedSequence that root_seed.spawn would give as child number of the replication-th child.
+    """
+    return np.random.SeedSequence(root_seed.entropy, spawn_key=root_seed.spawn_key + (replication, number))
+
+
+def run_task(config, agent_parameters, cG, modes, periods, seed, shard=None, fan_out=None):
+    """
+    Runs the simulations of every simulation type in modes from agent parameters, at a price of green delivery cG or
+    at each price in a list cG. If shard is given, the simulation statistics of each price are appended to the
+    ResultSink shard {shard}-{position of the price}.
+
+    :param fan_out: dict of the (position, price, index of the simulated price in cG) of each result of each mode, see
+                    plan_tasks. A result at another price than the simulated one is a copy of the simulation's results
+                    with that price. By default, each mode has one result per simulated price, at its index.
+    :return: list of (price, mode, simulation statistics, agent sample), by mode then by price
+    """
+    engine = Engine(**dict(config, cG=cG, seed=seed), agent_parameters=agent_parameters)
+    engine.SpoolAgentSamples = shard is not None  # the agent samples of a saved sweep are saved at its end
+    mode_results = engine.RunAll(periods, modes, save=False)
+
+    prices = cG if engine.NumPrices is not None else [cG]
+    if fan_out is None:
+        fan_out = {mode: [(index, price, index) for index, price in enumerate(prices)] for mode in modes}
+
+    results = []
+    result_sinks = {}
+    for mode, mode_result in mode_results.items():
+        for position, price, index in fan_out[mode]:
+            simulation_stats, agent_sample = mode_result[index] if engine.NumPrices is not None else mode_result
+            if price != prices[index]:
+                simulation_stats = simulation_stats.assign(PriceOfGreenDelivery=price)
+            results.append((price, mode, simulation_stats, agent_sample))
+
+            if shard is not None:
+                if position not in result_sinks:
+                    result_sinks[position] = ResultSink(shard=f"{shard}-{position:06d}",
+                                                        output_format=config.get('output_format', 'csv'))
+                # the shard's simulation index is renumbered by the merge, see save_results
+                result_sinks[position].AppendSimulation(simulation_stats.copy(), mode)
+
+    return results
+
+
+def run_worker_task(*task_args):
+    """
+    run_task in a worker process.
+
+    :return: the results of run_task, and what the worker's instrumentation recorded during the task
+    """
+    return run_task(*task_args), collect_registry()
+
+
+def save_results(config, results, sweep_id):
+    """
+    Merges the shards of a sweep into ./SavedStats in task order, and saves the agent sample of the last task of each
+    simulation type and price, as a serial run would leave them.
+
+    :param results: results of run_sweep, in (replication, price, mode) order, which is the order of their shards
+    :return: the results, whose simulation statistics have the SimulationIndex they were saved under
+    """
+    aggregation_manager = AggregationManager(config['eG'], config['eN'], config['cG'], config['cN'],
+                                             output_format=config.get('output_format', 'csv'))
+    result_sink = aggregation_manager.ResultSink
+    simulation_indices = {}
+    for mode in dict.fromkeys(mode for replication, cG, mode, simulation_stats, agent_sample in results):
+        simulation_indices[mode] = result_sink.next_index(result_sink.FilePath(mode))
+        result_sink.MergeShards(mode, f"{sweep_id}-")
+
+    indexed_results = []
+    for replication, cG, mode, simulation_stats, agent_sample in results:
+        simulation_stats = simulation_stats.assign(SimulationIndex=simulation_indices[mode])
+        simulation_indices[mode] += 1
+        indexed_results.append((replication, cG, mode, simulation_stats, agent_sample))
+
+    # samples are saved in order of their last task, so that the last sample of each type is saved last
+    last_agent_samples = {}
+    for replication, cG, mode, simulation_stats, agent_sample in results:
+        last_agent_samples.pop((mode, cG), None)
+        last_agent_samples[(mode, cG)] = agent_sample
+
+    for (mode, cG), agent_sample in last_agent_samples.items():
+        aggregation_manager.Reset(cG)
+        aggregation_manager.SaveAgentSample(agent_sample, mode)
+
+    return indexed_results
+
+
+def remove_spools(results):
+    """
+    Removes the spooled agent samples of saved sweep results which no ResultCache keeps.
+
+    :return: the results, with None in place of the agent samples removed
+    """
+    for spool in agent_sample_spools(results):
+        if spool.Temporary():
+            spool.Remove()
+    return [(replication, cG, mode, simulation_stats,
+             None if isinstance(agent_sample, AgentSampleSpool) and agent_sample.Temporary() else agent_sample)
+            for replication, cG, mode, simulation_stats, agent_sample in results]
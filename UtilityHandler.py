@@ -3,11 +3,37 @@
 """
 UtilityHandler.py:
 
-The UtilityHandler will
+The UtilityHandler will solve the agents' utility maximisation problem symbolically and turn the solutions into
+numerical functions.
+
+Solutions are cached at module level, keyed by the utility and budget expressions, so that every Engine (and every
+fork of an Engine) in a process solves each Lagrangian only once. If a cache directory is given, the numerical
+functions are also saved there as generated Python source, so that a fresh process can load them without solving.
+
+With closed_form set, the hand-derived solution in ClosedForm.py is used instead, and nothing is solved.
+
+The utility functions are kept as text, and sympy is only imported to solve them or to parse the solved expressions.
+As the cache keys are computed from the text, neither the closed form nor a cached solution imports sympy.
 """
 
+import hashlib
+import os
+
+import ClosedForm
+from Checkpoint import *
+from Instrumentation import *
+
+# Utility functions and budget constraint, in terms of the names of the symbols of EnvSymbols.py
+NORMAL_UTILITY = 'a*ln(Q) + b*ln(S) - a*ln(mu*e*Q + 1)'
+SOCIAL_UTILITY = NORMAL_UTILITY + ' + a*delta*ln(1 + F)'
+BUDGET = 'Y - P*Q - S - c_Gen'
 
-from EnvSymbols import *  # Also imports math and sympy
+# Arguments of the generated numerical functions
+NORMAL_ARGS = ['a', 'b', 'mu', 'Y', 'P', 'e', 'c_Gen']
+SOCIAL_ARGS = NORMAL_ARGS + ['delta', 'F']
+
+# Module level cache of solutions, keyed by UtilityHandler.cache_key
+SOLUTION_CACHE = {}
 
 
 class UtilityHandler:
@@ -15,48 +41,162 @@ class UtilityHandler:
     UtilityHandler is a class that will solve the utility functions
     """
 
-    def __init__(self):
-        self.Generic_Utility_Function = a * ln(Q) + b * ln(S) - a * ln(mu * e_rate * Q + 1)
-        self.Generic_Utility_Function_QS = None
-        self.Generic_Solved_Q = None
-        self.Generic_Solved_S = None
-        self.Generic_Budget_Expr = Y - P * Q - S - cGeneric
+    def __init__(self, cache_dir=None, closed_form=False):
+        """
+        :param cache_dir:   Directory in which solved utility functions are saved as Python source. None keeps the
+                            cache in memory only.
+        :param closed_form: If True, the numerical functions are the closed-form solution of ClosedForm.py, and Optimum
+                            computes the utility, Q and S in one pass
+        """
+        self.Generic_Utility_Text = NORMAL_UTILITY
+        self.Solution = None
         self.Lambdify_Q = None
         self.Lambdify_S = None
         self.LambdifyNormal = None
         self.LambdifySocial = None
+        self.CacheDir = cache_dir
+        self.ClosedForm = closed_form
 
+    @instrumented('solve.normal')
     def SolveNormal(self):
         """
+        Solves the utility maximisation without social effects, and sets LambdifyNormal, Lambdify_Q and Lambdify_S.
+        """
+        self.Generic_Utility_Text = NORMAL_UTILITY
 
-        :return:
+        if self.ClosedForm:
+            self.Lambdify_Q = ClosedForm.solved_q
+            self.Lambdify_S = ClosedForm.solved_s
+            self.LambdifyNormal = ClosedForm.utility
+            return
+
+        solution = self.solve(self.Generic_Utility_Text, NORMAL_ARGS)
+        self.assign_solution(solution)
+        self.LambdifyNormal = solution['Lambdify_Utility']
+
+    @instrumented('solve.social')
+    def SolveSocial(self):
+        """
+        Solves the utility maximisation with the social effect of friends' plans, and sets LambdifySocial, Lambdify_Q
+        and Lambdify_S.
         """
-        Q_sol, S_sol = self.max_Q_and_S(self.Generic_Utility_Function)
+        self.Generic_Utility_Text = SOCIAL_UTILITY
 
-        self.Generic_Solved_S = S_sol
-        self.Generic_Solved_Q = Q_sol
+        if self.ClosedForm:
+            self.Lambdify_Q = ClosedForm.solved_q
+            self.Lambdify_S = ClosedForm.solved_s
+            self.LambdifySocial = ClosedForm.utility_social
+            return
 
-        self.Generic_Utility_Function_QS = self.Generic_Utility_Function.subs([(Q, Q_sol), (S, S_sol)])
+        solution = self.solve(self.Generic_Utility_Text, SOCIAL_ARGS)
+        self.assign_solution(solution)
+        self.LambdifySocial = solution['Lambdify_Utility']
 
-        self.add_lambdify(self.Generic_Utility_Function_QS)
-        self.add_lambdify_Q(Q_sol)
-        self.add_lambdify_S(S_sol)
+    def Optimum(self, a, b, mu, Y, P, e, c):
+        """
+        The utility without social effects, Q and S at the optimum, see SolveNormal.
 
-    def SolveSocial(self):
-        self.Generic_Utility_Function = a * ln(Q) + b * ln(S) - a * ln(mu * e_rate * Q + 1) + a * delta * ln(1 + F)
+        :return: (utility, Q, S)
+        """
+        if self.ClosedForm:
+            return ClosedForm.optimum(a, b, mu, Y, P, e, c)
+        return self.LambdifyNormal(a, b, mu, Y, P, e, c), self.Lambdify_Q(a, b, mu, Y, P, e, c), \
+            self.Lambdify_S(a, b, mu, Y, P, e, c)
 
-        Q_sol, S_sol = self.max_Q_and_S(self.Generic_Utility_Function)
+    def OptimumSocial(self, a, b, mu, Y, P, e, c, delta, F):
+        """
+        The utility with the social effect of friends' plans, Q and S at the optimum, see SolveSocial.
 
-        self.Generic_Solved_S = S_sol
-        self.Generic_Solved_Q = Q_sol
+        :return: (utility, Q, S)
+        """
+        if self.ClosedForm:
+            return ClosedForm.optimum_social(a, b, mu, Y, P, e, c, delta, F)
+        return self.LambdifySocial(a, b, mu, Y, P, e, c, delta, F), self.Lambdify_Q(a, b, mu, Y, P, e, c), \
+            self.Lambdify_S(a, b, mu, Y, P, e, c)
+
+    @property
+    def Normal_Utility_Function(self):
+        return parse_expression(NORMAL_UTILITY)
+
+    @property
+    def Social_Utility_Function(self):
+        return parse_expression(SOCIAL_UTILITY)
+
+    @property
+    def Generic_Utility_Function(self):
+        return parse_expression(self.Generic_Utility_Text)
+
+    @property
+    def Generic_Budget_Expr(self):
+        return parse_expression(BUDGET)
+
+    @property
+    def Generic_Solved_Q(self):
+        return self.solved_expression('Q')
+
+    @property
+    def Generic_Solved_S(self):
+        return self.solved_expression('S')
+
+    @property
+    def Generic_Utility_Function_QS(self):
+        return self.solved_expression('Utility')
 
-        self.Generic_Utility_Function_QS = self.Generic_Utility_Function.subs([(Q, Q_sol), (S, S_sol)])
+    def solved_expression(self, name):
+        """
+        The solved expressions are kept as srepr strings and only parsed back into sympy when they are asked for, so
+        that loading a cached solution does not pay for sympy parsing.
+        """
+        if self.Solution is None:
+            return None
+
+        from sympy import sympify
+        return sympify(self.Solution[name])
+
+    def assign_solution(self, solution):
+        self.Solution = solution
+        self.Lambdify_Q = solution['Lambdify_Q']
+        self.Lambdify_S = solution['Lambdify_S']
+
+    def solve(self, util_text, utility_args):
+        """
+        Returns the solution of the utility maximisation for util_text, from the module level cache, the cache
+        directory, or by solving the Lagrangian, in that order.
+
+        :param util_text:    utility function in terms of Q and S, see NORMAL_UTILITY
+        :param utility_args: names of the arguments of the numerical utility function
+        :return: dict of the solved expressions and their numerical functions
+        """
+        key = self.cache_key(util_text)
 
-        self.add_lambdify_social(self.Generic_Utility_Function_QS)
-        self.add_lambdify_Q(Q_sol)
-        self.add_lambdify_S(S_sol)
+        if key not in SOLUTION_CACHE:
+            solution = self.load_solution(key)
+
+            if solution is None:
+                from EnvSymbols import Q, S
+
+                util_expr = parse_expression(util_text)
+                Q_sol, S_sol = self.max_Q_and_S(util_expr)
+                util_QS = util_expr.subs([(Q, Q_sol), (S, S_sol)])
+                source = self.generate_source(util_expr, Q_sol, S_sol, util_QS, utility_args)
+                solution = self.compile_source(source, key)
+                self.save_source(key, source)
+
+            SOLUTION_CACHE[key] = solution
+
+        return SOLUTION_CACHE[key]
+
+    def cache_key(self, util_text):
+        """
+        Hash of the utility function and budget constraint, used as the cache key and file name.
+        """
+        text = f'{util_text};{BUDGET}'
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
 
     def max_Q_and_S(self, util_expr):
+        from sympy import diff, solve
+        from EnvSymbols import Q, S, lam
+
         L = util_expr - lam * (self.Generic_Budget_Expr)  # L for the Lagrangian
         dQ = diff(L, Q)  # FOC 1
         dS = diff(L, S)  # FOC 2
@@ -76,14 +216,88 @@ class UtilityHandler:
 
         return Q_sol, S_sol
 
-    def add_lambdify(self, func):
-        self.LambdifyNormal = lambdify([a, b, mu, Y, P, e_rate, cGeneric], func)
+    def generate_source(self, util_expr, Q_sol, S_sol, util_QS, utility_args):
+        """
+        Writes the solved expressions as the source of a Python module with one NumPy function per expression, and the
+        expressions themselves as srepr strings.
+        """
+        from sympy import srepr
+        from sympy.printing.numpy import NumPyPrinter
+
+        printer = NumPyPrinter({'fully_qualified_modules': True})
+
+        def function_source(name, args, expr):
+            arg_names = ', '.join(str(arg) for arg in args)
+            return f"def {name}({arg_names}):\n    return {printer.doprint(expr)}\n"
+
+        return '\n'.join([
+            f"# Generated by UtilityHandler.py for the utility function {util_expr}",
+            "import numpy",
+            "",
+            f"EXPRESSION_Q = {srepr(Q_sol)!r}",
+            f"EXPRESSION_S = {srepr(S_sol)!r}",
+            f"EXPRESSION_UTILITY = {srepr(util_QS)!r}",
+            "",
+            function_source('Lambdify_Utility', argument_symbols(utility_args), util_QS),
+            function_source('Lambdify_Q', argument_symbols(NORMAL_ARGS), Q_sol),
+            function_source('Lambdify_S', argument_symbols(NORMAL_ARGS), S_sol),
+        ])
+
+    def compile_source(self, source, key):
+        """
+        Executes generated source and returns the solution dict. The expressions are returned as srepr strings.
+        """
+        namespace = {}
+        exec(compile(source, f"<UtilityHandler {key}>", 'exec'), namespace)
+
+        return {
+            'Q': namespace['EXPRESSION_Q'],
+            'S': namespace['EXPRESSION_S'],
+            'Utility': namespace['EXPRESSION_UTILITY'],
+            'Lambdify_Utility': namespace['Lambdify_Utility'],
+            'Lambdify_Q': namespace['Lambdify_Q'],
+            'Lambdify_S': namespace['Lambdify_S']
+        }
+
+    def cache_path(self, key):
+        return os.path.join(self.CacheDir, f"solution_{key}.py")
+
+    def load_solution(self, key):
+        if self.CacheDir is None or not os.path.exists(self.cache_path(key)):
+            return None
+
+        with open(self.cache_path(key), 'r') as f:
+            return self.compile_source(f.read(), key)
+
+    def save_source(self, key, source):
+        if self.CacheDir is None:
+            return
+
+        write_atomically(self.cache_path(key), lambda f: f.write(source), 'w')
+
+
+def expression_symbols():
+    """
+    The symbols of EnvSymbols.py by name, and ln.
+    """
+    import EnvSymbols
+
+    symbols = {str(value): value for value in vars(EnvSymbols).values() if isinstance(value, EnvSymbols.Symbol)}
+    symbols['ln'] = EnvSymbols.ln
+    return symbols
+
 
-    def add_lambdify_social(self, func):
-        self.LambdifySocial = lambdify([a, b, mu, Y, P, e_rate, cGeneric, delta, F], func)
+def parse_expression(text):
+    """
+    Parses an expression in terms of the names of the symbols of EnvSymbols.py, such as NORMAL_UTILITY, into sympy.
+    """
+    from sympy import sympify
+    return sympify(text, locals=expression_symbols())
 
-    def add_lambdify_Q(self, func):
-        self.Lambdify_Q = lambdify([a, b, mu, Y, P, e_rate, cGeneric], func)
 
-    def add_lambdify_S(self, func):
-        self.Lambdify_S = lambdify([a, b, mu, Y, P, e_rate, cGeneric], func)
+def argument_symbols(names):
+    """
+    The symbols of a list of argument names, such as NORMAL_ARGS.
+    """
+    symbols = expression_symbols()
+    return [symbols[name] for name in names]
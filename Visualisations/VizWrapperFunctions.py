@@ -6,15 +6,72 @@ VizWrapperFunctions.py:
 This file contains functions that assist with visualisations.
 """
 
+import os
+
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
 from Constants import *
+from ResultSink import *
 
 
 # %matplotlib inline
 
 
+def stats_path(sim_type, level, directory, output_format):
+    """
+    :return: path of the csv file or dataset directory of saved statistics, see AggregationManager.FilePath
+    """
+    if output_format == 'csv':
+        return os.path.join(directory, f'{sim_type}_{level}.csv')
+    return os.path.join(directory, f'{sim_type}_{level}')
+
+
+def iter_stats(sim_type, level='simulation', directory='../SavedStats', output_format='csv', prices=None,
+               columns=None, chunksize=100000):
+    """
+    Reads saved statistics lazily, one dataframe at a time: one file per simulation (or agent sample) for the columnar
+    formats, and chunks of chunksize rows for csv files. Only the partitions of the requested prices are opened.
+
+    :param sim_type:      'benchmark', 'normal' or 'social'
+    :param level:         'simulation' or 'agent'
+    :param directory:     directory of the saved statistics
+    :param output_format: format the statistics were saved in, 'csv', 'parquet', 'feather' or 'npz'
+    :param prices:        If given, only the statistics of these prices of green delivery
+    :param columns:       If given, only these columns are read
+    """
+    path = stats_path(sim_type, level, directory, output_format)
+
+    if output_format == 'csv':
+        usecols = columns
+        if columns is not None and prices is not None and level != 'agent':
+            usecols = list(dict.fromkeys(list(columns) + ['PriceOfGreenDelivery']))
+        for chunk in pd.read_csv(path, usecols=usecols, chunksize=chunksize):
+            if prices is not None and level != 'agent':
+                chunk = chunk[chunk['PriceOfGreenDelivery'].isin(prices)]
+            yield chunk if columns is None else chunk[list(columns)]
+        return
+
+    for filepath in dataset_files(path, prices):
+        df = read_frame(filepath, columns)
+        if columns is None and 'PriceOfGreenDelivery' not in df.columns:
+            # agent samples only record their price in the partition name
+            price = os.path.basename(os.path.dirname(filepath)).split('=', 1)[1]
+            df.insert(0, 'PriceOfGreenDelivery', pd.to_numeric(price))
+        yield df
+
+
+def load_stats(sim_type, level='simulation', directory='../SavedStats', output_format='csv', prices=None,
+               columns=None):
+    """
+    Reads saved statistics into one dataframe, see iter_stats.
+    """
+    dfs = list(iter_stats(sim_type, level, directory, output_format, prices, columns))
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(dfs, ignore_index=True)
+
+
 def aggregate_emissions(df):
     """
     Aggregates the emissions grouped by Period.
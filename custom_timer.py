@@ -1,9 +1,13 @@
 import functools
 import time
 
+from Instrumentation import *
+
 def timer(func):
     """
-    If you decorate a function with this, it will time the period taken to run the decorated function.
+    If you decorate a function with this, it will time the period taken to run the decorated function. The time is
+    printed unless in quiet mode, and recorded under the function's name if instrumentation is on (see
+    Instrumentation.py).
     """
 
     @functools.wraps(func)
@@ -12,6 +16,7 @@ def timer(func):
         value = func(*args, **kwargs)
         toc = time.perf_counter()
         elapsed_time = toc - tic
-        print(f"Elapsed time ({func.__name__}): {elapsed_time:0.4f} seconds")
+        observe_value(func.__qualname__, elapsed_time)
+        log_message(f"Elapsed time ({func.__name__}): {elapsed_time:0.4f} seconds")
         return value
-    return wrapper_timer
\ No newline at end of file
+    return wrapper_timer
@@ -8,15 +8,15 @@ This file runs the main program. It accepts
 
 from Engine import *
 from RandomNumbers import *
-
-import copy
+from Sweep import *
+from AdaptiveSweep import *
 
 
 @timer
 def main():
     
     # Engine inputs
-    num_agents = 1000  # ETA 90-100 seconds
+    num_agents = 1000  # Run times at other numbers of agents can be measured with Benchmark.py
     price_of_average_good = 65
     alpha_mean, alpha_std = 0.2, 0.04  
     mu_mean, mu_std = 0.05, 0.025
@@ -26,6 +26,21 @@ def main():
     emissions_of_green_delivery = 0.9  
     emissions_of_normal_delivery = 1
     inflation_rate = 0.017
+    vectorized = True  # Evaluate all agents per period as NumPy arrays
+    solution_cache_dir = './SolutionCache'  # Solved utility functions are reused from here across runs
+    closed_form = False  # Compute the agents' optimum from its closed form rather than solving it with sympy
+    jit = False  # Evaluate each period in a compiled loop over agents if numba is installed (implies closed_form)
+    incremental = False  # With jit, only evaluate both plans of agents whose choice may change ('check' to verify)
+    keep_history = True  # False keeps only the last two periods of records, and computes statistics as periods end
+    output_format = 'csv'  # 'csv', or 'parquet', 'feather' or 'npz' for columnar datasets partitioned by price
+    result_cache_dir = None  # e.g. './ResultCache': runs repeated with the same seed load their results from here
+    result_cache_size = 2 ** 30  # Largest size of the result cache in bytes, beyond which old results are evicted
+    checkpoint_dir = None  # e.g. './Checkpoints': where an unfinished sweep is checkpointed, None for no checkpoints
+    checkpoint_interval = 6  # Periods between the checkpoints of each run
+    resume = False  # Continue the interrupted sweep checkpointed in checkpoint_dir
+    quiet = False  # Silence the progress messages of the Engine and its agents (or set SIMULATION_QUIET=1)
+    instrument = False  # Time each stage (or set SIMULATION_INSTRUMENTATION=1), see Instrumentation.py
+    instrumentation_file = './SavedStats/instrumentation.json'  # Where the timings are saved as JSON
 
     # Calculations for distribution shape parameters
     alpha_a, alpha_b = find_beta_shape_params(mean=alpha_mean, stdev=alpha_std)
@@ -38,39 +53,59 @@ def main():
     prices_of_green_delivery = range(8, 24, 3)  # At what different prices of green delivery do you want to simulate?
     periods = 24  # How many periods for each simulation to be ran?
 
-    for i in range(25): # How many times do you want the simulation to be ran? (monte carlo)
-        # Initiate engine with input values
-        engine = Engine(num_agents=num_agents, price=price_of_average_good, a_params=[alpha_a, alpha_b],
-                        mu_params=[mu_a, mu_b], income_interval=[log_income_mean, log_income_std],
-                        cG=0, cN=price_of_normal_delivery, eG=emissions_of_green_delivery,
-                        eN=emissions_of_normal_delivery,
-                        inflation_rate=inflation_rate, delta_interval=[0.01, 0.1], friend_interval=[1, 10])
-
-        for cG in prices_of_green_delivery:
-
-
-            engine_copy = copy.deepcopy(engine)
-            engine_copy.cG = cG
-            engine_copy.AggregationManager.cG = cG
-            engine_copy.RunBenchMark(periods)
-
-            engine_copy = copy.deepcopy(engine)
-            engine_copy.cG = cG
-            engine_copy.AggregationManager.cG = cG
-            engine_copy.RunNormal(periods)
-
-            engine_copy = copy.deepcopy(engine)
-            engine_copy.cG = cG
-            engine_copy.AggregationManager.cG = cG
-            engine_copy.RunSocial(periods)
-
-    print(f"\n{len(prices_of_green_delivery) * 3} simulations ran overall, reflecting the following prices of green "
-          f"delivery: {[i for i in prices_of_green_delivery]}.\n"
+    replications = 25  # How many times do you want the simulation to be ran? (monte carlo)
+    adaptive = False  # Run replications in batches until the statistics are precise enough, at most replications
+    min_replications, batch_size = 10, 5  # Replications of the first batch, then of each following batch
+    confidence = 0.95  # Confidence level of the intervals of the final-period statistics
+    targets = DEFAULT_TARGETS  # Half-widths of those intervals at which a price and simulation type stops
+    workers = None  # How many processes run the simulations? None uses every CPU
+    seed = None  # Set an integer to reproduce a sweep
+    batch_prices = False  # Simulate every price of green delivery at once in each replication (needs vectorized)
+
+    config = dict(num_agents=num_agents, price=price_of_average_good, a_params=[alpha_a, alpha_b],
+                  mu_params=[mu_a, mu_b], income_interval=[log_income_mean, log_income_std],
+                  cG=0, cN=price_of_normal_delivery, eG=emissions_of_green_delivery,
+                  eN=emissions_of_normal_delivery,
+                  inflation_rate=inflation_rate, delta_interval=[0.01, 0.1], friend_interval=[1, 10],
+                  vectorized=vectorized, solution_cache_dir=solution_cache_dir, closed_form=closed_form, jit=jit,
+                  incremental=incremental,
+                  keep_history=keep_history, output_format=output_format, result_cache_dir=result_cache_dir,
+                  result_cache_size=result_cache_size, checkpoint_interval=checkpoint_interval)
+
+    if quiet:
+        set_quiet()
+    if instrument:
+        enable_instrumentation()
+    observe_value('startup.import', IMPORT_SECONDS)
+
+    if adaptive and resume:
+        summary, results = resume_adaptive_sweep(checkpoint_dir, workers=workers)
+    elif adaptive:
+        summary, results = run_adaptive_sweep(config, prices_of_green_delivery, periods=periods, targets=targets,
+                                              confidence=confidence, min_replications=min_replications,
+                                              max_replications=replications, batch_size=batch_size, workers=workers,
+                                              seed=seed, batch_prices=batch_prices, checkpoint_dir=checkpoint_dir)
+    elif resume:
+        results = resume_sweep(checkpoint_dir, workers=workers)
+    else:
+        results = run_sweep(config, prices_of_green_delivery, replications, periods=periods, workers=workers, seed=seed,
+                            batch_prices=batch_prices, checkpoint_dir=checkpoint_dir)
+
+    if Instrumentation.Enabled:
+        REGISTRY.ToJSON(instrumentation_file)
+
+    # the number of replications of each price and simulation type varies in adaptive sweeps
+    replications_run = len(set(replication for replication, cG, mode, simulation_stats, agent_sample in results))
+    print(f"\n{len(results)} simulations ran overall, over {replications_run} replications, reflecting the following "
+          f"prices of green delivery: {[i for i in prices_of_green_delivery]}.\n"
           f"Number of agents: {num_agents}\n"
           f"Median monthly income: {round(median_monthly_income, 2)}\n"
           f"Price of average good: {price_of_average_good}\n"
           f"Alpha average (stdev): {round(alpha_mean, 2)} ({round(alpha_std, 2)})\n"
           f"Eco consciousness average (stdev): {round(mu_mean, 3)} ({round(mu_std, 3)})")
+    if result_cache_dir is not None:
+        print(f"Result cache: {REGISTRY.Counters.get('result_cache.hits', 0)} hits, "
+              f"{REGISTRY.Counters.get('result_cache.misses', 0)} misses")
 
 
 if __name__ == '__main__':